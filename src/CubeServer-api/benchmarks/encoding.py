@@ -0,0 +1,79 @@
+"""Compares the size of typical team api payloads, and the time it takes to
+encode and decode them, as JSON and as MessagePack
+
+Run with: python benchmarks/encoding.py [repetitions]
+(Timings are for CPython on the server; the difference is proportionally
+larger for CircuitPython on the cubes.)"""
+
+import sys
+from base64 import encodebytes, decodebytes
+from json import dumps, loads
+from os import urandom
+from timeit import timeit
+
+import msgpack
+
+
+def _payloads():
+    """(name, as JSON, as MessagePack) for each of the typical payloads"""
+    reading = {"type": "temperature", "value": 72.5}
+    batch = [
+        {"type": "pressure", "value": 29.92, "measured_at": 1700000000 + 60 * i}
+        for i in range(50)
+    ]
+    status = {
+        "datetime": "2023-11-14T22:13:20.000000",
+        "unix_time": 1700000000,
+        "2020_time": 122163200,
+        "status": {"score": 123.5},
+        "CubeServer_version": "1.7.2",
+    }
+    code = urandom(32768)  # TEAM_MAX_UPDATE_LENGTH
+    update = {
+        "datetime": "2023-11-14T22:13:20.000000",
+        "unix_time": 1700000000,
+        "new": True,
+    }
+    return [
+        ("POST /data", reading, reading),
+        ("POST /data/batch (50)", batch, batch),
+        ("GET /status", status, status),
+        (
+            "GET /update (32KiB)",
+            dict(update, encoding="base64", code=encodebytes(code).decode()),
+            dict(update, encoding="binary", code=code),
+        ),
+    ]
+
+
+def _json_round_trip(payload):
+    decoded = loads(dumps(payload))
+    if isinstance(decoded, dict) and decoded.get("encoding") == "base64":
+        decodebytes(decoded["code"].encode())
+
+
+def _msgpack_round_trip(payload):
+    msgpack.unpackb(msgpack.packb(payload))
+
+
+def main(repetitions: int = 2000):
+    print(
+        f"{'payload':<24}{'JSON B':>9}{'msgpack B':>11}"
+        f"{'JSON us':>10}{'msgpack us':>12}"
+    )
+    for name, as_json, as_msgpack in _payloads():
+        json_size = len(dumps(as_json).encode())
+        msgpack_size = len(msgpack.packb(as_msgpack))
+        json_time = timeit(lambda: _json_round_trip(as_json), number=repetitions)
+        msgpack_time = timeit(
+            lambda: _msgpack_round_trip(as_msgpack), number=repetitions
+        )
+        print(
+            f"{name:<24}{json_size:>9}{msgpack_size:>11}"
+            f"{json_time / repetitions * 1e6:>10.1f}"
+            f"{msgpack_time / repetitions * 1e6:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,246 @@
+"""A load test of the top of the hour, when every team posts at once
+
+The default Rules have the JV teams posting on the hour and half hour, and
+the Varsity teams every 6 and 15 minutes (give or take the tolerance), so at
+the top of the hour everyone posts together. This models that burst: each
+team posts whichever of its readings are due on the hour at a time drawn
+around the hour (a normal distribution, spread over its tolerance), then
+checks its status, and now and then asks for a code update.
+
+The api is run in this process against mongomock, or against a (local)
+mongod given with --mongo. Time is compressed by --time-scale so that the
+burst does not take minutes. Latency is measured from when each request was
+due to be sent, so that time spent waiting for a free client is counted.
+
+Run with (from CubeServer-api):
+    PYTHONPATH=.:../CubeServer-common python benchmarks/thundering_herd.py \
+        [--teams 100] [--help]"""
+
+import argparse
+import logging
+import random
+from base64 import b64encode
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from statistics import quantiles
+from threading import Lock
+from time import perf_counter, sleep
+from types import SimpleNamespace
+
+from flask import Flask
+from flask_restful import Api
+from mongomock import MongoClient as MockMongoClient
+from pymongo import MongoClient
+
+from cubeserver_common import config
+from cubeserver_common.models.utils import PyMongoModel
+
+ON_THE_HOUR = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def _connect(uri: str):
+    """Points the models at a fresh database"""
+    client = MockMongoClient() if uri is None else MongoClient(uri)
+    client.drop_database("cubeserver_herd")
+    PyMongoModel.update_mongo_client(
+        SimpleNamespace(cx=client, db=client["cubeserver_herd"])
+    )
+
+
+def _make_api() -> Flask:
+    """The team api, as cubeserver_api sets it up"""
+    from cubeserver_api.encoding import add_representations
+    from cubeserver_api.team_resources import (
+        CodeUpdate,
+        Data,
+        DataBatch,
+        Status,
+    )
+
+    app = Flask(__name__)
+    api = Api(app)
+    add_representations(api)
+    api.add_resource(Data, "/data")
+    api.add_resource(DataBatch, "/data/batch")
+    api.add_resource(Status, "/status")
+    api.add_resource(CodeUpdate, "/update")
+    return app
+
+
+def _make_teams(count: int) -> list:
+    """Registers count teams (half JV, half Varsity) and a reference team
+    Returns (team, headers) pairs."""
+    from cubeserver_common.models.config.conf import Conf
+    from cubeserver_common.models.config.rules import Rules, RegularOccurrence
+    from cubeserver_common.models.datapoint import DataClass, DataPoint
+    from cubeserver_common.models.team import Team, TeamLevel, TeamStatus
+
+    # Windows that are always open, so that (whenever this is run) every post
+    # is scored against the reference data, as it is at the top of the hour:
+    always = {
+        level: {
+            category: RegularOccurrence(interval=60, tolerance=30) for category in times
+        }
+        for level, times in Rules().times.items()
+    }
+    Rules(post_times=always).save()
+    conf = Conf()
+    conf.competition_on = True
+    conf.save()
+    teams = [
+        Team(
+            name=Team.RESERVED_NAMES[1],
+            weight_class=TeamLevel.REFERENCE,
+            status=TeamStatus.INTERNAL,
+        )
+    ]
+    for i in range(count):
+        level = TeamLevel.JUNIOR_VARSITY if i % 2 else TeamLevel.VARSITY
+        teams.append(
+            Team(
+                name=f"Herd Team {i}",
+                weight_class=level,
+                status=TeamStatus.PARTICIPATING,
+            )
+        )
+    Team.save_many(teams)
+    DataPoint.save_many(
+        DataPoint(teams[0].id, category, value, is_reference=True)
+        for category, value in (
+            (DataClass.PRESSURE, 29.92),
+            (DataClass.TEMPERATURE, 72.0),
+        )
+    )
+    return [
+        (
+            team,
+            {
+                "Authorization": "Basic "
+                + b64encode(f"{team.name}:{team.secret}".encode()).decode()
+            },
+        )
+        for team in teams
+    ]
+
+
+def _schedule(teams: list, time_scale: float, seed: int) -> list:
+    """The requests of the burst, as (due time, endpoint, method, headers,
+    body), in seconds from its start (the hour is at its middle)"""
+    from cubeserver_common.models.config.rules import Rules
+    from cubeserver_common.models.datapoint import DataClass
+    from cubeserver_common.models.team import TeamLevel
+
+    rules = Rules()
+    rng = random.Random(seed)
+    longest = max(
+        occurrence.tolerance
+        for times in rules.times.values()
+        for occurrence in times.values()
+    )
+    middle = longest / time_scale
+    requests = []
+    for team, headers in teams:
+        level = TeamLevel.VARSITY if team.is_reference else team.weight_class
+        due = {
+            category: occurrence.tolerance
+            for category, occurrence in rules.times[level].items()
+            if occurrence.follows(ON_THE_HOUR)
+        }
+        if not due:
+            continue
+        spread = max(due.values()) / 3 / time_scale
+        at = min(max(middle + rng.gauss(0, spread), 0), 2 * middle)
+        for category in due:
+            value = 29.92 if category == DataClass.PRESSURE else 72.0
+            reading = {"type": category.value, "value": value + rng.gauss(0, 0.1)}
+            requests.append((at, "/data", "post", headers, reading))
+            at += rng.uniform(0.05, 0.5) / time_scale
+        requests.append((at, "/status", "get", headers, None))
+        if rng.random() < 0.1:
+            requests.append((at, "/update", "get", headers, None))
+    return sorted(requests, key=lambda request: request[0])
+
+
+def run(app: Flask, requests: list, clients: int) -> dict:
+    """Sends the requests when they are due
+    Returns the latencies (in seconds) and error count of each endpoint."""
+    results = defaultdict(lambda: SimpleNamespace(latencies=[], errors=0))
+    lock = Lock()
+
+    def send(due: float, endpoint: str, method: str, headers: dict, body):
+        response = getattr(app.test_client(), method)(
+            endpoint, json=body, headers=headers
+        )
+        latency = perf_counter() - start - due
+        with lock:
+            result = results[endpoint]
+            result.latencies.append(latency)
+            if response.status_code >= 400:
+                result.errors += 1
+
+    with ThreadPoolExecutor(clients) as pool:
+        start = perf_counter()
+        for request in requests:
+            wait = request[0] - (perf_counter() - start)
+            if wait > 0:
+                sleep(wait)
+            pool.submit(send, *request)
+    results["(all)"].latencies = [
+        latency for result in list(results.values()) for latency in result.latencies
+    ]
+    results["(all)"].errors = sum(result.errors for result in results.values())
+    results["(all)"].elapsed = perf_counter() - start
+    return results
+
+
+def report(results: dict):
+    """Prints the latency percentiles and the throughput of each endpoint"""
+    elapsed = results["(all)"].elapsed
+    print(
+        f"{'endpoint':<12}{'requests':>9}{'errors':>8}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>8}"
+    )
+    for endpoint, result in sorted(results.items()):
+        if len(result.latencies) < 2:
+            continue
+        p = quantiles(result.latencies, n=100, method="inclusive")
+        print(
+            f"{endpoint:<12}{len(result.latencies):>9}{result.errors:>8}"
+            f"{p[49] * 1e3:>9.1f}{p[94] * 1e3:>9.1f}{p[98] * 1e3:>9.1f}"
+            f"{len(result.latencies) / elapsed:>8.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--teams", type=int, default=100)
+    parser.add_argument(
+        "--mongo", help="a mongod to use, e.g. mongodb://localhost (not mongomock)"
+    )
+    parser.add_argument(
+        "--time-scale", type=float, default=30.0, help="how much faster than life"
+    )
+    parser.add_argument("--clients", type=int, default=64, help="concurrent clients")
+    parser.add_argument(
+        "--async-ingestion", action="store_true", help="queue posted data (202)"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config.ASYNC_INGESTION = args.async_ingestion
+    _connect(args.mongo)
+    app = _make_api()
+    # (the api logs every request, which would bury the report and slow it)
+    logging.getLogger().setLevel(logging.WARNING)
+    teams = _make_teams(args.teams)
+    requests = _schedule(teams, args.time_scale, args.seed)
+    print(
+        f"{len(requests)} requests from {len(teams)} teams over "
+        f"{requests[-1][0]:.1f}s ({args.time_scale:g}x faster than life)"
+    )
+    report(run(app, requests, args.clients))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ from flask_apscheduler import APScheduler
 from cubeserver_common import configure_db, config, init_logging
 from cubeserver_common.gensecret import check_secrets
 from ._version import *
+from .encoding import add_representations
 
 # Init logger:
 init_logging()
@@ -32,10 +33,21 @@ if all(
     app.config["SECRET_KEY"] = check_secrets()
     logging.debug("Initializing Flask-Restful Api")
     api = Api(app)
+    add_representations(api)  # (MessagePack, for the cubes)
 
     logging.debug("Initializing db connection")
     configure_db(app)
 
+    # Shed load when busy:
+    from cubeserver_api.admission import init_admission_control
+
+    init_admission_control(app)
+
+    # Reference data for scoring:
+    from cubeserver_common.models.datapoint import DataPoint
+
+    DataPoint.reference_timeline.backfill()
+
     # Email quota counting:
     from cubeserver_common.models.team import Team
     from cubeserver_common.models.config.conf import Conf
@@ -56,9 +68,19 @@ if all(
     logging.debug("Starting scheduler")
     scheduler.start()
 
+    # Keep the configuration in sync between server processes:
+    logging.debug("Watching for configuration changes")
+    Conf.watch()
+
     # Import after init'ing the db:
     logging.debug("Loading team api resources")
-    from cubeserver_api.team_resources import Data, Status, Email, CodeUpdate
+    from cubeserver_api.team_resources import (
+        Data,
+        DataBatch,
+        Status,
+        Email,
+        CodeUpdate,
+    )
 
     logging.debug("Loading beacon api resources")
     from cubeserver_api.beacon_resources import NextMessage, Message
@@ -66,6 +88,7 @@ if all(
     # Attach resources:
     logging.debug("Attaching team api resources")
     api.add_resource(Data, "/data")  # TODO: Use as decorators?
+    api.add_resource(DataBatch, "/data/batch")
     api.add_resource(Status, "/status")
     api.add_resource(Email, "/email")
     api.add_resource(CodeUpdate, "/update")
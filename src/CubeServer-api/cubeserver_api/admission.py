@@ -0,0 +1,75 @@
+"""Admission control for the api
+
+Each server process turns requests away (429) while it is busy with
+API_MAX_CONCURRENT_REQUESTS others, and each team is held to the rate limit
+of its division (see Rules.rate_limit), kept in RATE_LIMIT_BACKEND.
+A team has a bucket of its own for each kind of request, so that (e.g.)
+polling for code updates never uses up its allowance for posting data."""
+
+import logging
+from functools import wraps
+from math import ceil
+from threading import BoundedSemaphore
+
+from flask import Flask, g
+
+from cubeserver_common import config
+from cubeserver_common.models.config.rules import Rules
+from cubeserver_common.models.team import TeamStatus
+from cubeserver_common.ratelimit import TokenBuckets, make_token_buckets
+
+from .auth import current_team
+
+__all__ = ["init_admission_control", "rate_limited"]
+
+_in_progress = BoundedSemaphore(config.API_MAX_CONCURRENT_REQUESTS)
+_token_buckets: TokenBuckets = None
+
+
+def _too_many_requests(message: str, retry_after: float):
+    return {"message": message}, 429, {"Retry-After": str(ceil(retry_after))}
+
+
+def init_admission_control(app: Flask):
+    """Makes an app shed requests beyond API_MAX_CONCURRENT_REQUESTS"""
+
+    @app.before_request
+    def admit():
+        if not _in_progress.acquire(blocking=False):
+            logging.warning("Too busy; turning a request away")
+            return _too_many_requests(
+                "The server is busy", config.API_OVERLOAD_RETRY_AFTER
+            )
+        g.admitted = True
+
+    @app.teardown_request
+    def release(_):
+        if g.pop("admitted", False):
+            _in_progress.release()
+
+
+def rate_limited(bucket: str) -> callable:
+    """Makes a decorator for team resource functions, which refuses requests
+    (429) from a team that is over its rate limit for a kind of request
+    (the bucket, e.g. "data"); internal teams are exempt
+    This must be applied inside of (listed before) auth.login_required."""
+
+    def decorator(func: callable) -> callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            global _token_buckets
+            team = current_team()
+            if config.RATE_LIMIT_BACKEND is None or team.status == TeamStatus.INTERNAL:
+                return func(*args, **kwargs)
+            if _token_buckets is None:
+                _token_buckets = make_token_buckets(config.RATE_LIMIT_BACKEND)
+            rate, burst = Rules.retrieve_instance().rate_limit(team.weight_class)
+            wait = _token_buckets.take(f"{team.id}/{bucket}", rate, burst)
+            if wait > 0:
+                logging.info(f"Rate limited {team.name} ({bucket}) for {wait:.1f}s")
+                return _too_many_requests("Too many requests", wait)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
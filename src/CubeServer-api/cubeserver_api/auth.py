@@ -1,10 +1,10 @@
 import logging
 import os
 
-from flask import request
+from flask import g, request
 from flask_httpauth import HTTPBasicAuth
 
-from cubeserver_common.models.team import Team, TeamStatus
+from cubeserver_common.models.team import Team, TeamCredentials, TeamStatus
 
 
 auth = HTTPBasicAuth()
@@ -13,19 +13,27 @@ auth = HTTPBasicAuth()
 @auth.get_password
 def get_team_secret(team_name: str) -> str:
     """Returns the secret code of a team by name
-    (The digest username is the team name)"""
-    team = Team.find_by_name(team_name)
+    (The digest username is the team name)
+    The team's credentials are kept on flask.g for the rest of the request."""
+    team = Team.credentials(team_name)
     logging.debug(f"Request from {team_name}")
     if team and team.status.is_active:
+        g.team = team
         return team.secret
     return None
 
 
+def current_team() -> TeamCredentials:
+    """Returns the credentials of the team that made this (authenticated)
+    request, without going back to the database"""
+    return g.team
+
+
 def internal(func: callable) -> callable:
     """A decorator for internal resource functions"""
 
     def wrapper(*args, **kwargs):
-        team: Team = Team.find_by_name(auth.username())
+        team = current_team()
         if team.status != TeamStatus.INTERNAL:
             # Abort due to unauthorized access
             logging.info(
@@ -45,9 +53,8 @@ def check_secret_header(func: callable) -> callable:
             "API_SECRET"
         )  # TODO: Joe look this upf from the new config location
         if API_SECRET and request.headers.get("X-API-Secret") != API_SECRET:
-            team: Team = Team.find_by_name(auth.username())
             logging.info(
-                f"Unauthorized access attempt without API SECRET by {team.name}"
+                f"Unauthorized access attempt without API SECRET by {auth.username()}"
             )
             return "Unauthorized access attempt without API SECRET", 403
         return func(*args, **kwargs)
@@ -19,6 +19,7 @@ from cubeserver_common import config
 from cubeserver_common.metadata import VERSION
 
 from .auth import auth, internal, check_secret_header
+from .encoding import request_data
 
 
 class NextMessage(Resource):
@@ -35,7 +36,6 @@ class NextMessage(Resource):
     @internal
     def get(self):
         logging.debug(f"Next message get req from {auth.username()}")
-        team: Team = Team.find_by_name(auth.username())
         # data_str = request.get_json()
         # logging.debug(f"Request: {data_str}")
         # if data_str is None:
@@ -74,10 +74,8 @@ class Message(Resource):
     @internal
     def put(self, message_id: str):
         logging.debug(f"Message put req from {auth.username()}")
-        data_str = request.get_json()
+        data_str = request_data()
         logging.debug(f"Request: {data_str}")
-        if data_str is None:
-            data_str = loads(request.form["data"])
         message: BeaconMessage = BeaconMessage.find_by_id(message_id)
         try:
             message.status = SentStatus(
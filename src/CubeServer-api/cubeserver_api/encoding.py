@@ -0,0 +1,67 @@
+"""Content negotiation between JSON (the default) and MessagePack, a compact
+binary encoding that is cheaper for the cubes to build and to parse
+
+Request bodies are decoded according to their Content-Type, and responses are
+encoded according to the Accept header."""
+
+from json import loads
+from typing import Any
+
+import msgpack
+from flask import abort, make_response, request
+from flask_restful import Api
+
+__all__ = [
+    "MSGPACK_MIMETYPES",
+    "add_representations",
+    "wants_binary",
+    "request_data",
+]
+
+MSGPACK_MIMETYPES = [
+    "application/msgpack",
+    "application/vnd.msgpack",
+    "application/x-msgpack",
+]
+"""The media types by which MessagePack may be asked for"""
+
+
+def output_msgpack(data: Any, code: int, headers: dict = None):
+    """Makes a MessagePack response (a Flask-RESTful representation)"""
+    response = make_response(msgpack.packb(data, default=str), code)
+    response.headers.extend(headers or {})
+    response.mimetype = request.accept_mimetypes.best_match(
+        MSGPACK_MIMETYPES, MSGPACK_MIMETYPES[0]
+    )
+    return response
+
+
+def add_representations(api: Api):
+    """Lets an api respond with MessagePack (JSON stays the default)"""
+    for mimetype in MSGPACK_MIMETYPES:
+        api.representation(mimetype)(output_msgpack)
+
+
+def wants_binary() -> bool:
+    """Whether the response to this request will be MessagePack
+    (so that bytes can be sent as they are, without base64)"""
+    return (
+        request.accept_mimetypes.best_match(
+            ["application/json"] + MSGPACK_MIMETYPES, "application/json"
+        )
+        in MSGPACK_MIMETYPES
+    )
+
+
+def request_data() -> Any:
+    """Decodes the body of this request, whether it is MessagePack, JSON, or
+    a form with the JSON in its "data" field (None if there is no body)"""
+    if request.mimetype in MSGPACK_MIMETYPES:
+        try:
+            return msgpack.unpackb(request.get_data())
+        except ValueError:
+            abort(400)
+    data = request.get_json(silent=True)
+    if data is None and "data" in request.form:
+        data = loads(request.form["data"])
+    return data
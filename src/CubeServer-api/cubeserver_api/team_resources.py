@@ -1,9 +1,12 @@
 """This package contains the resource classes for the api used by teams
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
 from time import time
 import logging
+import zlib
+from typing import Optional, Tuple
 
 from flask import request
 from flask_restful import Resource
@@ -13,68 +16,152 @@ from base64 import encodebytes
 
 from cubeserver_common.models.config.rules import Rules
 from cubeserver_common.models.config.conf import Conf
-from cubeserver_common.models.team import Team, TeamLevel
+from cubeserver_common.models.team import Team, TeamCredentials, TeamLevel
 from cubeserver_common.models.beaconmessage import BeaconMessage
 from cubeserver_common.models.datapoint import DataClass, DataPoint
+from cubeserver_common.models.ingestqueue import QueuedDataPoint
 from cubeserver_common import config
 from cubeserver_common.metadata import VERSION
 
-from .auth import auth, check_secret_header
+from .admission import rate_limited
+from .auth import auth, check_secret_header, current_team
+from .encoding import request_data, wants_binary
+
+
+def _datapoint(
+    entry: dict, team: TeamCredentials, moment: Optional[datetime] = None
+) -> Tuple[Optional[DataPoint], int]:
+    """Validates one posted reading ({"type": ..., "value": ...})
+    Returns the (unsaved) DataPoint, or None and the status to reject it with"""
+    data_class = DataClass(entry["type"])
+    if (
+        not Conf.retrieve_instance().competition_on
+        and data_class in DataClass.measurable
+    ):
+        logging.info("Data submission rejected; competition is not running.")
+        return None, 423
+    if data_class in DataClass.manual:
+        logging.debug("Manually-determined- Rejecting")
+        return None, 400  # If this should be manually-determined..
+    data_value = data_class.datatype(entry["value"])
+    logging.debug(f"Value: {data_value}")
+    # Create the DataPoint object:
+    point = DataPoint(
+        team_identifier=team.id,
+        category=data_class,
+        value=data_value,
+        date=moment,
+        is_reference=team.is_reference,
+    )
+    logging.debug(f"DataPoint object: {point}")
+    return point, 201
+
+
+def _measured_at(entry: dict, now: datetime) -> datetime:
+    """When a buffered reading was taken, given as seconds since the epoch
+    or as an ISO 8601 string (the time it was posted, if not given)"""
+    measured_at = entry.get("measured_at")
+    if measured_at is None:
+        return now
+    if isinstance(measured_at, (int, float)) and not isinstance(measured_at, bool):
+        moment = datetime.fromtimestamp(measured_at)
+    elif isinstance(measured_at, str):
+        moment = datetime.fromisoformat(measured_at)
+        if moment.tzinfo is not None:
+            moment = moment.astimezone().replace(tzinfo=None)
+    else:
+        raise ValueError("measured_at must be a timestamp")
+    if moment > now or now - moment > timedelta(seconds=config.DATA_BATCH_MAX_AGE):
+        raise ValueError("measured_at is out of range")
+    return moment
 
 
 class Data(Resource):
     """A POST-only resource for datapoints"""
 
-    decorators = [check_secret_header, auth.login_required]
+    decorators = [rate_limited("data"), check_secret_header, auth.login_required]
 
     def post(self):
         logging.debug(f"Data post req from {auth.username()}")
-        team = Team.find_by_name(auth.username())
+        team = current_team()
         logging.info(f"Data submission de {team.name}")
         # Get DataClass and cast the value:
-        data_str = request.get_json()
+        data_str = request_data()
         logging.debug(f"Request: {data_str}")
-        if data_str is None:
-            data_str = loads(request.form["data"])
-        data_class = DataClass(data_str["type"])
-        if (
-            not Conf.retrieve_instance().competition_on
-            and data_class in DataClass.measurable
-        ):
-            logging.info("Data submission rejected; competition is not running.")
-            return request.form, 423
-        if data_class in DataClass.manual:
-            logging.debug("Manually-determined- Rejecting")
-            return request.form, 400  # If this should be manually-determined..
-        data_value = data_class.datatype(data_str["value"])
-        logging.debug(f"Value: {data_value}")
-        # Create the DataPoint object:
-        point = DataPoint(
-            team_identifier=team.id,
-            category=data_class,
-            value=data_value,
-            is_reference=team.is_reference,
-        )
-        logging.debug(f"DataPoint object: {point}")
+        point, status = _datapoint(data_str, team)
+        if point is None:
+            return request.form, status
+        if config.ASYNC_INGESTION:  # (to be scored by the scoring worker)
+            QueuedDataPoint.enqueue([point])
+            return request.form, 202
         logging.info("Posting data")
-        if Rules.retrieve_instance().post_data(point):
+        if Rules.retrieve_instance().post_data(point, team=team):
             logging.info("Success!")
             return request.form, 201
         logging.info("Something happened suboptimally.")
         return request.form, 400  # TODO: Support better response codes?
 
 
+class DataBatch(Resource):
+    """A POST-only resource for many (e.g. buffered) datapoints at once
+    Takes a list of {"type": ..., "value": ..., "measured_at": ...}s, and
+    responds with a status code for each"""
+
+    decorators = [rate_limited("data"), check_secret_header, auth.login_required]
+
+    def post(self):
+        logging.debug(f"Data batch post req from {auth.username()}")
+        team = current_team()
+        entries = request_data()
+        if not isinstance(entries, list):
+            return {"message": "Expected a list of datapoints"}, 400
+        if len(entries) > config.DATA_BATCH_MAX_SIZE:
+            return {
+                "message": f"At most {config.DATA_BATCH_MAX_SIZE} datapoints at once"
+            }, 413
+        logging.info(f"Batch data submission de {team.name} ({len(entries)})")
+
+        now = datetime.now()
+        statuses = []
+        points = []
+        for entry in entries:
+            try:
+                point, status = _datapoint(entry, team, _measured_at(entry, now))
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                logging.debug(f"Rejecting {entry}: {e}")
+                point, status = None, 400
+            statuses.append(status)
+            if point is not None:
+                points.append((len(statuses) - 1, point))
+
+        if points:
+            if config.ASYNC_INGESTION:  # (to be scored by the scoring worker)
+                saved = QueuedDataPoint.enqueue([point for _, point in points])
+            else:
+                saved = Rules.retrieve_instance().post_batch(
+                    [point for _, point in points], team
+                )
+            for (index, _), ok in zip(points, saved):
+                if not ok:
+                    statuses[index] = 500
+                elif config.ASYNC_INGESTION:
+                    statuses[index] = 202
+        return {"results": [{"status": status} for status in statuses]}, 200
+
+
 class Email(Resource):
     """A POST-only resource for datapoints"""
 
-    decorators = [check_secret_header, auth.login_required]
+    decorators = [rate_limited("email"), check_secret_header, auth.login_required]
 
     def post(self):
         logging.debug(f"Email send req from {auth.username()}")
-        team = Team.find_by_name(auth.username())
+        team = Team.find_by_id(
+            current_team().id, fields=["name", "emails_sent", "_members"]
+        )
         logging.info(f"Email submission from: {team.name}")
         # Get DataClass and cast the value:
-        data_str = request.get_json()
+        data_str = request_data()
         subject = data_str["subject"]
         message = data_str["message"]
         logging.debug(f"Subject: {subject}")
@@ -110,11 +197,11 @@ class Email(Resource):
 class Status(Resource):
     """A resource with some basic info"""
 
-    decorators = [check_secret_header, auth.login_required]
+    decorators = [rate_limited("poll"), check_secret_header, auth.login_required]
 
     def get(self):
         logging.debug(f"Status get req de {auth.username()}")
-        team = Team.find_by_name(auth.username())
+        team = Team.find_by_id(current_team().id, fields=["name", "health"])
         logging.info(f"Status req de {team.name}")
         return {
             "datetime": datetime.now().isoformat(),
@@ -125,18 +212,52 @@ class Status(Resource):
         }, 200
 
 
+@lru_cache(maxsize=32)
+def _zlib_compressed(code: bytes) -> bytes:
+    """Compresses a code update (cached, since the same code is sent to a
+    cube again and again)"""
+    return zlib.compress(code, 9)
+
+
 class CodeUpdate(Resource):
     """A resource for teams to update code.py on their circuitpython cubes"""
 
-    decorators = [check_secret_header, auth.login_required]
+    decorators = [rate_limited("poll"), check_secret_header, auth.login_required]
 
     def get(self):
-        team = Team.find_by_name(auth.username())
+        """Sends the team's latest code, or 304 if the ETag (a hash of the
+        code) given in If-None-Match shows that the cube already has it
+        Specify ?compression=zlib to have the code compressed (before any
+        base64 encoding)."""
+        compression = request.args.get("compression")
+        if compression not in (None, "zlib"):
+            return {"message": f"Unsupported compression: {compression}"}, 400
+        team = Team.find_by_id(
+            current_team().id, fields=["name", "code_update_taken", "_code_update"]
+        )
         logging.info(f"Code update req de {team.name}")
-        return {
-            "datetime": datetime.now().isoformat(),
-            "unix_time": int(time()),
-            "encoding": "base64",
-            "new": not team.code_update_taken,
-            "code": encodebytes(team.get_code_update()).decode("utf-8"),
-        }, 200
+        code, new = team.poll_code_update()
+        binary = wants_binary()  # (MessagePack can carry the bytes as they are)
+        etag = "-".join(
+            [Team.code_update_etag(code), "binary" if binary else "base64"]
+            + ([compression] if compression else [])
+        )
+        headers = {"ETag": f'"{etag}"'}
+        if etag in request.if_none_match:
+            return None, 304, headers
+        if compression:
+            code = _zlib_compressed(code)
+        if not binary:
+            code = encodebytes(code).decode("utf-8")
+        return (
+            {
+                "datetime": datetime.now().isoformat(),
+                "unix_time": int(time()),
+                "encoding": "binary" if binary else "base64",
+                "compression": compression,
+                "new": new,
+                "code": code,
+            },
+            200,
+            headers,
+        )
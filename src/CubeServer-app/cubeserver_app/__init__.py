@@ -9,6 +9,7 @@ from flask import Flask
 from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
 from flask_apscheduler import APScheduler
+from werkzeug.local import LocalProxy
 
 from cubeserver_common import config, init_logging, configure_db
 from cubeserver_common.models import PyMongoModel
@@ -54,26 +55,12 @@ else:
     from cubeserver_common.models.user import clear_bad_attempts
     from cubeserver_common.models.config.conf import Conf
 
-    def _update_conf(app):
-        """An update job scheduled to run every 30 seconds
-        This retrieves the latest configuration to ensure that any changes
-        are synced between server threads."""
-        logging.debug("Updating configuration variables from db")
-        app.config["CONFIGURABLE"] = Conf.retrieve_instance()
-
     if False:
         logging.debug("Initializing APScheduler")
         scheduler = APScheduler()
         # Make APScheduler a little quieter:
         logging.getLogger("apscheduler.executors.default").setLevel(LOGGING_LEVEL + 10)
 
-        scheduler.add_job(
-            func=_update_conf,
-            args=[app],
-            trigger="interval",
-            id="configsync",
-            seconds=30,
-        )
         scheduler.add_job(
             func=clear_bad_attempts,
             trigger="interval",
@@ -83,7 +70,10 @@ else:
         scheduler.start()
         logging.debug("Starting scheduler")
 
-    _update_conf(app)
+    # Keep the configuration in sync between server processes:
+    logging.debug("Watching for configuration changes")
+    Conf.watch()
+    app.config["CONFIGURABLE"] = LocalProxy(Conf.retrieve_instance)
 
     # Load SECRET_KEY:
     # Double-check that the secret_file is actually there...
@@ -19,7 +19,6 @@ from flask import (
     render_template,
     request,
     url_for,
-    current_app,
     flash,
     session,
     send_file,
@@ -54,6 +53,7 @@ from cubeserver_common.models.multiplier import (
     VolumeUnit,
 )
 from cubeserver_common.models.mail import Message
+from cubeserver_common.models.rescoring import RescoreRun
 from cubeserver_common.models.beaconmessage import (
     BeaconMessage,
     BeaconMessageEncoding,
@@ -102,7 +102,9 @@ def admin_home():
     if current_user.level != UserLevel.ADMIN:
         return abort(403)
     # Fetch teams from database and populate a table:
-    teams_table = AdminTeamTable(Team.find())
+    teams_table = AdminTeamTable(
+        Team.find(fields=AdminTeamTable.model_fields, lazy=True)
+    )
 
     # Populate configuration form:
     conf_form = ConfigurationForm()
@@ -123,7 +125,7 @@ def admin_home():
     # Reserved / internal team handling:
     reserved_links = []
     for name in Team.RESERVED_NAMES:
-        team = Team.find_by_name(name)
+        team = Team.find_by_name(name, fields=["name"])
         if team is not None:
             reserved_links += [
                 (
@@ -166,7 +168,9 @@ def admin_home():
                 ",  ".join(
                     [
                         ", ".join(team.emails)
-                        for team in Team.find_by_division(TeamLevel.JUNIOR_VARSITY)
+                        for team in Team.find_by_division(
+                            TeamLevel.JUNIOR_VARSITY, fields=["_members"]
+                        )
                     ]
                 ).encode()
             ),
@@ -174,12 +178,16 @@ def admin_home():
                 ",  ".join(
                     [
                         ", ".join(team.emails)
-                        for team in Team.find_by_division(TeamLevel.VARSITY)
+                        for team in Team.find_by_division(
+                            TeamLevel.VARSITY, fields=["_members"]
+                        )
                     ]
                 ).encode()
             ),
             "All Teams": base64.urlsafe_b64encode(
-                ",  ".join([", ".join(team.emails) for team in Team.find()]).encode()
+                ",  ".join(
+                    [", ".join(team.emails) for team in Team.find(fields=["_members"])]
+                ).encode()
             ),
         }.items(),
         beacon_stats=beacon_status,
@@ -210,6 +218,7 @@ def beacon_csv():
         reopened = open(file_path, "r")
         try:
             csv_reader = csv.DictReader(reopened)
+            messages: List[BeaconMessage] = []
             for row in csv_reader:
                 if (
                     row["time"] == ""
@@ -220,15 +229,25 @@ def beacon_csv():
                     or row["intensity"] == ""
                 ):
                     continue
-                BeaconMessage(
-                    instant=datetime.fromisoformat(row["time"]),
-                    division=TeamLevel(row["division"]),
-                    message=row["body"],
-                    destination=OutputDestination(row["output"]),
-                    encoding=BeaconMessageEncoding(row["encoding"]),
-                    misfire_grace=int(row["misfire grace time"]),
-                    intensity=int(row["intensity"]),
-                ).save()
+                messages.append(
+                    BeaconMessage(
+                        instant=datetime.fromisoformat(row["time"]),
+                        division=TeamLevel(row["division"]),
+                        message=row["body"],
+                        destination=OutputDestination(row["output"]),
+                        encoding=BeaconMessageEncoding(row["encoding"]),
+                        misfire_grace=int(row["misfire grace time"]),
+                        intensity=int(row["intensity"]),
+                    )
+                )
+            failures = BeaconMessage.save_many(messages)
+            for _, error in failures:
+                logging.error(f"Failed to save a beacon message: {error}")
+            if failures:
+                flash(
+                    f"{len(failures)} of {len(messages)} messages could not be saved.",
+                    category="danger",
+                )
         except:
             flash("There was a problem processing your CSV")
             tb = traceback.format_exc()
@@ -325,7 +344,7 @@ def table_endpoint(table, identifier, field):
             )
     if request.method == "POST":
         if field == "score_increment" and model_class == Team:
-            cast(Team, model_obj).health.change(float(request.form.get("item")))
+            cast(Team, model_obj).change_score(float(request.form.get("item")))
         elif field == "score_recomputation" and model_class == Team:
             cast(Team, model_obj).recompute_score()
             return render_template("redirect_back.html.jinja2")
@@ -336,7 +355,6 @@ def table_endpoint(table, identifier, field):
             if (
                 field == "rawscore" and model_class == DataPoint
             ):  # Manually setting dp point value
-                team = Team.find_by_id(cast(DataPoint, model_obj).team_reference)
                 init_rawscore = cast(DataPoint, model_obj).rawscore
 
             # Change that Make!
@@ -345,11 +363,11 @@ def table_endpoint(table, identifier, field):
             if (
                 field == "rawscore" and model_class == DataPoint
             ):  # Manually setting dp point value
-                team.health.change(
+                Team.adjust_score(
+                    cast(DataPoint, model_obj).team_reference,
                     cast(DataPoint, model_obj).multiplier
-                    * (cast(DataPoint, model_obj).rawscore - init_rawscore)
+                    * (cast(DataPoint, model_obj).rawscore - init_rawscore),
                 )
-                team.save()
         model_obj.save()
         return render_template("redirect_back.html.jinja2")
     elif request.method == "DELETE":
@@ -358,6 +376,28 @@ def table_endpoint(table, identifier, field):
         # Note that as of now the response text is ignored anyway
 
 
+@bp.route("/rescore", methods=["GET", "POST"])
+@login_required
+def rescore_all():
+    """Starts rescoring every team in the background (POST), and reports on
+    how the latest rescore is going"""
+    if current_user.level != UserLevel.ADMIN:
+        return abort(403)
+    if request.method == "POST" and RescoreRun.start() is None:
+        return {"message": "The competition is already being rescored"}, 409
+    run = RescoreRun.latest()
+    if run is None:
+        return {"running": False, "finished": False}
+    return {
+        "running": run.running,
+        "finished": run.finished != datetime.min,
+        "done": run.done,
+        "teams": run.teams,
+        "mismatched": run.mismatched,
+        "error": run.error,
+    }
+
+
 @bp.route("/useradd", methods=["POST"])
 @login_required
 def useradd():
@@ -392,7 +432,7 @@ def conf_change():
     form = ConfigurationForm()
     if form.validate_on_submit():
         # Update database from form:
-        db_conf: Conf = Conf.retrieve_instance()
+        db_conf: Conf = Conf.find_one()  # (a copy of our own to edit)
         db_conf.competition_on = form.competition_on.data
         db_conf.registration_open = form.registration_open.data
         db_conf.home_description = form.home_description.data
@@ -409,7 +449,6 @@ def conf_change():
             db_conf.smtp_user = credentials[0]
             db_conf.smtp_pass = credentials[1]
         db_conf.save()
-        current_app.config["CONFIGURABLE"] = db_conf
         return render_template("redirect_back.html.jinja2")
     return abort(500)
 
@@ -641,7 +680,7 @@ def beacon_table():
     # Check admin status:
     if current_user.level != UserLevel.ADMIN:
         return abort(403)
-    table = BeaconMessageTable(BeaconMessage.find())
+    table = BeaconMessageTable(BeaconMessage.iter_find())
 
     beacon_form = ImmediateBeaconForm()
     beacon_form.instant.data = datetime.now()
@@ -708,7 +747,7 @@ def database_repair(mode="", collection_name="", query="{}"):
     good_doc = collection()
 
     # Load up anything that matches the query
-    all_docs = collection.find(loads(query))
+    all_docs = collection.iter_find(loads(query))
 
     broken: List[BrokenDocId] = []
     # Iterate through and figure out which ones are broken
@@ -756,7 +795,7 @@ def gen_reserved(name: str = ""):
     if name == "":
         flash("No team specified")
         return abort(500)
-    if Team.find_by_name(name) is not None:
+    if Team.find_by_name(name, fields=["name"]) is not None:
         flash(f"Please delete `{name}` before regenerating.")
         return render_template("redirect_back.html.jinja2")
 
@@ -52,18 +52,22 @@ def leaderboard(sel_div: str = ""):
     team_objects = [
         team
         for team in Team.find(
-            {
-                "status": {
-                    "$nin": [TeamStatus.UNAPPROVED.value, TeamStatus.INTERNAL.value]
+            (
+                {
+                    "status": {
+                        "$nin": [TeamStatus.UNAPPROVED.value, TeamStatus.INTERNAL.value]
+                    }
                 }
-            }
-            if selected_division is None
-            else {
-                "status": {
-                    "$nin": [TeamStatus.UNAPPROVED.value, TeamStatus.INTERNAL.value]
-                },
-                "weight_class": selected_division.value,
-            }
+                if selected_division is None
+                else {
+                    "status": {
+                        "$nin": [TeamStatus.UNAPPROVED.value, TeamStatus.INTERNAL.value]
+                    },
+                    "weight_class": selected_division.value,
+                }
+            ),
+            fields=LeaderboardTeamTable.model_fields,
+            lazy=True,
         )
     ]
     teams_table = LeaderboardTeamTable(team_objects)
@@ -5,9 +5,21 @@ from bson.objectid import ObjectId
 
 
 def register_commands(app):
+    from cubeserver_common import config
     from cubeserver_common.models.config.rules import RegularOccurrence, Rules
-    from cubeserver_common.models.datapoint import DataPoint, DataClass
+    from cubeserver_common.models.datapoint import (
+        DataPoint,
+        DataClass,
+        migrate_scoring_keys,
+        window_key,
+    )
+    from cubeserver_common.models.rescoring import check_scores, rescore_competition
     from cubeserver_common.models.team import Team, TeamLevel
+    from cubeserver_common.models.utils import (
+        all_models,
+        index_report,
+        migrate_to_flat,
+    )
 
     @app.cli.command("more-stuff")
     def more_stuff():
@@ -15,7 +27,7 @@ def register_commands(app):
             {
                 "team_reference": ObjectId("655b83885c957af8e85632d3"),
                 "category": "temperature",
-                "scoring_key": "2023-11-20 22:57:00->2023-11-20 23:03:00",
+                "scoring_key": window_key(datetime(2023, 11, 20, 22, 57)),
             }
         )
         existing_datapoint2 = DataPoint.find_one(
@@ -69,3 +81,66 @@ def register_commands(app):
                 print("!!", i, "--".join([str(x) for x in result]))
             else:
                 print("!!", i, result)
+
+    @app.cli.command("index-report")
+    def report_indexes():
+        """Lists the indexes that are missing, undeclared, or unused"""
+        all_good = True
+        for model in all_models():
+            report = index_report(model)
+            for problem, names in report.items():
+                for name in names:
+                    all_good = False
+                    click.echo(f"{model.__name__}: {problem} index {name}")
+        if all_good:
+            click.echo("All declared indexes are present and in use.")
+
+    @app.cli.command("migrate-storage")
+    @click.argument("model_name")
+    @click.option("--batch-size", default=500, help="Documents per batch")
+    @click.option("--pause", default=0.1, help="Seconds to wait between batches")
+    def migrate_storage(model_name, batch_size, pause):
+        """Converts a model's collection to the flat storage layout
+        This is safe to run while the servers are up."""
+        models = {model.__name__: model for model in all_models()}
+        if model_name not in models:
+            raise click.BadParameter(f"No such model: {model_name}")
+        converted = migrate_to_flat(models[model_name], batch_size, pause)
+        click.echo(f"Converted {converted} documents.")
+
+    @app.cli.command("migrate-scoring-keys")
+    @click.option("--batch-size", default=500, help="Documents per batch")
+    @click.option("--pause", default=0.1, help="Seconds to wait between batches")
+    def migrate_keys(batch_size, pause):
+        """Converts the scoring keys stored as strings to window keys
+        This is safe to run while the servers are up."""
+        converted = migrate_scoring_keys(batch_size, pause)
+        click.echo(f"Converted {converted} scoring keys.")
+
+    @app.cli.command("rescore")
+    @click.option(
+        "--workers",
+        type=int,
+        default=config.RESCORE_WORKERS,
+        help="Processes to use (one per core by default)",
+    )
+    @click.option(
+        "--shard-size",
+        default=config.RESCORE_SHARD_SIZE,
+        help="Teams per process at a time",
+    )
+    def rescore(workers, shard_size):
+        """Rescores every team under the current rules, then checks that each
+        team's score is the sum of its data's scores"""
+        progress = rescore_competition(workers, shard_size)
+        _, teams = next(progress)
+        with click.progressbar(length=teams, label="Rescoring teams") as bar:
+            for done, _ in progress:
+                bar.update(done - bar.pos)
+        mismatched = check_scores()
+        for team_id, (score, total) in mismatched.items():
+            name = Team.find_by_id(team_id, fields=["name"]).name
+            click.echo(f"{name}: score {score} is not the sum of its data, {total}")
+        if mismatched:
+            raise click.ClickException(f"{len(mismatched)} team(s) do not add up.")
+        click.echo(f"Rescored {teams} teams; every score adds up.")
@@ -13,15 +13,25 @@ document.addEventListener("DOMContentLoaded", function(event) {
     localStorage.removeItem('scrollpos');
 });
 
-// API Functions
-function deleteItem(item, id) {
+// Asks twice before doing something that cannot be undone
+// (and says so if it was canceled):
+function confirmPermanent(confirmationMessage) {
     // TODO: Replace confirm() and alert() with a nice-looking Bootstrap modal
-    var confirmationMessage = `Are you certain you wish to DELETE object #${id} FOREVER?\n
-This action is PERMANANT and CANNOT BE UNDONE!`;
-//var comment = prompt("Please comment on this change.");  // TODO: Add comment in case of deleted objects also
     var secondConfirmationMessage = `FINAL CHANCE-- There's no going back after this!\n
 Are you ABSOLUTELY CERTAIN?`;
-    if (confirm(confirmationMessage) && confirm(secondConfirmationMessage)) {
+    if (confirm(`${confirmationMessage}\n
+This action is PERMANENT and CANNOT BE UNDONE!`) && confirm(secondConfirmationMessage)) {
+        return true;
+    }
+    alert("Action Canceled.");
+    return false;
+}
+
+// API Functions
+function deleteItem(item, id) {
+    var confirmationMessage = `Are you certain you wish to DELETE object #${id} FOREVER?`;
+//var comment = prompt("Please comment on this change.");  // TODO: Add comment in case of deleted objects also
+    if (confirmPermanent(confirmationMessage)) {
         $.ajax({  // TODO: Generate these URLs better so stuff is less likely to break:
             url: `/admin/table_endpoint/${item}/${id}/*`,
             type: 'DELETE',
@@ -36,21 +46,15 @@ Are you ABSOLUTELY CERTAIN?`;
                 location.reload();
             }
         });
-    } else {
-        alert("Action Canceled.");
     }
 }
 
 function recompute_score(item, id) {
-    // TODO: Replace confirm() and alert() with a nice-looking Bootstrap modal
     var confirmationMessage = `Are you certain you wish to RECOMPUTE object #${id}'s score?\n
 All/the datapoint(s) will be re-evaluated under the current scoring rules and multiplier.\n
-All manual score increments on this object will be lost.\n
-This action is PERMANANT and CANNOT BE UNDONE!`
+All manual score increments on this object will be lost.`
 //var comment = prompt("Please comment on this change.");  // TODO: Add comment in case of deleted objects also
-    var secondConfirmationMessage = `FINAL CHANCE-- There's no going back after this!\n
-Are you ABSOLUTELY CERTAIN?`;
-    if (confirm(confirmationMessage) && confirm(secondConfirmationMessage)) {
+    if (confirmPermanent(confirmationMessage)) {
         $.ajax({  // TODO: Generate these URLs better so stuff is less likely to break:
             url: `/admin/table_endpoint/${item}/${id}/score_recomputation`,
             type: 'POST',
@@ -65,11 +69,50 @@ Are you ABSOLUTELY CERTAIN?`;
                 location.reload();
             }
         });
-    } else {
-        alert("Action Canceled.");
     }
 }
 
+function rescoreAll() {
+    var confirmationMessage = `Are you certain you wish to RECOMPUTE EVERY TEAM's score?\n
+All datapoints will be re-evaluated under the current scoring rules and multipliers.\n
+All manual score increments will be lost.`
+    if (confirmPermanent(confirmationMessage)) {
+        $.ajax({
+            url: `/admin/rescore`,
+            type: 'POST',
+            success: function(result) {
+                watchRescore();
+            },
+            error: function(result) {
+                alert("Could not start rescoring:\n" + (result.responseJSON || {}).message);
+            }
+        });
+    }
+}
+
+// Shows how the latest rescore of all teams is going, until it is done:
+function watchRescore(reload) {
+    $.get("/admin/rescore", function(run) {
+        var progress = $("#rescore_progress");
+        if (run.running) {
+            progress.text(`Rescoring... ${run.done} of ${run.teams} teams done`);
+            setTimeout(function() { watchRescore(true); }, 1000);
+        } else if (run.finished && reload) {
+            if (run.error) {
+                alert(`Rescoring failed:\n${run.error}`);
+            } else if (run.mismatched.length) {
+                alert(`Rescored ${run.teams} teams, but these scores do not add up:\n${run.mismatched.join("\n")}`);
+            } else {
+                alert(`Rescored ${run.teams} teams; every score adds up.`);
+            }
+            localStorage.setItem('scrollpos', window.scrollY);
+            location.reload();
+        } else if (run.finished && (run.error || run.mismatched.length)) {
+            progress.text(run.error ? "The last rescore failed." : `Scores that did not add up after the last rescore: ${run.mismatched.join(", ")}`);
+        }
+    });
+}
+
 function adjustScore(item, id) {
     // TODO: Replace confirm() and alert() with a nice-looking Bootstrap modal
     var promptMessage = "Enter the value to offset this score by.\n(A negative number indicates a penalty)\n";
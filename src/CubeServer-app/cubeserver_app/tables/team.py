@@ -27,6 +27,17 @@ class AdminTeamTable(Table):
     thead_classes = ["thead-dark"]
     border = True
 
+    model_fields = [
+        "name",
+        "weight_class",
+        "status",
+        "_members",
+        "health",
+        "secret",
+        "emails_sent",
+    ]
+    """The Team fields needed to render this table"""
+
     name_secondary = AdminTeamNameCol("Team Name")
     # _id             = Col('Identifier')
     weight_class = DropDownEnumCol(
@@ -77,6 +88,9 @@ class LeaderboardTeamTable(Table):
     thead_classes = ["thead-dark"]
     border = True
 
+    model_fields = ["name", "health", "_members", "weight_class", "status"]
+    """The Team fields needed to render this table"""
+
     name = TeamNameCol("Team Name")
     score = FloatCol("Score")
     score_delta = ScoreDeltaCol("Score Delta")
@@ -40,5 +40,9 @@ def parse_query(cls, cols, args, filter=None):
 
     count = cls.count_documents(filter or {})
     return count, cls.find(
-        filter=filter, skip=int(args.get("start", 0)), limit=limit, sort=sort
+        filter=filter,
+        skip=int(args.get("start", 0)),
+        limit=limit,
+        sort=sort,
+        lazy=True,
     )
@@ -1,6 +1,7 @@
 """Classes common to both the API and the app"""
 
 import os
+from importlib import import_module
 from flask_pymongo import PyMongo
 from pymongo import MongoClient
 from cubeserver_common.models import PyMongoModel
@@ -16,8 +17,10 @@ def init_logging():
     )
 
 
-def configure_db(app=None):
-    """Configures the database"""
+def configure_db(app=None, worker: bool = False):
+    """Configures the database
+    Set worker for helper processes (e.g. a rescoring pool), which leave
+    setting the database up (default settings and indexes) to the servers."""
     # Configure MongoDB:
 
     driver = os.environ.get("MONGODB_DRIVER", "mongodb")
@@ -46,7 +49,9 @@ def configure_db(app=None):
         mongo = PyMongo(uri=uri)
         mongo.cx = MongoClient(uri)
         mongo.db = mongo.cx[os.environ["MONGODB_DATABASE"]]
-    PyMongoModel.update_mongo_client(mongo)
+    PyMongoModel.update_mongo_client(mongo)  # (binds models imported already)
+    if worker:
+        return
     # Don't let the model classes load until after the db is init'd:
     from cubeserver_common.models.config.conf import Conf
     from cubeserver_common.models.config.rules import Rules
@@ -57,3 +62,12 @@ def configure_db(app=None):
     if Conf.retrieve_instance() is None:
         default_confset = Conf()
         default_confset.save()
+
+    # Build any declared indexes that are missing (every model must be
+    # imported by now so that its declarations are seen; these modules are
+    # imported only for that, since nothing else here uses them):
+    for module in ("beaconmessage", "ingestqueue", "rescoring"):
+        import_module(f"cubeserver_common.models.{module}")
+    from cubeserver_common.models.utils import reconcile_all_indexes
+
+    reconcile_all_indexes()
@@ -10,6 +10,7 @@ required to implement changes from this file.
 """
 
 import logging
+from typing import Optional
 
 ############################
 # Configuration variables: #
@@ -109,6 +110,12 @@ INTERNAL_SECRET_LENGTH: int = 32
 TEAM_MAX_UPDATE_LENGTH: int = 32768  # 32KiB
 """Maximum length of a team's code update"""
 
+DATA_BATCH_MAX_SIZE: int = 100
+"""Maximum number of readings a team can post at once to /data/batch"""
+
+DATA_BATCH_MAX_AGE: int = 24 * 60 * 60
+"""How old (in seconds) a buffered reading posted to /data/batch can be"""
+
 
 # Internal Teams (for extending api functionality for behind-the-scenes use):
 
@@ -162,6 +169,83 @@ This *MUST* be present in hashlib.algorithms_available or things will break!"""
 TEMP_PATH: str = "/tmp/"
 """A path to a temporary directory that will not be persistent"""
 
+SETTINGS_REFRESH: float = 2.0
+"""How often (in seconds) each worker checks that its cached copies of the
+game rules and configuration are current; changes made by an admin reach
+every worker within this delay"""
+
+TEAM_AUTH_CACHE_TTL: float = 5.0
+"""How long (in seconds) the api remembers a team's credentials and status;
+changes made by an admin elsewhere take up to this long to take effect"""
+
+TEAM_AUTH_CACHE_SIZE: int = 256
+"""How many teams' credentials each api worker remembers at most"""
+
+RATE_LIMIT_BACKEND: Optional[str] = "memory"
+"""Where the api keeps each team's rate limit: "memory" (each process limits
+teams on its own, so a team may make that many requests of each), "mongo"
+(shared by every api server process, at the cost of a write per request),
+or None to not rate limit teams at all"""
+
+RATE_LIMIT_SLACK: float = 10.0
+"""How many times as many requests as its division's windows call for a
+team may make (see Rules.rate_limit)"""
+
+RATE_LIMIT_MIN_PER_HOUR: int = 60
+"""The fewest requests per hour a team is ever limited to"""
+
+RATE_LIMIT_MIN_BURST: int = 10
+"""The fewest requests a team is ever limited to making at once"""
+
+API_MAX_CONCURRENT_REQUESTS: int = 16
+"""How many requests each api server process handles at a time; any more
+are turned away (429) until it catches up"""
+
+API_OVERLOAD_RETRY_AFTER: int = 2
+"""How long (in seconds) clients turned away because the api is busy are
+told to wait"""
+
+ASYNC_INGESTION: bool = False
+"""Whether the api just queues the data that teams post, for the scoring
+worker (python -m cubeserver_common.scorer) to score, rather than scoring it
+while the team waits; the scoring worker must be running if this is on"""
+
+INGEST_BATCH_SIZE: int = 200
+"""How many queued datapoints the scoring worker takes at once"""
+
+INGEST_POLL_INTERVAL: float = 0.5
+"""How long (in seconds) the scoring worker waits when the queue is empty"""
+
+INGEST_CLAIM_TIMEOUT: int = 60
+"""How long (in seconds) queued data taken by a scoring worker that died
+waits to be taken by another"""
+
+REFERENCE_TIMELINE_SIZE: int = 10000
+"""How many of the latest reference datapoints of each category are kept in
+memory for scoring (see models.datapoint.ReferenceTimeline)"""
+
+REFERENCE_TIMELINE_SYNC_INTERVAL: float = 1.0
+"""How often (in seconds) reference datapoints saved by other processes are
+fetched for scoring"""
+
+REFERENCE_TIMELINE_SYNC_LAG: float = 5.0
+"""How long (in seconds) a reference datapoint may take to be saved after its
+moment and still be fetched for scoring by other processes"""
+
+REFERENCE_TIMELINE_REBUILD_INTERVAL: float = 60.0
+"""How often (in seconds) the reference datapoints kept for scoring are all
+fetched again, to catch up with any that other processes edited or removed"""
+
+RESCORE_WORKERS: Optional[int] = None
+"""How many processes rescore the competition at once (None for one per core)"""
+
+RESCORE_SHARD_SIZE: int = 10
+"""How many teams each of those processes rescores at a time"""
+
+RESCORE_STALE_AFTER: int = 600
+"""How long (in seconds) a rescore started from the admin panel may go without
+progress before it is taken to have died (and another may be started)"""
+
 
 ########################
 #      Generated       #
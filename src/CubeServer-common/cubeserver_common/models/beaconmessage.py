@@ -8,6 +8,7 @@ from datetime import datetime, timedelta
 from pprint import pformat
 
 from .utils.modelutils import PyMongoModel
+from .utils.indexes import ModelIndex
 from .team import TeamLevel
 
 from cubeserver_common._version import __version__ as VERSION
@@ -94,6 +95,22 @@ class BeaconMessage(PyMongoModel):
     The protocol used is modeled after HTTP server responses.
     """
 
+    indexes = [
+        ModelIndex("status", "send_at"),
+        ModelIndex("send_at"),
+    ]
+
+    send_at: datetime
+    division: TeamLevel
+    message_encoding: Optional[BeaconMessageEncoding]
+    additional_headers: Mapping[str, str]
+    destination: OutputDestination
+    intensity: int
+    past: bool
+    misfire_grace: int
+    full_message_bytes_stored: bytes
+    status: SentStatus
+
     def __init__(
         self,
         instant: datetime = datetime.now(),
@@ -120,11 +137,6 @@ class BeaconMessage(PyMongoModel):
 
         super().__init__()
 
-        self.ignore_attribute("message")
-        self.ignore_attribute("prefix")
-        self.ignore_attribute("suffix")
-        self.ignore_attribute("line_term")
-
         self.send_at = instant
         self.division = division
 
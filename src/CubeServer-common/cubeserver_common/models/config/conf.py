@@ -2,14 +2,21 @@
 
 See app.models.config.rules for information regarding the rules of the game"""
 
+import logging
+import os
+from threading import Thread
+from time import monotonic, sleep
 from typing import Optional
 
+from pymongo.errors import ConnectionFailure, PyMongoError
+
 # TODO: Just import config and use the package name throughout
 from cubeserver_common.config import (
     DEFAULT_HOME_DESCRIPTION,
     DEFAULT_REG_CONFIRMATION,
     DEFAULT_EMAIL_QUOTA,
     DEFAULT_BEACON_POLLING_PERIOD,
+    SETTINGS_REFRESH,
 )
 from cubeserver_common.models import PyMongoModel
 
@@ -22,6 +29,25 @@ class Conf(PyMongoModel):
     There will be a separate Rules object for JV and Varsity teams
     """
 
+    notify_teams: bool
+    registration_open: bool
+    home_description: str
+    reg_confirmation: str
+    email_domain: str
+    smtp_server: str
+    smtp_user: Optional[str]
+    smtp_pass: Optional[str]
+    team_email_quota: int
+    quota_reset_hour: int
+    banner_message: str
+    beacon_polling_period: int
+    competition_on: bool
+
+    # The config as last fetched: (time fetched, config)
+    _cached = None
+    # The thread keeping the cache fresh: (process id, token)
+    _watcher = None
+
     def __init__(
         self,
         registration_open: bool = False,
@@ -56,5 +82,80 @@ class Conf(PyMongoModel):
     # The initial instance is created in cubeserver_common/__init__.py
     @staticmethod
     def retrieve_instance() -> PyMongoModel:
-        """Retrieves the current config"""
-        return Conf.find_one()
+        """Retrieves the current config
+        This comes from an in-process cache, which is kept fresh by a
+        background thread once watch() has been called (and is otherwise
+        fetched again after SETTINGS_REFRESH seconds).
+        The config returned is shared, so please treat it as read-only;
+        use Conf.find_one() for a copy to edit."""
+        watcher = Conf._watcher
+        if watcher is not None and watcher[0] != os.getpid():
+            Conf.watch()  # This is a freshly forked worker
+        cached = Conf._cached
+        if cached is None or (
+            watcher is None and monotonic() - cached[0] >= SETTINGS_REFRESH
+        ):
+            return Conf.refresh()
+        return cached[1]
+
+    @staticmethod
+    def refresh() -> Optional["Conf"]:
+        """Fetches the current config into this worker's cache"""
+        conf = Conf.find_one()
+        Conf._cached = None if conf is None else (monotonic(), conf)
+        return conf
+
+    @staticmethod
+    def invalidate():
+        """Drops this worker's cached config, so it is fetched again"""
+        Conf._cached = None
+
+    def save(self):
+        """Saves the config (other workers pick up the change on their own)"""
+        super().save()
+        Conf.invalidate()
+
+    @staticmethod
+    def watch():
+        """Starts a background thread that keeps this worker's cached config
+        fresh by following a change stream on the collection, or by polling
+        every SETTINGS_REFRESH seconds where change streams are unavailable
+        (i.e. a standalone mongod)"""
+        token = object()
+        Conf._watcher = (os.getpid(), token)
+        Thread(
+            target=Conf._follow_changes, args=(token,), name="conf-watch", daemon=True
+        ).start()
+
+    @staticmethod
+    def unwatch():
+        """Stops the thread started by watch()"""
+        Conf._watcher = None
+
+    @staticmethod
+    def _watching(token: object) -> bool:
+        """Whether the thread with the given token should keep going"""
+        return Conf._watcher is not None and Conf._watcher[1] is token
+
+    @staticmethod
+    def _follow_changes(token: object):
+        """Keeps the cache fresh until unwatch() or watch() is called"""
+        while Conf._watching(token):
+            try:
+                Conf.refresh()
+                with Conf.collection.watch(max_await_time_ms=1000) as stream:
+                    while Conf._watching(token) and stream.alive:
+                        if stream.try_next() is not None:
+                            Conf.refresh()
+            except ConnectionFailure as e:
+                logging.warning(f"Lost the config change stream: {e}")
+                sleep(SETTINGS_REFRESH)
+            except Exception as e:  # e.g. a standalone mongod
+                logging.info(f"Polling for config changes (no change stream: {e})")
+                break
+        while Conf._watching(token):
+            sleep(SETTINGS_REFRESH)
+            try:
+                Conf.refresh()
+            except PyMongoError as e:
+                logging.warning(f"Could not refresh the config: {e}")
@@ -3,15 +3,31 @@
 See app.models.team for more information regarding the game aspect"""
 
 import logging
-from typing import Optional, Mapping, List
+from array import array
+from types import MappingProxyType
+from typing import NamedTuple, Optional, Mapping, List, Tuple
 from datetime import datetime, timedelta
+from time import monotonic
 import json
 from bson import ObjectId
-
-from cubeserver_common.config import COMMENT_FILTER_PROFANITY
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from cubeserver_common.config import (
+    COMMENT_FILTER_PROFANITY,
+    RATE_LIMIT_MIN_BURST,
+    RATE_LIMIT_MIN_PER_HOUR,
+    RATE_LIMIT_SLACK,
+    SETTINGS_REFRESH,
+)
 from cubeserver_common.models import PyMongoModel, Encodable
-from cubeserver_common.models.team import Team, TeamLevel
-from cubeserver_common.models.datapoint import DataPoint, DataClass
+from cubeserver_common.models.team import Team, TeamCredentials, TeamLevel
+from cubeserver_common.models.datapoint import (
+    DUPLICATE_KEY,
+    DataPoint,
+    DataClass,
+    window_key,
+)
 from cubeserver_common.models.utils import (
     ComplexDictCodec,
     EnumCodec,
@@ -77,6 +93,26 @@ class RegularOccurrence(Encodable):
 
         return None
 
+    def compile(self) -> "ScoringWindows":
+        """Works out once which window (if any) each second of the hour falls
+        into, just as get_match_window() does"""
+        starts = {}  # The start of each window -> its id
+        by_second = array("h", [NO_WINDOW]) * (60 * 60)
+        for second in range(60 * 60):
+            for offset in self.offsets:
+                if abs(second - offset) <= self.tolerance:
+                    start = offset - self.tolerance
+                    break
+                if abs((second - 60 * 60) - offset) <= self.tolerance:
+                    start = 60 * 60 + offset - self.tolerance
+                    break
+            else:
+                continue
+            by_second[second] = starts.setdefault(start, len(starts))
+        return ScoringWindows(
+            by_second, tuple((start, start + 2 * self.tolerance) for start in starts)
+        )
+
     def encode(self) -> dict:
         """Encodes an Encodable object into a plain old, bson-able
         dictionary"""
@@ -88,6 +124,73 @@ class RegularOccurrence(Encodable):
         return cls(offsets=value["offsets"], tolerance=value["tolerance"])
 
 
+NO_WINDOW = -1
+"""The window id of the seconds of the hour that fall into no window"""
+
+
+class ScoringWindows(NamedTuple):
+    """A RegularOccurrence compiled for scoring (see RegularOccurrence.compile)"""
+
+    by_second: array  # The id of the window of each second of the hour
+    bounds: Tuple[Tuple[int, int], ...]  # Of each window, in seconds from the hour
+
+    def match(self, moment: datetime) -> Optional[Tuple[datetime, datetime]]:
+        """The window that a moment falls into, as get_match_window()"""
+        window = self.by_second[moment.minute * 60 + moment.second]
+        if window == NO_WINDOW:
+            return None
+        start, end = self.bounds[window]
+        hour = moment.replace(minute=0, second=0, microsecond=0)
+        return hour + timedelta(seconds=start), hour + timedelta(seconds=end)
+
+
+class ScoringEntry(NamedTuple):
+    """How one category of data is scored for one division"""
+
+    manual: bool  # Scored from its value alone (e.g. a signal light seen)
+    measured: bool  # Scored against the reference data, in windows
+    points: Optional[int]
+    tolerance: Optional[float]
+    windows: Optional[ScoringWindows]  # None if it is not scored
+
+    @property
+    def penalty(self) -> float:
+        """The score of data posted outside of the windows, or extra data"""
+        return -self.points if self.points is not None else 0.0
+
+
+class ScoringPlan:
+    """A ruleset compiled for scoring: a flat table of how each category of
+    data is scored for each division (see Rules.plan)"""
+
+    def __init__(self, rules: "Rules"):
+        self._entries = MappingProxyType(
+            {
+                (level, category): self._entry(rules, level, category)
+                for level in [*TeamLevel, None]
+                for category in DataClass
+            }
+        )
+
+    @staticmethod
+    def _entry(
+        rules: "Rules", level: Optional[TeamLevel], category: DataClass
+    ) -> ScoringEntry:
+        occurrence = rules.times.get(level, {}).get(category)
+        return ScoringEntry(
+            manual=category in DataClass.manual and category in DataClass.measurable,
+            measured=category in DataClass.measurable
+            and category not in DataClass.manual,
+            points=rules.point_menu.get(level, {}).get(category),
+            tolerance=rules.accuracy_tolerance.get(level, {}).get(category),
+            windows=None if occurrence is None else occurrence.compile(),
+        )
+
+    def __getitem__(self, key: Tuple[Optional[TeamLevel], DataClass]) -> ScoringEntry:
+        """The entry of a (division, category)"""
+        return self._entries[key]
+
+
 class Rules(PyMongoModel):
     """Defines the exact rules for a game.
 
@@ -95,6 +198,33 @@ class Rules(PyMongoModel):
     All integer time values are in seconds unless otherwise noted.
     """
 
+    selected: bool
+    version: int
+    reference_window: int
+    point_menu: Mapping[TeamLevel, Mapping[DataClass, int]]
+    times: Mapping[TeamLevel, Mapping[DataClass, RegularOccurrence]]
+    accuracy_tolerance: Mapping[TeamLevel, Mapping[DataClass, float]]
+
+    # The selected ruleset as last fetched: (time checked, id, version, rules)
+    _selected = None
+
+    # TODO: Autogen recursive codec trees?
+    # Manually spell out how to deal with these fields:
+    field_codecs = {
+        "point_menu": ComplexDictCodec(
+            EnumCodec(TeamLevel),
+            ComplexDictCodec(EnumCodec(DataClass), DummyCodec(float)),
+        ),
+        "times": ComplexDictCodec(
+            EnumCodec(TeamLevel),
+            ComplexDictCodec(EnumCodec(DataClass), EncodableCodec(RegularOccurrence)),
+        ),
+        "accuracy_tolerance": ComplexDictCodec(
+            EnumCodec(TeamLevel),
+            ComplexDictCodec(EnumCodec(DataClass), DummyCodec(float)),
+        ),
+    }
+
     class JSONEncoder(json.JSONEncoder):
         def default(self, o):
             if isinstance(o, ObjectId):
@@ -149,148 +279,316 @@ class Rules(PyMongoModel):
         """
         super().__init__()
 
-        # TODO: Autogen recursive codec trees?
-        # primitive bson types so codecs are auto selected as DummyCodec:
-        self.selected: bool = selected
-        self.reference_window: int = reference_window
-        # Manually spell out how to deal with these fields:
-        super().register_field(
-            "point_menu",
-            value=point_menu,
-            custom_codec=ComplexDictCodec(
-                EnumCodec(TeamLevel),
-                ComplexDictCodec(EnumCodec(DataClass), DummyCodec(float)),
-            ),
-        )
-        super().register_field(
-            "times",
-            value=post_times,
-            custom_codec=ComplexDictCodec(
-                EnumCodec(TeamLevel),
-                ComplexDictCodec(
-                    EnumCodec(DataClass), EncodableCodec(RegularOccurrence)
-                ),
-            ),
-        )
-        super().register_field(
-            "accuracy_tolerance",
-            value=accuracy_tolerance,
-            custom_codec=ComplexDictCodec(
-                EnumCodec(TeamLevel),
-                ComplexDictCodec(EnumCodec(DataClass), DummyCodec(float)),
-            ),
-        )
+        self.selected = selected
+        self.version = 0  # Bumped by every save()
+        self.reference_window = reference_window
+        self.point_menu = point_menu
+        self.times = post_times
+        self.accuracy_tolerance = accuracy_tolerance
 
-    def post_data(self, datapoint: DataPoint, _force: bool = False) -> bool:
+    @property
+    def plan(self) -> ScoringPlan:
+        """This ruleset compiled for scoring (once, so please treat a ruleset
+        as read-only once it has scored data, until it is saved)"""
+        plan = self.__dict__.get("_plan")
+        if plan is None:
+            plan = self._plan = ScoringPlan(self)
+        return plan
+
+    def rate_limit(self, level: Optional[TeamLevel]) -> Tuple[float, float]:
+        """How often a team of a division may call the api, as a rate (in
+        requests per second) and a burst: RATE_LIMIT_SLACK times the posts
+        its windows call for, but never less than the configured minimums"""
+        times = self.times.get(level, {})
+        per_hour = sum(len(occurrence.offsets) for occurrence in times.values())
+        rate = max(per_hour * RATE_LIMIT_SLACK, RATE_LIMIT_MIN_PER_HOUR) / 3600
+        burst = max(len(times) * RATE_LIMIT_SLACK, RATE_LIMIT_MIN_BURST)
+        return rate, burst
+
+    def post_data(
+        self,
+        datapoint: DataPoint,
+        _force: bool = False,
+        team: Optional[TeamCredentials] = None,
+    ) -> bool:
         """This is executed whenever a team sends in some data
-        If this returns true, it sends an OK response to the client"""
+        If this returns true, it sends an OK response to the client
+        Pass the posting team's credentials if they are at hand (e.g. from
+        authenticating the request) to save looking the team up."""
 
         # Prevent double-dipping on points:
         if not _force and datapoint.rawscore > 0.0:
             raise ValueError("This datapoint has already been scored!")
 
-        team = Team.find_by_id(datapoint.team_reference)
+        if team is None:
+            team = TeamCredentials.of(
+                Team.find_by_id(datapoint.team_reference, fields=Team.CREDENTIAL_FIELDS)
+            )
+
+        self._assess(datapoint, team, force=_force)
+
+        # Log the data and score it, together where the database allows:
+        try:
+            self._log(datapoint, team)
+        except DuplicateKeyError:  # Another datapoint scored the window first
+            self._lose_window(datapoint, team)
+            self._log(datapoint, team)
+        if datapoint.is_reference:
+            DataPoint.remember_reference(datapoint)
+        return True
 
+    def post_batch(
+        self, datapoints: List[DataPoint], team: TeamCredentials
+    ) -> List[bool]:
+        """Scores and logs many datapoints posted at once by a team, just as
+        post_data() would one after another, but with all of them stored in
+        one bulk write and the team's score changed only once.
+        Returns whether each datapoint was saved."""
+        claimed = set()
+        missed = []
+        for datapoint in datapoints:
+            if datapoint.rawscore > 0.0:
+                raise ValueError("This datapoint has already been scored!")
+            self._assess(datapoint, team, claimed=claimed, missed=missed)
+        self._lose_held_windows(missed, team)
+
+        saved = set()
+        while True:
+            pending = [
+                datapoint for datapoint in datapoints if id(datapoint) not in saved
+            ]
+            with DataPoint.transaction() as session:
+                failures = DataPoint.save_many(pending, session=session)
+                failed = {id(datapoint) for datapoint, _ in failures}
+                lost = [
+                    datapoint
+                    for datapoint, error in failures
+                    if error["code"] == DUPLICATE_KEY
+                    and datapoint.scoring_key is not None
+                ]
+                if lost and session is not None:
+                    # (the transaction was aborted by the write error)
+                    session.abort_transaction()
+                    for datapoint in pending:
+                        datapoint.forget_stored()
+                else:
+                    points = sum(
+                        datapoint.rawscore
+                        for datapoint in pending
+                        if id(datapoint) not in failed
+                    )
+                    if points:
+                        Team.adjust_score(
+                            team.id, points * team.multiplier, session=session
+                        )
+                    saved.update(id(datapoint) for datapoint in pending)
+                    saved -= failed
+            if not lost:
+                break
+            # Other datapoints scored those windows first:
+            for datapoint in lost:
+                self._lose_window(datapoint, team)
+        saved = [id(datapoint) in saved for datapoint in datapoints]
+        for datapoint, ok in zip(datapoints, saved):
+            if ok and datapoint.is_reference:
+                DataPoint.remember_reference(datapoint)
+        return saved
+
+    @staticmethod
+    def _log(datapoint: DataPoint, team: TeamCredentials):
+        """Saves a datapoint and adds its score to the team's
+        Raises DuplicateKeyError (having changed nothing) if another
+        datapoint already holds the window that it scored."""
+        with DataPoint.transaction() as session:
+            datapoint.save(session=session)
+            Team.adjust_score(
+                team.id, datapoint.rawscore * team.multiplier, session=session
+            )
+
+    def _lose_window(self, datapoint: DataPoint, team: TeamCredentials):
+        """Penalizes a datapoint for a window that was already scored"""
+        logging.info("Existing datapoint already exists for this window")
+        # the team loses full points for each additional point submitted during the window
+        datapoint.rawscore = self.plan[team.weight_class, datapoint.category].penalty
+        datapoint.scoring_key = None
+
+    def _lose_held_windows(self, missed: list, team: TeamCredentials):
+        """Penalizes the datapoints that missed the mark in windows that the
+        team had already scored, looking the windows up all at once
+        missed holds (datapoint, scoring_key) pairs (see _score())."""
+        if not missed:
+            return
+        held = {
+            (data_point.category, data_point.scoring_key)
+            for data_point in DataPoint.find(
+                {
+                    "team_reference": team.id,
+                    "scoring_key": {"$in": list({key for _, key in missed})},
+                },
+                fields=["category", "scoring_key"],
+            )
+        }
+        for datapoint, scoring_key in missed:
+            if (datapoint.category, scoring_key) in held:
+                self._lose_window(datapoint, team)
+
+    def _assess(
+        self,
+        datapoint: DataPoint,
+        team: TeamCredentials,
+        force: bool = False,
+        claimed: Optional[set] = None,
+        missed: Optional[list] = None,
+    ):
+        """Works out the (raw) score of a datapoint
+        claimed holds the (category, scoring_key)s already scored by other
+        datapoints that have not been saved yet (e.g. earlier in a batch);
+        see _score() for missed"""
         # Profanity check:
         if COMMENT_FILTER_PROFANITY:
             datapoint.censor()
 
-        # TODO: Make this more Pythonic
-        if (
-            datapoint.category in DataClass.manual
-            and datapoint.category in DataClass.measurable
-        ):
-            if bool(
-                datapoint.value
-            ):  # If this is a manually scored datapoint that is being manually scored:
-                datapoint.rawscore = self.point_menu[team.weight_class][
-                    datapoint.category
-                ]
+        entry = self.plan[team.weight_class, datapoint.category]
+        if entry.manual:
+            # If this is a manually scored datapoint that is being manually scored:
+            if bool(datapoint.value):
+                if entry.points is None:
+                    raise KeyError(team.weight_class)
+                datapoint.rawscore = entry.points
             else:
                 datapoint.rawscore = 0.0
+        elif entry.windows is None:  # If this type of datapoint doesn't get scored:
+            logging.debug("Not a scored data category for this weight class.")
+            datapoint.rawscore = 0.0
         else:
-            try:
-                # If they didn't miss the window, give 'em some points:
-                window = self.times[team.weight_class][datapoint.category]
-                logging.debug(f"Window: {window}")
-                match_window = window.get_match_window(datapoint.moment)
-
-                if match_window:
-                    # Get some reference data:
-                    self._score(
-                        team,
-                        datapoint,
-                        "->".join([str(x) for x in match_window]),
-                        force=_force,
-                    )
-                    logging.debug("Window met.")
-                else:
-                    # the team loses full points for datapoints submitted outside of the window.
-                    points_possible = self.point_menu[team.weight_class][
-                        datapoint.category
-                    ]
-                    datapoint.rawscore = -points_possible
-
-                    logging.debug("Window missed.")
-            except KeyError:  # If this type of datapoint doesn't get scored:
-                logging.debug("Not a scored data category for this weight class.")
-                datapoint.rawscore = 0.0
+            # If they didn't miss the window, give 'em some points:
+            match_window = entry.windows.match(datapoint.moment)
+            logging.debug(f"Window: {match_window}")
+
+            if match_window:
+                # Get some reference data:
+                self._score(
+                    team,
+                    datapoint,
+                    window_key(match_window[0]),
+                    force=force,
+                    claimed=claimed,
+                    missed=missed,
+                )
+                logging.debug("Window met.")
+            else:
+                # the team loses full points for datapoints submitted outside of the window.
+                datapoint.rawscore = entry.penalty
 
-        # Score the datapoint:
-        team.health.change(datapoint.score)
-        team.save()
-        # Now log the data:
-        datapoint.save()
-        return True
+                logging.debug("Window missed.")
 
-    def _score(self, team: Team, datapoint: DataPoint, scoring_key, force=False):
+    def _score(
+        self,
+        team: TeamCredentials,
+        datapoint: DataPoint,
+        scoring_key: int,
+        force=False,
+        claimed: Optional[set] = None,
+        missed: Optional[list] = None,
+    ):
         """Scores the datapoint, storing the score in the datapoint.
         Set force to True to recalculate an already-scored datapoint
-        THIS MAKES THE *ASS*UMPTION* THAT THE TIME WINDOW IS VALID!"""
+        THIS MAKES THE *ASS*UMPTION* THAT THE TIME WINDOW IS VALID!
+        A datapoint that scores the window claims it with its scoring_key;
+        if another already holds the window, the unique index turns it away
+        when it is saved (see post_data()).
+        One that misses the mark is still penalized if the window was
+        already scored; pass a list as missed to have it added there, to be
+        looked up with the rest (see _lose_held_windows()), rather than
+        looked up now."""
         # Make sure the point is scoreable:
-        if (
-            datapoint.rawscore != 0
-            and not force
-            or datapoint.category in DataClass.manual
-            or datapoint.category not in DataClass.measurable
-        ):
+        entry = self.plan[team.weight_class, datapoint.category]
+        if datapoint.rawscore != 0 and not force or not entry.measured:
             return
         datapoint.rawscore = 0.0
         datapoint.scoring_key = None
 
-        existing_datapoint = DataPoint.find_one(
+        key = (datapoint.category, scoring_key)
+        if claimed is not None and key in claimed:
+            self._lose_window(datapoint, team)
+            return
+
+        if entry.tolerance is not None and entry.points is not None:
+            reference_datapoint = DataPoint.get_window_reference_point(
+                datapoint.category, datapoint.moment, self.reference_window
+            )
+            if reference_datapoint:
+                difference = abs(reference_datapoint.value - datapoint.value)
+                if difference <= entry.tolerance:
+                    datapoint.rawscore = entry.points
+                    datapoint.scoring_key = scoring_key
+                    if claimed is not None:
+                        claimed.add(key)
+                    return
+
+        # Even missing the mark loses points if the window was already scored.
+        # Such a point doesn't hold the window (a later one may still score
+        # it), so it can't claim the window to find out; it looks it up:
+        if missed is not None:
+            missed.append((datapoint, scoring_key))
+        elif DataPoint.count_documents(
             {
                 "team_reference": datapoint.team_reference,
                 "category": datapoint.category.value,
                 "scoring_key": scoring_key,
-            }
-        )
-
-        if not existing_datapoint or existing_datapoint.id == datapoint.id:
-            try:
-                tol = self.accuracy_tolerance[team.weight_class][datapoint.category]
-                points_possible = self.point_menu[team.weight_class][datapoint.category]
-                reference_datapoint = DataPoint.get_window_reference_point(
-                    datapoint.category, datapoint.moment, self.reference_window
-                )
-                if reference_datapoint:
-                    if abs(reference_datapoint.value - datapoint.value) <= tol:
-                        datapoint.rawscore = points_possible
-                        datapoint.scoring_key = scoring_key
-            except IndexError:
-                pass
-        else:
-            logging.info("Existing datapoint already exists for this key {scoring_key}")
-
-            # the team loses full points for each additional point submitted during the window
-            points_possible = self.point_menu[team.weight_class][datapoint.category]
-            datapoint.rawscore = -points_possible
+                "_id": {"$ne": datapoint.id},
+            },
+            limit=1,
+        ):
+            self._lose_window(datapoint, team)
 
     # The initial instance is created in cubeserver_common/__init__.py
     @staticmethod
     def retrieve_instance() -> "Rules":
-        """Retrieves the current ruleset"""
-        return Rules.find_one({"selected": True})
+        """Retrieves the current ruleset
+        This is cached, and only fetched (and decoded) again once its version
+        has changed; that is checked at most every SETTINGS_REFRESH seconds.
+        The ruleset returned is shared, so please treat it as read-only."""
+        cached = Rules._selected
+        now = monotonic()
+        if cached is not None and now - cached[0] < SETTINGS_REFRESH:
+            return cached[3]
+        current = Rules.find_one({"selected": True}, fields=["version"], lazy=True)
+        if current is None:
+            Rules._selected = None
+            return None
+        if cached is not None and (current.id, current.version) == cached[1:3]:
+            Rules._selected = (now,) + cached[1:]
+            return cached[3]
+        rules = Rules.find_by_id(current.id)
+        if rules is not None:
+            Rules._selected = (now, rules.id, rules.version, rules)
+        return rules
+
+    @staticmethod
+    def invalidate():
+        """Drops this worker's cached ruleset"""
+        Rules._selected = None
+
+    def save(self):
+        """Saves the ruleset, then bumps its version so that every worker
+        fetches it again"""
+        if self._id is not None:
+            # Never take the version backwards (e.g. saving an old copy):
+            stored = Rules.find_one({"_id": self._id}, fields=["version"], lazy=True)
+            if stored is not None and stored.version > self.version:
+                self.version = stored.version
+        self.__dict__.pop("_plan", None)  # (in case it was changed)
+        super().save()
+        document = self.collection.find_one_and_update(
+            {"_id": self._id},
+            {"$inc": {self.field_path("version"): 1}},
+            projection={"version": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        bumped = Rules.decode_partial(document, ["version"])
+        self._sync_field("version", bumped.version)
+        Rules.invalidate()
 
     def to_json(self) -> str:
         """Turns this document into a json string"""
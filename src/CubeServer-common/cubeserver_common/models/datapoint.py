@@ -1,18 +1,39 @@
 """Models users, teams, and privilege data"""
 
 import logging
+from bisect import bisect_right
+from calendar import timegm
 from enum import Enum, unique
-from typing import Any, Optional
-from datetime import datetime
+from threading import Lock
+from typing import Any, Dict, List, Optional
+from datetime import datetime, timedelta
+from time import sleep
 from better_profanity import profanity
 
-from pymongo import DESCENDING
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.client_session import ClientSession
+from pymongo.errors import BulkWriteError
 from bson.objectid import ObjectId
-from cubeserver_common.models.utils import PyMongoModel
+from cubeserver_common.config import (
+    REFERENCE_TIMELINE_REBUILD_INTERVAL,
+    REFERENCE_TIMELINE_SIZE,
+    REFERENCE_TIMELINE_SYNC_INTERVAL,
+    REFERENCE_TIMELINE_SYNC_LAG,
+)
+from cubeserver_common.models.utils import ModelIndex, PyMongoModel
 from cubeserver_common.models.team import Team
 
 
-__all__ = ["DataPoint", "DataClass"]
+__all__ = [
+    "DataPoint",
+    "DataClass",
+    "ReferenceTimeline",
+    "window_key",
+    "migrate_scoring_keys",
+]
+
+DUPLICATE_KEY = 11000
+"""The code of the write error for a duplicate key in a unique index"""
 
 
 @unique
@@ -58,22 +79,58 @@ class DataClass(Enum):
     @property
     def measurable(cls):
         """Returns all measurable types of data (not COMMENT, etc)"""
-        m = []
-        for dataclass in cls:
-            if dataclass != cls.COMMENT:
-                m.append(dataclass)
-        return m
+        return _MEASURABLE
 
     @classmethod
     @property
     def manual(cls):
         """Returns all types of data that are determined manually"""
-        return [cls.SIGNAL_LIGHT]
+        return _MANUAL
+
+
+_MEASURABLE = tuple(
+    dataclass for dataclass in DataClass if dataclass != DataClass.COMMENT
+)
+_MANUAL = (DataClass.SIGNAL_LIGHT,)
+
+
+def window_key(start: datetime) -> int:
+    """The scoring_key of the window that starts at a given moment: that
+    moment in seconds since the epoch (taken as UTC, since it is only an id)"""
+    return timegm(start.timetuple())
 
 
 class DataPoint(PyMongoModel):
     """Models a datapoint"""
 
+    flat_storage = True
+
+    indexes = [
+        # A team's data, newest first:
+        ModelIndex("team_reference", ("moment", DESCENDING)),
+        # The point that scored each window (only ever one per team):
+        ModelIndex(
+            "team_reference",
+            "category",
+            "scoring_key",
+            unique=True,
+            partial={"scoring_key": {"$type": "number"}},
+        ),
+        # The latest reference point before a given moment:
+        ModelIndex("category", ("moment", DESCENDING), partial={"is_reference": True}),
+    ]
+
+    team_reference: ObjectId
+    category: DataClass
+    value: Any
+    moment: datetime
+    is_reference: bool
+    rawscore: float
+    scoring_key: Optional[int]  # The window that it scored (see window_key())
+
+    # The recent reference points of each category (see ReferenceTimeline):
+    reference_timeline = None
+
     def __init__(
         self,
         team_identifier: ObjectId = ObjectId(),
@@ -102,7 +159,9 @@ class DataPoint(PyMongoModel):
 
     @property
     def multiplier(self) -> float:
-        return Team.find_by_id(self.team_reference).multiplier.amount
+        return Team.find_by_id(
+            self.team_reference, fields=["multiplier"]
+        ).multiplier.amount
 
     @property
     def value_with_unit(self):
@@ -122,14 +181,21 @@ class DataPoint(PyMongoModel):
         return cls.find({"team_reference": ObjectId(team.id)})
 
     @classmethod
-    def find(cls, *args, **kwargs):
+    def iter_by_team(cls, team: "Team", batch_size: Optional[int] = None):
+        """Lazily iterates over the datapoints by a team"""
+        return cls.iter_find(
+            {"team_reference": ObjectId(team.id)}, batch_size=batch_size
+        )
+
+    @classmethod
+    def iter_find(cls, *args, **kwargs):
         if "sort" not in kwargs or not kwargs["sort"]:
             kwargs["sort"] = [("moment", DESCENDING)]
-        return super().find(*args, **kwargs)
+        return super().iter_find(*args, **kwargs)
 
     @property
     def team_str(self):
-        return Team.find_by_id(self.team_reference).name
+        return Team.find_by_id(self.team_reference, fields=["name"]).name
 
     @property
     def score(self):
@@ -140,26 +206,135 @@ class DataPoint(PyMongoModel):
 
         logging.debug("Recalculating points...")
         logging.debug(f"Original rawscore: {self.rawscore}")
-        team: Team = Team.find_by_id(self.team_reference)
         if _init_contrib_score is ...:
-            team.health.change(-1 * self.score)
+            Team.adjust_score(self.team_reference, -1 * self.score)
         else:
-            team.health.change(-1 * _init_contrib_score)
-        team.save()
+            Team.adjust_score(self.team_reference, -1 * _init_contrib_score)
         Rules.retrieve_instance().post_data(self, _force=True)
 
+    def save(self, session: Optional[ClientSession] = None):
+        """Saves the datapoint, replacing it in the reference timeline if it
+        is held there (e.g. when a reference point is edited)"""
+        super().save(session=session)
+        DataPoint.reference_timeline.update(self)
+
+    def remove(self):
+        """Removes the datapoint, dropping it from the reference timeline"""
+        super().remove()
+        DataPoint.reference_timeline.discard(self)
+
     def censor(self):
         """Removes bad words."""
         if isinstance(self.value, str):
             self.value = profanity.censor(self.value)
 
+    @classmethod
+    def remember_reference(cls, data_point: "DataPoint"):
+        """Notes a reference point that was just saved, so that scoring
+        can use it without looking it up"""
+        cls.reference_timeline.add(data_point)
+
     @classmethod
     def get_window_reference_point(
         cls, category: DataClass, moment: datetime, window: int
     ) -> "DataPoint":
-        """Just returns a DataPoint object from the last most recent DataPoints"""
+        """Just returns a DataPoint object from the last most recent DataPoints
+        (found in the reference_timeline)"""
+
+        data_point = cls.reference_timeline.latest(category, moment)
+        if data_point:
+            data_point_age = (moment - data_point.moment).total_seconds()
+
+            # TODO: need to determine the right window since values are captured async from reference cubes
+            if True or data_point_age < window:
+                return data_point
+        return None
+
+
+class _Timeline:
+    """The reference points of one category, oldest first"""
+
+    def __init__(self):
+        self.moments: List[datetime] = []
+        self.points: List[DataPoint] = []
+        self.ids = set()
+        self.synced_at: Optional[datetime] = None
+        self.built_at: Optional[datetime] = None
+        self.complete = False  # Whether these are all of the reference points
+        self.syncing = False  # Whether a thread is fetching for it
+
+
+class ReferenceTimeline:
+    """The most recent REFERENCE_TIMELINE_SIZE reference points of each
+    category, in time order, so that the one that a datapoint is scored
+    against is found with a bisect rather than a query
 
-        data_point = DataPoint.find_one(
+    Reference points saved, edited, or removed by this process are added,
+    replaced, or dropped as that happens; those saved by other processes are
+    fetched (with an indexed query for anything newer than the last fetch)
+    at most every REFERENCE_TIMELINE_SYNC_INTERVAL seconds, and each timeline
+    is fetched afresh every REFERENCE_TIMELINE_REBUILD_INTERVAL seconds to
+    catch up with points that other processes edited or removed. Fetches
+    are made without holding the lock, so that scoring never waits on them.
+    Moments older than the timeline are looked up in the database."""
+
+    def __init__(self, size: int = REFERENCE_TIMELINE_SIZE):
+        self.size = size
+        self._timelines: Dict[DataClass, _Timeline] = {}
+        self._lock = Lock()
+
+    def clear(self):
+        """Forgets everything (it is fetched again when next needed)"""
+        with self._lock:
+            self._timelines.clear()
+
+    def backfill(self, categories=None):
+        """Fetches the recent reference points of the given categories
+        (all measurable ones by default), e.g. when starting up"""
+        for category in categories or DataClass.measurable:
+            with self._lock:
+                timeline = self._timeline(category)
+                if timeline.syncing:
+                    continue
+                timeline.syncing = True
+            self._sync(category, timeline, datetime.now())
+
+    def add(self, data_point: DataPoint):
+        """Adds a reference point that was just saved"""
+        with self._lock:
+            self._insert(self._timeline(data_point.category), data_point)
+
+    def update(self, data_point: DataPoint):
+        """Replaces a reference point that was just edited, if it is held
+        here (dropping it if it is no longer a reference point)"""
+        with self._lock:
+            if self._drop(data_point.id) and data_point.is_reference:
+                self._insert(self._timeline(data_point.category), data_point)
+
+    def discard(self, data_point: DataPoint):
+        """Drops a reference point that was just removed"""
+        with self._lock:
+            self._drop(data_point.id)
+
+    def latest(self, category: DataClass, moment: datetime) -> Optional[DataPoint]:
+        """The latest reference point of a category as of a moment, if any"""
+        now = datetime.now()
+        with self._lock:
+            timeline = self._timeline(category)
+            due = not timeline.syncing and self._due(timeline, moment, now)
+            if due:
+                timeline.syncing = True
+            else:
+                held, found = self._find(timeline, moment)
+        if due:
+            self._sync(category, timeline, now)
+            with self._lock:
+                held, found = self._find(self._timeline(category), moment)
+        if held:
+            return found
+
+        # Older than anything kept here:
+        return DataPoint.find_one(
             {
                 "is_reference": True,
                 "category": category.value,
@@ -168,10 +343,173 @@ class DataPoint(PyMongoModel):
             sort=[("moment", DESCENDING)],
         )
 
-        if data_point:
-            data_point_age = (moment - data_point.moment).total_seconds()
+    def _timeline(self, category: DataClass) -> _Timeline:
+        return self._timelines.setdefault(category, _Timeline())
 
-            # TODO: need to determine the right window since values are captured async from reference cubes
-            if True or data_point_age < window:
-                return data_point
-        return None
+    @staticmethod
+    def _due(timeline: _Timeline, moment: datetime, now: datetime) -> bool:
+        """Whether a timeline needs fetching before it can answer for a moment"""
+        lag = timedelta(seconds=REFERENCE_TIMELINE_SYNC_LAG)
+        interval = timedelta(seconds=REFERENCE_TIMELINE_SYNC_INTERVAL)
+        rebuild = timedelta(seconds=REFERENCE_TIMELINE_REBUILD_INTERVAL)
+        return (
+            timeline.synced_at is None
+            or now - timeline.built_at >= rebuild
+            or (
+                moment > timeline.synced_at - lag
+                and now - timeline.synced_at >= interval
+            )
+        )
+
+    @staticmethod
+    def _find(timeline: _Timeline, moment: datetime):
+        """Whether a timeline covers a moment, and its latest point as of then"""
+        if timeline.complete or (timeline.moments and moment >= timeline.moments[0]):
+            index = bisect_right(timeline.moments, moment)
+            return True, (timeline.points[index - 1] if index else None)
+        return False, None
+
+    def _sync(self, category: DataClass, timeline: _Timeline, now: datetime):
+        """Fetches the reference points of a category saved since it was last
+        synced (allowing REFERENCE_TIMELINE_SYNC_LAG seconds for points that
+        were still being saved then), or the latest ones if it is due to be
+        rebuilt (or never was synced)
+        The caller marks the timeline as syncing; the query is made without
+        the lock, which is only taken to put the results in place."""
+        lag = timedelta(seconds=REFERENCE_TIMELINE_SYNC_LAG)
+        rebuild = timeline.built_at is None or now - timeline.built_at >= timedelta(
+            seconds=REFERENCE_TIMELINE_REBUILD_INTERVAL
+        )
+        query = {"is_reference": True, "category": category.value}
+        try:
+            if rebuild:
+                points = DataPoint.find(
+                    query, sort=[("moment", DESCENDING)], limit=self.size
+                )
+                points.reverse()
+            else:
+                query["moment"] = {"$gt": timeline.synced_at - lag}
+                points = DataPoint.find(query, sort=[("moment", ASCENDING)])
+        except BaseException:
+            with self._lock:
+                timeline.syncing = False
+            raise
+
+        with self._lock:
+            timeline.syncing = False
+            if not rebuild:
+                for data_point in points:
+                    self._insert(timeline, data_point)
+                timeline.synced_at = now
+                return
+            fresh = _Timeline()
+            fresh.complete = len(points) < self.size
+            for data_point in points:
+                self._insert(fresh, data_point)
+            # Keep any that were added here while fetching:
+            for data_point in timeline.points:
+                if data_point.moment > now - lag:
+                    self._insert(fresh, data_point)
+            fresh.synced_at = fresh.built_at = now
+            if self._timelines.get(category) is timeline:  # (not cleared)
+                self._timelines[category] = fresh
+
+    def _insert(self, timeline: _Timeline, data_point: DataPoint):
+        if data_point.id in timeline.ids:
+            return
+        if (
+            not timeline.complete
+            and timeline.moments
+            and data_point.moment < timeline.moments[0]
+        ):
+            return  # (older than the timeline, so looked up when needed)
+        index = bisect_right(timeline.moments, data_point.moment)
+        timeline.moments.insert(index, data_point.moment)
+        timeline.points.insert(index, data_point)
+        timeline.ids.add(data_point.id)
+        if len(timeline.points) > self.size:
+            del timeline.moments[0]
+            timeline.ids.discard(timeline.points.pop(0).id)
+            timeline.complete = False
+
+    def _drop(self, point_id: ObjectId) -> bool:
+        """Drops a point from whichever timeline holds it
+        Returns whether one did."""
+        for timeline in self._timelines.values():
+            if point_id in timeline.ids:
+                index = next(
+                    i for i, point in enumerate(timeline.points) if point.id == point_id
+                )
+                del timeline.moments[index]
+                del timeline.points[index]
+                timeline.ids.discard(point_id)
+                return True
+        return False
+
+
+DataPoint.reference_timeline = ReferenceTimeline()
+
+
+def migrate_scoring_keys(batch_size: int = 500, pause: float = 0.1) -> int:
+    """Converts the scoring_keys that were stored as strings ("start->end")
+    to window keys (see window_key()), a batch at a time
+    Each key is only replaced if it is unchanged since it was read, so this
+    is safe to run while the servers are up. Points that held the same
+    window as another (which the unique index no longer allows) lose their
+    keys, but not their scores; rescore the competition to settle those.
+    Returns the number of keys converted."""
+    key_path = DataPoint.field_path("scoring_key")
+    converted = 0
+    last_id = None
+    while True:
+        query = {"scoring_key": {"$type": "string"}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = DataPoint.find(
+            query, fields=["scoring_key"], sort=[("_id", ASCENDING)], limit=batch_size
+        )
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        filters = []
+        keys = []
+        for data_point in batch:
+            try:
+                start = datetime.fromisoformat(data_point.scoring_key.split("->")[0])
+                key = window_key(start)
+            except ValueError:
+                logging.warning(f"Dropping unreadable key {data_point.scoring_key!r}")
+                key = None
+            # (only if it is unchanged since it was read)
+            filters.append(
+                DataPoint._map_filter(
+                    {"_id": data_point.id, "scoring_key": data_point.scoring_key}
+                )
+            )
+            keys.append(key)
+        operations = [
+            UpdateOne(f, {"$set": {key_path: key}}) for f, key in zip(filters, keys)
+        ]
+        try:
+            converted += DataPoint.collection.bulk_write(
+                operations, ordered=False
+            ).modified_count
+        except BulkWriteError as error:
+            converted += error.details["nModified"]
+            duplicates = []
+            for write_error in error.details["writeErrors"]:
+                if write_error["code"] != DUPLICATE_KEY:
+                    raise
+                duplicates.append(
+                    UpdateOne(filters[write_error["index"]], {"$set": {key_path: None}})
+                )
+            logging.warning(
+                f"Dropped {len(duplicates)} scoring_keys of windows that were held "
+                "twice; please rescore the competition"
+            )
+            DataPoint.collection.bulk_write(duplicates, ordered=False)
+        if pause:
+            sleep(pause)
+    logging.info(f"Converted {converted} scoring_keys")
+    return converted
@@ -0,0 +1,155 @@
+"""Models the queue of data that has been posted but not yet scored
+
+See config.ASYNC_INGESTION; the queue is drained by the scoring worker
+(cubeserver_common.scorer)"""
+
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Iterable, List, Optional
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+
+from cubeserver_common.config import INGEST_BATCH_SIZE, INGEST_CLAIM_TIMEOUT
+from cubeserver_common.models.utils import ModelIndex, PyMongoModel
+from cubeserver_common.models.datapoint import DataClass, DataPoint
+from cubeserver_common.models.team import Team, TeamCredentials
+
+__all__ = ["QueuedDataPoint"]
+
+
+class QueuedDataPoint(PyMongoModel):
+    """A datapoint that has been received, waiting to be scored
+    Its id becomes the id of the DataPoint once it is scored."""
+
+    indexes = [
+        ModelIndex("claimed_at", "moment", "_id"),
+        ModelIndex("claim"),
+    ]
+
+    RECEIVED_ORDER = [("moment", ASCENDING), ("_id", ASCENDING)]
+
+    team_reference: ObjectId
+    category: DataClass
+    value: Any
+    moment: datetime
+    is_reference: bool
+    claim: ObjectId
+    claimed_at: datetime
+    attempts: int
+
+    def __init__(self, datapoint: Optional[DataPoint] = None):
+        """Queues a copy of an (unscored) datapoint"""
+        super().__init__()
+
+        if datapoint is None:
+            datapoint = DataPoint()
+
+        self.team_reference = datapoint.team_reference
+        self.category = datapoint.category
+        self.value = datapoint.value
+        self.moment = datapoint.moment  # When it was received
+        self.is_reference = datapoint.is_reference
+        self.claim = ObjectId()  # (never matches a worker's claim)
+        self.claimed_at = datetime.min
+        self.attempts = 0
+
+    @classmethod
+    def enqueue(cls, datapoints: Iterable[DataPoint]) -> List[bool]:
+        """Queues datapoints to be scored, in one write
+        Returns whether each was queued."""
+        queued = [cls(datapoint) for datapoint in datapoints]
+        failed = {id(entry) for entry, _ in cls.save_many(queued)}
+        return [id(entry) not in failed for entry in queued]
+
+    def to_datapoint(self) -> DataPoint:
+        """The (unscored) DataPoint that was queued"""
+        datapoint = DataPoint(
+            self.team_reference,
+            self.category,
+            self.value,
+            self.moment,
+            self.is_reference,
+        )
+        datapoint._id = self._id
+        return datapoint
+
+    @classmethod
+    def claim_batch(cls, size: int = INGEST_BATCH_SIZE) -> List["QueuedDataPoint"]:
+        """Takes up to size of the oldest queued datapoints for this worker
+        to score; any that another worker took too long ago are retaken."""
+        now = datetime.now()
+        available = {
+            "claimed_at": {"$lt": now - timedelta(seconds=INGEST_CLAIM_TIMEOUT)}
+        }
+        candidates = cls.find(
+            available, fields=["moment"], sort=cls.RECEIVED_ORDER, limit=size
+        )
+        if not candidates:
+            return []
+        claim = ObjectId()
+        cls.collection.update_many(
+            cls._map_filter(
+                {"_id": {"$in": [entry.id for entry in candidates]}, **available}
+            ),
+            {
+                "$set": {
+                    cls.field_path("claim"): claim,
+                    cls.field_path("claimed_at"): now,
+                },
+                "$inc": {cls.field_path("attempts"): 1},
+            },
+        )
+        return cls.find({"claim": claim}, sort=cls.RECEIVED_ORDER)
+
+    @classmethod
+    def score_batch(cls, size: int = INGEST_BATCH_SIZE) -> int:
+        """Claims a batch of queued datapoints, then scores and logs them just
+        as Rules.post_data() would have when they were received.
+        Returns how many were claimed."""
+        from cubeserver_common.models.config.rules import Rules
+
+        batch = cls.claim_batch(size)
+        if not batch:
+            return 0
+
+        # A worker that died after saving some of these has already scored them:
+        retried = [entry.id for entry in batch if entry.attempts > 1]
+        if retried:
+            done = {
+                datapoint.id
+                for datapoint in DataPoint.find(
+                    {"_id": {"$in": retried}}, fields=["moment"]
+                )
+            }
+            pending = [entry for entry in batch if entry.id not in done]
+        else:
+            pending = batch
+
+        teams = {
+            team.id: TeamCredentials.of(team)
+            for team in Team.find(
+                {"_id": {"$in": list({entry.team_reference for entry in pending})}},
+                fields=Team.CREDENTIAL_FIELDS,
+            )
+        }
+        datapoints = defaultdict(list)
+        for entry in pending:
+            if entry.team_reference in teams:
+                datapoints[entry.team_reference].append(entry.to_datapoint())
+            else:
+                logging.warning(f"Dropping queued data of a removed team: {entry.id}")
+
+        # The reference data first, since the teams' data are scored against it:
+        rules = Rules.retrieve_instance()
+        for team_id in sorted(datapoints, key=lambda t: not teams[t].is_reference):
+            saved = rules.post_batch(datapoints[team_id], teams[team_id])
+            if not all(saved):
+                logging.error(
+                    f"Could not save {saved.count(False)} queued datapoint(s) "
+                    f"of {teams[team_id].name}"
+                )
+
+        cls.collection.delete_many({"_id": {"$in": [entry.id for entry in batch]}})
+        return len(batch)
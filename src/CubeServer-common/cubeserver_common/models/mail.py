@@ -9,6 +9,7 @@ from bson.objectid import ObjectId
 
 from cubeserver_common.models.config.conf import Conf
 from cubeserver_common.models.utils.modelutils import PyMongoModel
+from cubeserver_common.models.utils.indexes import ModelIndex
 from cubeserver_common.models.utils.dummycodec import DummyCodec
 
 # from cubeserver_common.models.team import Team  # Creates circular import; removed
@@ -17,6 +18,18 @@ from cubeserver_common.models.utils.dummycodec import DummyCodec
 class Message(PyMongoModel):
     """Describes an email to be sent"""
 
+    indexes = [ModelIndex("team_reference")]
+
+    from_addr: str
+    recipients: List[str]
+    from_name: str
+    subject: str
+    message: str
+    team_reference: Optional[ObjectId]
+    sent_at: Optional[datetime]
+
+    field_codecs = {"sent_at": DummyCodec(datetime)}
+
     def __init__(
         self,
         from_name: str = "",
@@ -33,9 +46,7 @@ class Message(PyMongoModel):
         self.subject = subject
         self.message = message
         self.team_reference = team_identifier
-
-        self.register_field("sent_at", custom_codec=DummyCodec(datetime))
-        self._ignored += ["_mimetext"]
+        self.sent_at = None
 
     @property
     def sender_str(self) -> str:
@@ -0,0 +1,534 @@
+"""Rescores the data of whole teams at once
+
+Rescoring a team point by point (DataPoint.recalculate_score()) looks up the
+team, the rules, the reference point and any earlier point of the window,
+then saves the point and the team's score, for every one of its points.
+This instead loads the teams' data and the reference data once, works the
+scores out with NumPy arrays, and writes them back in one bulk write.
+
+The results are those of rescoring point by point, newest first (as
+Team.recompute_score() did): in particular, a point only scores a window if
+no other point already holds its scoring_key when it is reached, so the keys
+stored before rescoring are taken into account (see _resolve_claims()).
+
+rescore_competition() spreads the teams over a pool of processes, and
+RescoreRun runs that in the background (for the admin panel)."""
+
+import logging
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from math import isclose
+from multiprocessing import get_context
+from threading import Thread
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from better_profanity import profanity
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from cubeserver_common.config import (
+    COMMENT_FILTER_PROFANITY,
+    RESCORE_SHARD_SIZE,
+    RESCORE_STALE_AFTER,
+    RESCORE_WORKERS,
+)
+from cubeserver_common.models.config.rules import NO_WINDOW, Rules, ScoringWindows
+from cubeserver_common.models.datapoint import DUPLICATE_KEY, DataClass, DataPoint
+from cubeserver_common.models.team import Team, TeamCredentials
+from cubeserver_common.models.utils import ModelIndex, PyMongoModel
+
+__all__ = ["rescore_teams", "rescore_competition", "check_scores", "RescoreRun"]
+
+FIELDS = ["team_reference", "category", "value", "moment", "rawscore", "scoring_key"]
+
+# How each scored point fares in its window:
+_PENALIZED, _UNSCORED, _SCORED = -1, 0, 1
+
+
+def _as_float(value) -> float:
+    """A value as a float, or NaN if it is not a number"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _moments(points: list) -> np.ndarray:
+    return np.array([point.moment for point in points], dtype="datetime64[us]")
+
+
+def _ranks(ids: List[ObjectId]) -> np.ndarray:
+    """The position of each id in id order"""
+    ranks = np.empty(len(ids), dtype=np.int64)
+    ranks[np.argsort(np.array([i.binary for i in ids], dtype="S12"))] = np.arange(
+        len(ids)
+    )
+    return ranks
+
+
+class _ReferenceSeries:
+    """Every reference point of each category, in time order"""
+
+    def __init__(self):
+        self.moments: Dict[DataClass, np.ndarray] = {}
+        self.values: Dict[DataClass, np.ndarray] = {}
+
+    @classmethod
+    def load(cls) -> "_ReferenceSeries":
+        series = cls()
+        by_category = defaultdict(list)
+        for point in DataPoint.iter_find(
+            {"is_reference": True},
+            fields=["category", "value", "moment"],
+            lazy=True,
+        ):
+            by_category[point.category].append(point)
+        for category, points in by_category.items():
+            moments = _moments(points)
+            # (the last of any saved at the same moment is the latest)
+            order = np.lexsort((_ranks([point.id for point in points]), moments))
+            series.moments[category] = moments[order]
+            series.values[category] = np.array(
+                [_as_float(points[i].value) for i in order]
+            )
+        return series
+
+    def latest(self, category: DataClass, moments: np.ndarray) -> np.ndarray:
+        """The value of the latest reference point of a category as of each
+        moment (NaN where there is none)"""
+        if category not in self.moments:
+            return np.full(len(moments), np.nan)
+        index = np.searchsorted(self.moments[category], moments, side="right") - 1
+        return np.where(index >= 0, self.values[category][index], np.nan)
+
+
+def _match_windows(
+    windows: ScoringWindows, moments: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The window id of each moment (NO_WINDOW if it falls into none), and
+    when that window starts (as ScoringWindows.match() finds them)"""
+    hours = moments.astype("datetime64[h]")
+    seconds = (moments - hours).astype("timedelta64[s]").astype(np.int64)
+    matched = np.frombuffer(windows.by_second, dtype=np.int16)[seconds]
+    bounds = np.array([start for start, _ in windows.bounds] or [0], dtype=np.int64)
+    return matched, hours.astype("datetime64[s]") + bounds[matched].astype(
+        "timedelta64[s]"
+    )
+
+
+def _scoring_keys(starts: np.ndarray) -> np.ndarray:
+    """The scoring_key of each window (as window_key() makes them)"""
+    return np.array(starts.astype(np.int64).tolist(), dtype=object)
+
+
+def _resolve_claims(
+    ids: List[ObjectId],
+    contending: np.ndarray,
+    groups: np.ndarray,
+    accurate: np.ndarray,
+    holders: Dict[int, List[int]],
+) -> np.ndarray:
+    """How each point contending for a window fares, rescored in order
+    (points are indexed in the order that they are rescored)
+
+    contending marks the points that are scored against a window, groups
+    numbers each one's window, and holders gives the points that held the
+    scoring_key of each window before rescoring. A point reached while
+    another holds the key of its window is penalized; otherwise it scores
+    (and takes the key) if it is accurate, and releases the key if not."""
+    result = np.full(len(contending), _UNSCORED)
+    index = np.flatnonzero(contending)
+    if not len(index):
+        return result
+    order = np.lexsort((index, groups[index]))
+    index, group = index[order], groups[index][order]
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    ends = np.r_[starts[1:], len(index)]
+    position = np.arange(len(index))
+    window = np.searchsorted(starts, position, side="right") - 1
+
+    # Usually the key of a window is held by none of the team's points, or by
+    # one in that window (which keeps it until it is reached, penalizing any
+    # reached before it); the first accurate point from there on scores:
+    begin = starts.copy()
+    irregular = []
+    for number, (start, end) in enumerate(zip(starts, ends)):
+        held = holders.get(group[start], [])
+        if len(held) == 1 and held[0] in index[start:end]:
+            begin[number] = start + np.flatnonzero(index[start:end] == held[0])[0]
+        elif held:
+            irregular.append((start, end, held))
+    candidates = np.where(
+        accurate[index] & (position >= begin[window]), position, len(index)
+    )
+    winner = np.minimum.reduceat(candidates, starts)[window]
+    outcome = np.full(len(index), _UNSCORED)
+    outcome[position == winner] = _SCORED
+    outcome[(position < begin[window]) | (position > winner)] = _PENALIZED
+
+    # Otherwise (after the windows were changed, say), go point by point:
+    for start, end, held in irregular:
+        holding = set(held)
+        members = set(index[start:end])
+        for position in range(start, end):
+            point = index[position]
+            # (a point of another window gives up this key once it's reached)
+            holding -= {
+                other
+                for other in holding
+                if other not in members and contending[other] and other < point
+            }
+            if holding and min(holding, key=ids.__getitem__) != point:
+                outcome[position] = _PENALIZED
+                holding.discard(point)
+            elif accurate[point]:
+                outcome[position] = _SCORED
+                holding.add(point)
+            else:
+                outcome[position] = _UNSCORED
+                holding.discard(point)
+
+    result[index] = outcome
+    return result
+
+
+def _rescore_team(
+    team: TeamCredentials,
+    points: list,
+    rules: Rules,
+    references: _ReferenceSeries,
+) -> Tuple[list, np.ndarray, np.ndarray, list]:
+    """Works out the scores of a team's points
+    Returns the points in the order that they were rescored, with their new
+    raw scores, scoring keys and values."""
+    moments = _moments(points)
+    order = np.lexsort(
+        (_ranks([point.id for point in points]), -moments.astype(np.int64))
+    )
+    points = [points[i] for i in order]
+    moments = moments[order]
+    ids = [point.id for point in points]
+    categories = np.array([point.category for point in points], dtype=object)
+    values = [point.value for point in points]
+    if COMMENT_FILTER_PROFANITY:
+        values = [
+            profanity.censor(value) if isinstance(value, str) else value
+            for value in values
+        ]
+    rawscores = np.array([point.rawscore for point in points], dtype=float)
+    stored_keys = np.array([point.scoring_key for point in points], dtype=object)
+    keys = stored_keys.copy()
+
+    contending = np.zeros(len(points), dtype=bool)
+    accurate = np.zeros(len(points), dtype=bool)
+    worth = np.zeros(len(points))
+    penalty = np.zeros(len(points))
+    groups = np.full(len(points), -1)  # Numbering the windows
+    numbers = {}
+    for category in set(categories):
+        mask = categories == category
+        entry = rules.plan[team.weight_class, category]
+        if entry.manual:
+            # Manually scored:
+            truthy = mask & np.array([bool(value) for value in values])
+            if truthy.any():
+                if entry.points is None:
+                    raise KeyError(team.weight_class)
+                rawscores[truthy] = entry.points
+            rawscores[mask & ~truthy] = 0.0
+            continue
+        if entry.windows is None:  # Not scored for this division
+            rawscores[mask] = 0.0
+            continue
+        windows, starts = _match_windows(entry.windows, moments[mask])
+        matched = windows != NO_WINDOW
+        rawscores[np.flatnonzero(mask)[~matched]] = entry.penalty
+        if not entry.measured:
+            continue
+        scored = np.flatnonzero(mask)[matched]
+        contending[scored] = True
+        keys[scored] = _scoring_keys(starts[matched])
+        for i, key in zip(scored, keys[scored]):
+            groups[i] = numbers.setdefault((category, key), len(numbers))
+        penalty[scored] = -entry.penalty
+        if entry.tolerance is not None and entry.points is not None:
+            worth[scored] = entry.points
+            difference = np.abs(
+                references.latest(category, moments[scored])
+                - np.array([_as_float(values[i]) for i in scored])
+            )
+            accurate[scored] = difference <= entry.tolerance
+
+    # Who held each window's key:
+    holders = defaultdict(list)
+    for i, (category, key) in enumerate(zip(categories, stored_keys)):
+        if key is not None and (category, key) in numbers:
+            holders[numbers[(category, key)]].append(i)
+
+    outcome = _resolve_claims(ids, contending, groups, accurate, holders)
+    rawscores[contending] = np.select(
+        [outcome == _SCORED, outcome == _PENALIZED],
+        [worth, -penalty],
+        0.0,
+    )[contending]
+    keys[contending & (outcome != _SCORED)] = None
+    return points, rawscores, keys, values
+
+
+def rescore_teams(
+    team_ids: Optional[Iterable[ObjectId]] = None,
+    rules: Optional[Rules] = None,
+    references: Optional[_ReferenceSeries] = None,
+) -> Dict[ObjectId, float]:
+    """Rescores all of the data of the given teams (or of every team) with
+    the given rules (the current ones by default), and sets their scores
+    Returns each team's new score.
+    Teams may go on posting meanwhile. A team whose score changes while its
+    data are read is rescored again. One whose score changes after that
+    keeps the change (see Team.set_scores()). So is a team whose data change
+    under the rescoring, e.g. when a new point scores a window that would
+    have been given to another."""
+    if rules is None:
+        rules = Rules.retrieve_instance()
+    if references is None:
+        references = _ReferenceSeries.load()
+    query = {} if team_ids is None else {"_id": {"$in": list(team_ids)}}
+    scores = {}
+    while True:
+        rescored, again = _rescore_once(query, rules, references)
+        scores.update(rescored)
+        if not again:
+            return scores
+        logging.info(f"Rescoring {len(again)} teams again, as they changed")
+        query = {"_id": {"$in": again}}
+
+
+def _rescore_once(
+    query: dict, rules: Rules, references: _ReferenceSeries
+) -> Tuple[Dict[ObjectId, float], List[ObjectId]]:
+    """Rescores the teams that match a query (see rescore_teams())
+    Returns the new scores, and the teams that have to be rescored again."""
+    teams = {}
+    loaded = {}  # Each team's score as its data were read
+    for team in Team.find(query, fields=Team.CREDENTIAL_FIELDS + ["health"]):
+        teams[team.id] = TeamCredentials.of(team)
+        loaded[team.id] = team.score
+    points = defaultdict(list)
+    for point in DataPoint.iter_find(
+        {"team_reference": {"$in": list(teams)}}, fields=FIELDS, lazy=True
+    ):
+        points[point.team_reference].append(point)
+    # (a point posted while these were read may be here without its score)
+    again = [
+        team.id
+        for team in Team.find({"_id": {"$in": list(teams)}}, fields=["health"])
+        if team.score != loaded[team.id]
+    ]
+    for team_id in again:
+        del teams[team_id]
+
+    releases = []  # (written first, so that no window is ever held twice)
+    updates = []
+    scores = {}
+    for team_id, team in teams.items():
+        if not points[team_id]:
+            scores[team_id] = 0.0
+            continue
+        rescored, rawscores, keys, values = _rescore_team(
+            team, points[team_id], rules, references
+        )
+        for point, rawscore, key, value in zip(rescored, rawscores, keys, values):
+            changes = {}
+            if rawscore != point.rawscore:
+                changes[DataPoint.field_path("rawscore")] = float(rawscore)
+            if key != point.scoring_key:
+                changes[DataPoint.field_path("scoring_key")] = key
+                if point.scoring_key is not None and key is not None:
+                    releases.append(
+                        UpdateOne(
+                            {"_id": point.id},
+                            {"$set": {DataPoint.field_path("scoring_key"): None}},
+                        )
+                    )
+            if value != point.value:
+                changes[DataPoint.field_path("value")] = value
+            if changes:
+                updates.append(UpdateOne({"_id": point.id}, {"$set": changes}))
+        # (summed in order, as the point by point scores were)
+        scores[team_id] = float(np.cumsum(rawscores * team.multiplier)[-1])
+
+    try:
+        with DataPoint.transaction() as session:
+            for writes in (releases, updates):
+                if writes:
+                    DataPoint.collection.bulk_write(
+                        writes, ordered=False, session=session
+                    )
+            Team.set_scores(scores, session=session, previous=loaded)
+    except BulkWriteError as error:
+        if any(e["code"] != DUPLICATE_KEY for e in error.details["writeErrors"]):
+            raise
+        # A window was scored by a point posted meanwhile. Without a
+        # transaction some of the data were written, but no scores were, so
+        # the teams are simply rescored from where they are now:
+        return {}, again + list(teams)
+    return scores, again
+
+
+# The reference data that each pooled process rescores against:
+_worker_references: Optional[_ReferenceSeries] = None
+
+
+def _init_worker():
+    """Connects a pooled process to the database"""
+    from cubeserver_common import configure_db
+
+    configure_db(worker=True)
+
+
+def _rescoring_pool(workers: Optional[int]) -> ProcessPoolExecutor:
+    """A pool of processes (spawned, as forking a connected client is unsafe)"""
+    return ProcessPoolExecutor(
+        workers, mp_context=get_context("spawn"), initializer=_init_worker
+    )
+
+
+def _rescore_shard(team_ids: List[ObjectId]) -> Dict[ObjectId, float]:
+    global _worker_references
+    if _worker_references is None:
+        _worker_references = _ReferenceSeries.load()
+    return rescore_teams(team_ids, references=_worker_references)
+
+
+def rescore_competition(
+    workers: Optional[int] = RESCORE_WORKERS, shard_size: int = RESCORE_SHARD_SIZE
+) -> Iterator[Tuple[int, int]]:
+    """Rescores every team, shard_size teams at a time, over a pool of workers
+    processes (one per core if None; 0 rescores in this process instead)
+    Yields how many teams have been rescored, and of how many, as it goes.
+    The pooled processes connect to the database as configure_db() does."""
+    team_ids = [team.id for team in Team.find(fields=["name"])]
+    shards = [
+        team_ids[start : start + shard_size]
+        for start in range(0, len(team_ids), shard_size)
+    ]
+    done = 0
+    yield done, len(team_ids)
+    if workers == 0:
+        references = _ReferenceSeries.load()
+        for shard in shards:
+            done += len(rescore_teams(shard, references=references))
+            yield done, len(team_ids)
+        return
+    with _rescoring_pool(workers) as pool:
+        for future in as_completed(pool.submit(_rescore_shard, s) for s in shards):
+            done += len(future.result())
+            yield done, len(team_ids)
+
+
+def check_scores() -> Dict[ObjectId, Tuple[float, float]]:
+    """Finds the teams whose score is not the sum of their data's scores
+    Returns the score and that sum of each, by id."""
+    rawscores = {
+        total["_id"]: total["rawscore"]
+        for total in DataPoint.collection.aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": "$" + DataPoint.field_path("team_reference"),
+                        "rawscore": {"$sum": "$" + DataPoint.field_path("rawscore")},
+                    }
+                }
+            ]
+        )
+    }
+    mismatched = {}
+    for team in Team.find(fields=["health", "multiplier"]):
+        total = rawscores.get(team.id, 0.0) * team.multiplier.amount
+        if not isclose(team.score, total, rel_tol=1e-9, abs_tol=1e-6):
+            mismatched[team.id] = (team.score, total)
+    return mismatched
+
+
+class RescoreRun(PyMongoModel):
+    """A competition-wide rescore running in the background, and how far it
+    has got (so that any server process can report on it)"""
+
+    indexes = [
+        # Only one run may be going at a time:
+        ModelIndex("finished", unique=True, partial={"finished": datetime.min}),
+    ]
+
+    started: datetime
+    updated: datetime
+    finished: datetime  # datetime.min until it has
+    done: int
+    teams: int
+    mismatched: List[str]  # Teams whose scores did not add up afterwards
+    error: str
+
+    def __init__(self):
+        super().__init__()
+        self.started = datetime.now()
+        self.updated = self.started
+        self.finished = datetime.min
+        self.done = 0
+        self.teams = 0
+        self.mismatched = []
+        self.error = ""
+
+    @property
+    def running(self) -> bool:
+        """Whether this is still going (and has not died)"""
+        stale = timedelta(seconds=RESCORE_STALE_AFTER)
+        return self.finished == datetime.min and datetime.now() - self.updated < stale
+
+    @classmethod
+    def latest(cls) -> Optional["RescoreRun"]:
+        return cls.find_one({}, sort=[("started", -1)])
+
+    @classmethod
+    def start(cls, workers: Optional[int] = RESCORE_WORKERS) -> Optional["RescoreRun"]:
+        """Starts rescoring the competition in a background thread of this
+        process (and in a pool of others), unless that is already going
+        Returns the run, or None if another was already running."""
+        # Runs that died are done with:
+        stale = datetime.now() - timedelta(seconds=RESCORE_STALE_AFTER)
+        cls.collection.update_many(
+            cls._map_filter({"finished": datetime.min, "updated": {"$lt": stale}}),
+            {
+                "$set": {
+                    cls.field_path("finished"): datetime.now(),
+                    cls.field_path("error"): "Stopped responding",
+                }
+            },
+        )
+        run = cls()
+        try:
+            run.save()  # (which the index turns away if another is going)
+        except DuplicateKeyError:
+            return None
+        Thread(target=run._follow, args=(workers,), name="rescore", daemon=True).start()
+        return run
+
+    def _follow(self, workers: Optional[int]):
+        """Rescores the competition, recording the progress and the outcome"""
+        try:
+            for self.done, self.teams in rescore_competition(workers):
+                self.updated = datetime.now()
+                self.save()
+            mismatched = check_scores()
+            self.mismatched = [
+                team.name
+                for team in Team.find(
+                    {"_id": {"$in": list(mismatched)}}, fields=["name"]
+                )
+            ]
+        except Exception as e:
+            logging.exception("Could not rescore the competition")
+            self.error = str(e) or type(e).__name__
+        self.finished = self.updated = datetime.now()
+        self.save()
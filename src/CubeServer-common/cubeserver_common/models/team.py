@@ -2,18 +2,28 @@
 
 import logging
 import secrets
+from hashlib import sha256
 from enum import Enum, unique
 from math import ceil
-from typing import Any, List, Optional
+from typing import Any, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.client_session import ClientSession
 
 from cubeserver_common import config
 from cubeserver_common.models.user import User
-from cubeserver_common.models.utils import Encodable, PyMongoModel
+from cubeserver_common.models.utils import (
+    Encodable,
+    ModelIndex,
+    PyMongoModel,
+    TTLCache,
+)
 
 from .config.conf import Conf
 from .mail import Message
 
-__all__ = ["TeamLevel", "TeamStatus", "TeamHealth", "Team"]
+__all__ = ["TeamLevel", "TeamStatus", "TeamHealth", "TeamCredentials", "Team"]
 
 
 def _filter_nonetype_from_list(l: list[Any]) -> list:
@@ -126,6 +136,33 @@ class TeamHealth(Encodable):
         return health
 
 
+class TeamCredentials(NamedTuple):
+    """What it takes to authenticate (and authorize) a team's api requests,
+    and to score the data that they post"""
+
+    id: ObjectId
+    name: str
+    secret: str
+    status: TeamStatus
+    weight_class: Optional[TeamLevel]
+    is_reference: bool
+    multiplier: float
+
+    @classmethod
+    def of(cls, team: "Team") -> "TeamCredentials":
+        """Takes the credentials from a team loaded with (at least) the
+        fields in Team.CREDENTIAL_FIELDS"""
+        return cls(
+            team.id,
+            team.name,
+            team.secret,
+            team.status,
+            team.weight_class,
+            team.is_reference,
+            team.multiplier.amount,
+        )
+
+
 class Team(PyMongoModel):
     """Models a team"""
 
@@ -133,6 +170,32 @@ class Team(PyMongoModel):
         config.REFERENCE_TEAM_NAME.format(i) for i in range(10)
     ]
 
+    indexes = [
+        # Every API request looks this up (partial, so that it may be
+        # migrated to flat storage; see utils.migration):
+        ModelIndex("name", unique=True, partial={"name": {"$gt": ""}}),
+        ModelIndex("status"),
+        ModelIndex("weight_class"),
+    ]
+
+    name: str
+    weight_class: Optional[TeamLevel]
+    _members: List[ObjectId]
+    status: TeamStatus
+    health: TeamHealth
+    secret: str
+    multiplier: Multiplier
+    emails_sent: int
+    _code_update: bytes
+    code_update_taken: bool
+
+    CREDENTIAL_FIELDS = ["name", "secret", "status", "weight_class", "multiplier"]
+    """The fields that TeamCredentials are made from"""
+
+    # Recently looked-up TeamCredentials, by team name (kept by each process,
+    # so an edit made elsewhere, e.g. by an admin, is seen within the TTL):
+    _credentials = TTLCache(config.TEAM_AUTH_CACHE_SIZE, config.TEAM_AUTH_CACHE_TTL)
+
     @classmethod
     def _gen_secret(cls, length: int) -> str:
         """Generates a crypto-safe secret of the length defined by
@@ -219,14 +282,55 @@ class Team(PyMongoModel):
         return all([user.verified for user in self.members])
 
     @classmethod
-    def find_by_name(cls, name):
-        """Returns the first known team with that name"""
-        return super().find_one({"name": name})
+    def find_by_name(cls, name, fields: Optional[List[str]] = None):
+        """Returns the first known team with that name
+        Optionally load only the given fields (see PyMongoModel.find)"""
+        return super().find_one({"name": name}, fields=fields)
+
+    @classmethod
+    def credentials(cls, name: str) -> Optional[TeamCredentials]:
+        """Returns the credentials of the team with that name, if any
+        These are cached for config.TEAM_AUTH_CACHE_TTL seconds, or until
+        the team is saved or removed by this process; the TTL bounds how long
+        other processes (e.g. the api workers, when an admin edits a team in
+        the app) go on accepting stale credentials."""
+        credentials = cls._credentials.get(name)
+        if credentials is None:
+            team = cls.find_by_name(name, fields=cls.CREDENTIAL_FIELDS)
+            if team is None:
+                return None
+            credentials = TeamCredentials.of(team)
+            cls._credentials.put(name, credentials)
+        return credentials
+
+    @classmethod
+    def forget_credentials(cls, team_ids: Iterable[ObjectId]):
+        """Drops the cached credentials of the given teams"""
+        team_ids = set(team_ids)
+        cls._credentials.discard_where(lambda credentials: credentials.id in team_ids)
+
+    def save(self, session: Optional[ClientSession] = None):
+        """Saves the team, dropping any cached credentials"""
+        super().save(session=session)
+        Team.forget_credentials([self._id])
 
     @classmethod
-    def find_by_division(cls, division: TeamLevel):
+    def save_many(cls, models, session: Optional[ClientSession] = None):
+        """Saves many teams, dropping any cached credentials"""
+        models = list(models)
+        failures = super().save_many(models, session=session)
+        cls.forget_credentials(model._id for model in models)
+        return failures
+
+    def remove(self):
+        """Removes the team, dropping any cached credentials"""
+        super().remove()
+        Team.forget_credentials([self._id])
+
+    @classmethod
+    def find_by_division(cls, division: TeamLevel, fields: Optional[List[str]] = None):
         """Returns teams with a given division"""
-        return super().find({"weight_class": division.value})
+        return super().find({"weight_class": division.value}, fields=fields)
 
     @property
     def id_2(self):
@@ -254,9 +358,15 @@ class Team(PyMongoModel):
     @classmethod
     def reset_sent_emails(cls):
         """Resets the email send counter for the day"""
-        for team in cls.find():
+
+        def reset(team: "Team") -> "Team":
             team.emails_sent = 0
-            team.save()
+            return team
+
+        for team, error in cls.save_many(
+            reset(team) for team in cls.iter_find(fields=["emails_sent"])
+        ):
+            logging.error(f"Failed to reset the email count of {team.id}: {error}")
 
     def update_code(self, code: bytes):
         """Uploads a string of python code to be transferred to the cube"""
@@ -265,10 +375,34 @@ class Team(PyMongoModel):
         self.save()
 
     def get_code_update(self) -> bytes:
-        """Grabs the latest code update given by the team"""
-        self.code_update_taken = True
-        self.save()
-        return self._code_update
+        """Grabs the latest code update given by the team, marking it taken
+        (which only writes to the database if it was not taken already)"""
+        return self.poll_code_update()[0]
+
+    def poll_code_update(self) -> Tuple[bytes, bool]:
+        """Grabs the latest code update given by the team, as get_code_update()
+        does, along with whether it was this call that took it (so that of
+        many concurrent polls, only one finds it new)"""
+        taken = False
+        if not self.code_update_taken:
+            taken = Team.take_code_update(self._id)
+            self._sync_field("code_update_taken", True)
+        return self._code_update, taken
+
+    @classmethod
+    def take_code_update(cls, team_id: ObjectId) -> bool:
+        """Atomically marks a team's code update taken, if it is not already
+        Returns whether it was this call that took it."""
+        result = cls.collection.update_one(
+            cls._map_filter({"_id": team_id, "code_update_taken": False}),
+            {"$set": {cls.field_path("code_update_taken"): True}},
+        )
+        return result.modified_count == 1
+
+    @staticmethod
+    def code_update_etag(code: bytes) -> str:
+        """A hash of a code update, for use in ETags"""
+        return sha256(code).hexdigest()[:32]
 
     @classmethod
     def find_beacon(cls) -> "Team":
@@ -341,14 +475,104 @@ class Team(PyMongoModel):
             "The entire reserved port range for reference servers has already been assigned."
         )
 
+    @classmethod
+    def _score_update(cls, new_score: Any) -> list:
+        """The update pipeline that sets a team's score, moving the current
+        score to lastScore"""
+        score = cls.field_path("health.score")
+        return [
+            {
+                "$set": {
+                    cls.field_path("health.lastScore"): "$" + score,
+                    score: new_score,
+                }
+            }
+        ]
+
+    @classmethod
+    def _update_score(
+        cls, team_id: ObjectId, new_score: Any, session: Optional[ClientSession] = None
+    ) -> Optional[TeamHealth]:
+        """Atomically sets a team's score to the given aggregation expression,
+        moving the current score to lastScore.
+        Returns the new health, or None if there is no such team"""
+        document = cls.collection.find_one_and_update(
+            {"_id": team_id},
+            cls._score_update(new_score),
+            projection={"health": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+        if document is None:
+            return None
+        health = cls.decode_partial(document, ["health"]).health
+        logging.debug(f"Set score from {health.last_score} to {health.score}")
+        return health
+
+    @classmethod
+    def set_scores(
+        cls,
+        scores: Mapping[ObjectId, float],
+        session: Optional[ClientSession] = None,
+        previous: Optional[Mapping[ObjectId, float]] = None,
+    ):
+        """Sets the scores of many teams in one write (each as
+        _update_score() would)
+        previous may give the score that each new score was worked out from;
+        a team whose score has changed since (e.g. it has scored another
+        point meanwhile) has its score changed by the difference instead, so
+        that the change is kept."""
+        if not scores:
+            return
+        current = "$" + cls.field_path("health.score")
+        updates = []
+        for team_id, score in scores.items():
+            if previous is not None and team_id in previous:
+                was = previous[team_id]
+                score = {
+                    "$cond": [
+                        {"$eq": [current, was]},
+                        score,
+                        {"$add": [current, score - was]},
+                    ]
+                }
+            updates.append(UpdateOne({"_id": team_id}, cls._score_update(score)))
+        cls.collection.bulk_write(updates, ordered=False, session=session)
+
+    @classmethod
+    def adjust_score(
+        cls, team_id: ObjectId, amt: float, session: Optional[ClientSession] = None
+    ) -> Optional[TeamHealth]:
+        """Atomically changes a team's score by a given amount, without
+        reading or rewriting the rest of the team document.
+        Returns the new health, or None if there is no such team"""
+        return cls._update_score(
+            team_id,
+            {"$add": ["$" + cls.field_path("health.score"), amt]},
+            session=session,
+        )
+
+    def change_score(self, amt: float):
+        """Atomically changes this team's score by a given amount"""
+        health = Team.adjust_score(self._id, amt)
+        if health is not None:
+            self._sync_field("health", health)
+
+    def reset_score(self):
+        """Atomically resets this team's score to 0"""
+        logging.debug("Resetting score")
+        health = Team._update_score(self._id, 0)
+        if health is not None:
+            self._sync_field("health", health)
+
     def recompute_score(self):
         """Completely recompute the score for this team.
         This can be risky.
         """
-        from cubeserver_common.models.datapoint import DataPoint
+        from cubeserver_common.models.rescoring import rescore_teams
 
         logging.debug("Re-evaluating team score.")
-        self.health.reset()
-        self.save()
-        for data in DataPoint.find_by_team(self):
-            data.recalculate_score(0)
+        rescore_teams([self._id])
+        team = Team.find_by_id(self._id, fields=["health"])
+        if team is not None:
+            self._sync_field("health", team.health)
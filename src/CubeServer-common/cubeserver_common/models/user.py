@@ -8,7 +8,7 @@ from bcrypt import hashpw, gensalt, checkpw
 from flask_login import UserMixin
 from secrets import token_urlsafe
 
-from cubeserver_common.models.utils import PyMongoModel
+from cubeserver_common.models.utils import ModelIndex, PyMongoModel
 from cubeserver_common.models.mail import Message
 from cubeserver_common.models.config.conf import Conf
 from cubeserver_common import config
@@ -46,6 +46,20 @@ class UserActivation(Enum):
 class User(PyMongoModel, UserMixin):
     """Models a user"""
 
+    indexes = [
+        # (partial, so that it may be migrated to flat storage):
+        ModelIndex("name", unique=True, partial={"name": {"$gt": ""}}),
+        ModelIndex("email"),
+    ]
+
+    name: str
+    email: str
+    verified: bool
+    _verification_token_raw: str
+    pwd: bytes
+    level: UserLevel
+    activated: UserActivation
+
     def __init__(
         self,
         name: str = "",
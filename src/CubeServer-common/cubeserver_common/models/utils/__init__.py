@@ -6,3 +6,12 @@ from .dummycodec import DummyCodec
 from .complexdictcodec import ComplexDictCodec
 
 from .modelutils import PyMongoModel, Encodable, EncodableCodec
+from .indexes import (
+    ModelIndex,
+    all_models,
+    reconcile_indexes,
+    reconcile_all_indexes,
+    index_report,
+)
+from .migration import migrate_to_flat
+from .ttlcache import TTLCache
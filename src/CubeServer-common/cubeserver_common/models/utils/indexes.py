@@ -0,0 +1,167 @@
+"""Declarative indexes for PyMongoModel collections
+
+Models list their indexes in terms of their own field names:
+
+    class DataPoint(PyMongoModel):
+        indexes = [
+            ModelIndex("team_reference", ("moment", DESCENDING)),
+        ]
+
+and reconcile_indexes() makes the collection match at startup.
+"""
+
+import logging
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Type
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .modelutils import PyMongoModel, all_models
+
+__all__ = [
+    "ModelIndex",
+    "all_models",
+    "reconcile_indexes",
+    "reconcile_all_indexes",
+    "index_report",
+]
+
+
+class ModelIndex:
+    """Describes an index on a model's collection
+
+    Keys are field names (or (field name, direction) pairs); they are mapped
+    to the paths the fields are stored under in the model's storage layout,
+    as is the partial filter expression."""
+
+    def __init__(
+        self,
+        *keys: str | Tuple[str, Any],
+        name: Optional[str] = None,
+        unique: bool = False,
+        partial: Optional[Mapping[str, Any]] = None,
+        expire_after: Optional[int] = None,
+    ):
+        if not keys:
+            raise ValueError("An index needs at least one key")
+        self.fields: List[Tuple[str, Any]] = [
+            (key, ASCENDING) if isinstance(key, str) else tuple(key) for key in keys
+        ]
+        self.name = name or "_".join(
+            f"{field}_{direction}" for field, direction in self.fields
+        )
+        self.unique = unique
+        self.partial = partial
+        self.expire_after = expire_after
+
+    def keys(self, model: Type[PyMongoModel]) -> List[Tuple[str, Any]]:
+        """The index keys, as stored in the model's collection"""
+        return [
+            (model.field_path(field), direction) for field, direction in self.fields
+        ]
+
+    def partial_filter(self, model: Type[PyMongoModel]) -> Optional[dict]:
+        """The partial filter expression, as stored in the model's collection"""
+        if not self.partial:
+            return None
+        return {model.field_path(field): value for field, value in self.partial.items()}
+
+    def options(self, model: Type[PyMongoModel]) -> Dict[str, Any]:
+        """The keyword arguments for Collection.create_index()"""
+        options = {"name": self.name}
+        if self.unique:
+            options["unique"] = True
+        if self.partial:
+            options["partialFilterExpression"] = self.partial_filter(model)
+        if self.expire_after is not None:
+            options["expireAfterSeconds"] = self.expire_after
+        return options
+
+    def matches(self, info: Mapping[str, Any], model: Type[PyMongoModel]) -> bool:
+        """Returns True if an existing index (as described by
+        Collection.index_information()) is the same as this one"""
+        return (
+            [(key, _direction(d)) for key, d in info["key"]]
+            == [(key, _direction(d)) for key, d in self.keys(model)]
+            and bool(info.get("unique")) == self.unique
+            and info.get("partialFilterExpression") == self.partial_filter(model)
+            and info.get("expireAfterSeconds") == self.expire_after
+        )
+
+    def __repr__(self) -> str:
+        return f"ModelIndex({self.name})"
+
+
+def _direction(direction: Any) -> Any:
+    """The server may report numeric directions as floats"""
+    return int(direction) if isinstance(direction, (int, float)) else direction
+
+
+def reconcile_indexes(model: Type[PyMongoModel]) -> List[str]:
+    """Creates the declared indexes of a model that are missing from its
+    collection, and rebuilds any whose definition has changed.
+    This is idempotent; it returns the names of the indexes it created."""
+    existing = model.collection.index_information()
+    created = []
+    for index in model.indexes:
+        info = existing.get(index.name)
+        if info is not None:
+            if index.matches(info, model):
+                continue
+            logging.info(f"Rebuilding changed index {index.name} on {model.__name__}")
+            model.collection.drop_index(index.name)
+        model.collection.create_index(index.keys(model), **index.options(model))
+        created.append(index.name)
+    return created
+
+
+def reconcile_all_indexes() -> Dict[str, List[str]]:
+    """Reconciles the indexes of every model that declares some
+    A failure is logged rather than raised, so that one bad index (e.g. a
+    unique index over existing duplicates) cannot keep the server down."""
+    created = {}
+    for model in all_models():
+        if not model.indexes:
+            continue
+        try:
+            created[model.__name__] = reconcile_indexes(model)
+        except PyMongoError as e:
+            logging.error(f"Could not reconcile indexes for {model.__name__}: {e}")
+            continue
+        if created[model.__name__]:
+            logging.info(
+                f"Created indexes on {model.__name__}: "
+                f"{', '.join(created[model.__name__])}"
+            )
+    return created
+
+
+def index_report(model: Type[PyMongoModel]) -> Dict[str, List[str]]:
+    """Compares a model's declared indexes with those in its collection
+
+    Returns the names of indexes that are...
+        * missing - declared, but not (correctly) built
+        * undeclared - built, but not declared by the model
+        * unused - built, but never used since the server started
+            (only if the server can report index usage)
+    """
+    existing = model.collection.index_information()
+    declared = {index.name: index for index in model.indexes}
+    report = {
+        "missing": [
+            name
+            for name, index in declared.items()
+            if name not in existing or not index.matches(existing[name], model)
+        ],
+        "undeclared": [
+            name for name in existing if name != "_id_" and name not in declared
+        ],
+        "unused": [],
+    }
+    try:
+        for stats in model.collection.aggregate([{"$indexStats": {}}]):
+            if stats["name"] != "_id_" and stats["accesses"]["ops"] == 0:
+                report["unused"].append(stats["name"])
+    except (OperationFailure, NotImplementedError):
+        logging.debug(f"Index usage is unavailable for {model.__name__}")
+    return report
@@ -0,0 +1,171 @@
+"""Converting collections to the FLAT storage layout
+
+The conversion runs while the servers keep serving requests:
+
+    0. Each of the model's indexes is built on the flat paths as well
+        (alongside the one on the wrapped paths), so that documents are
+        indexed, and held unique, from the moment they are converted.
+    1. The collection is marked MIGRATING; once every worker has noticed
+        (see SCHEMA_REFRESH), queries match both layouts, and decode()
+        reads either one.
+    2. Documents are converted a batch at a time. Each one is replaced
+        only if it is unchanged since it was read, so concurrent writes
+        are never lost (a document that changed is picked up again later).
+    3. The collection is marked FLAT, and any documents that were written
+        wrapped in the meantime are converted as well. Each declared index
+        is then rebuilt on the flat paths under its own name, in place of
+        its copy from step 0.
+
+A unique index must be partial, with a filter that documents stored in the
+other layout never match (e.g. {"name": {"$gt": ""}}, which no wrapped
+"name" does); otherwise every document in one layout would share the same
+(missing) key in the other layout's index.
+"""
+
+import logging
+from time import sleep
+from typing import Any, Dict, Tuple, Type
+
+from pymongo import ASCENDING, ReplaceOne
+
+from .indexes import ModelIndex
+from .modelutils import (
+    FLAT,
+    MIGRATING,
+    SCHEMA_REFRESH,
+    PyMongoModel,
+    _is_wrapped,
+    _split_field,
+)
+
+__all__ = ["migrate_to_flat"]
+
+
+def _flatten(document: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """Converts a wrapped document, returning it with its field types"""
+    flat = {"_id": document["_id"]}
+    types = {}
+    for field, stored in document.items():
+        if field == "_id":
+            continue
+        types[field], flat[field] = _split_field(stored)
+    return flat, types
+
+
+def _flat_name(index: ModelIndex) -> str:
+    """The name of the copy of an index that is built on the flat paths"""
+    return f"{index.name}_flat"
+
+
+def _build_flat_indexes(model: Type[PyMongoModel]):
+    """Builds a copy of each of a model's indexes on the flat paths"""
+    for index in model.indexes:
+        options = index.options(model)
+        options["name"] = _flat_name(index)
+        if index.partial:
+            options["partialFilterExpression"] = dict(index.partial)
+        model.collection.create_index(index.fields, **options)
+
+
+def _replace_flat_indexes(model: Type[PyMongoModel]):
+    """Rebuilds each of a model's indexes on the flat paths under its own
+    name, in place of its copy
+    The copy has to be dropped first, since the server refuses to build a
+    second index with the same keys and options; a unique index goes
+    unenforced only while its replacement is being built."""
+    existing = model.collection.index_information()
+    for index in model.indexes:
+        info = existing.get(index.name)
+        if info is not None and index.matches(info, model):
+            continue
+        if info is not None:
+            model.collection.drop_index(index.name)
+        if _flat_name(index) in existing:
+            model.collection.drop_index(_flat_name(index))
+        model.collection.create_index(index.keys(model), **index.options(model))
+
+
+def _convert_pass(
+    model: Type[PyMongoModel], batch_size: int, pause: float
+) -> Tuple[int, int]:
+    """Walks the collection in _id order, converting wrapped documents
+    Returns the number of documents converted and the number that changed
+    before they could be."""
+    converted = 0
+    missed = 0
+    last_id = None
+    while True:
+        batch = list(
+            model.collection.find(
+                {} if last_id is None else {"_id": {"$gt": last_id}},
+                sort=[("_id", ASCENDING)],
+                limit=batch_size,
+            )
+        )
+        if not batch:
+            return converted, missed
+        last_id = batch[-1]["_id"]
+
+        operations = []
+        types = {}
+        for document in batch:
+            if not any(
+                _is_wrapped(value)
+                for field, value in document.items()
+                if field != "_id"
+            ):
+                continue
+            flat, document_types = _flatten(document)
+            types.update(document_types)
+            # Matching the whole document makes this a compare-and-swap:
+            operations.append(ReplaceOne(document, flat))
+        if operations:
+            model.update_schema(fields=types)
+            result = model.collection.bulk_write(operations, ordered=False)
+            converted += result.modified_count
+            missed += len(operations) - result.matched_count
+        if pause:
+            sleep(pause)
+
+
+def migrate_to_flat(
+    model: Type[PyMongoModel],
+    batch_size: int = 500,
+    pause: float = 0.1,
+    settle: float = SCHEMA_REFRESH,
+) -> int:
+    """Converts a model's collection to the FLAT storage layout
+    batch_size documents are converted at a time, pausing between batches
+    to go easy on the database; settle is how long to wait for every
+    server to notice a change of layout.
+    Returns the number of documents converted."""
+    if not model.flat_storage:
+        raise ValueError(f"{model.__name__} has not opted in to flat storage")
+    for index in model.indexes:
+        if index.unique and not index.partial:
+            raise ValueError(
+                f"The unique index {index.name} must be partial to be migrated"
+            )
+
+    logging.info(f"Converting {model.__name__} to flat storage")
+    if model.storage_layout() != FLAT:
+        _build_flat_indexes(model)
+    model.update_schema(layout=MIGRATING)
+    sleep(settle)
+    converted, _ = _convert_pass(model, batch_size, pause)
+
+    model.update_schema(layout=FLAT)
+    sleep(settle)
+    # Catch documents that were changed mid-conversion, or written wrapped
+    # by servers that had yet to notice the new layout:
+    while True:
+        more, missed = _convert_pass(model, batch_size, pause)
+        converted += more
+        if not missed:
+            break
+        logging.info(f"Retrying {missed} documents that changed while converting")
+
+    # Indexes are on the stored paths, which have now changed:
+    _replace_flat_indexes(model)
+    logging.info(f"Converted {converted} {model.__name__} documents")
+    return converted
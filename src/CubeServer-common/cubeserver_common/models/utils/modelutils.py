@@ -1,21 +1,73 @@
 """Some utility classes to help with object mapping"""
 
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from copy import deepcopy
+from datetime import datetime
 from enum import Enum
-from typing import Any, List, Mapping, Optional, Tuple, Type, cast
+from functools import cache
+from types import MappingProxyType, UnionType
+from typing import (
+    Any,
+    ClassVar,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+    cast,
+    get_args,
+    get_origin,
+    get_type_hints,
+)
 from pydoc import locate
+from time import monotonic
 import warnings
 from bson import ObjectId
 from json import loads
 from bson import _BUILT_IN_TYPES as BSON_TYPES
 from bson.codec_options import TypeCodec, TypeRegistry
-from pymongo import MongoClient, ASCENDING, DESCENDING
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient, ASCENDING, DESCENDING, InsertOne, ReplaceOne, UpdateOne
+from pymongo.client_session import ClientSession
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, PyMongoError
 
 from .dummycodec import DummyCodec
 from .enumcodec import EnumCodec
 
-__all__ = ["PyMongoModel", "Encodable", "EncodableCodec", "ASCENDING", "DESCENDING"]
+__all__ = [
+    "PyMongoModel",
+    "Encodable",
+    "EncodableCodec",
+    "UnloadedFieldError",
+    "all_models",
+    "WRAPPED",
+    "MIGRATING",
+    "FLAT",
+    "ASCENDING",
+    "DESCENDING",
+]
+
+
+WRAPPED = "wrapped"
+"""Storage layout with every field stored as {"_type": ..., "_val": ...}"""
+MIGRATING = "migrating"
+"""Storage layout of a collection partway through conversion to FLAT"""
+FLAT = "flat"
+"""Storage layout with plain field values (types are kept in the schema)"""
+
+SCHEMA_COLLECTION = "modelschemas"
+"""Holds the storage layout and field types of flat-storage collections"""
+SCHEMA_REFRESH = 10
+"""How long (in seconds) a cached collection schema is trusted"""
+
+_IMMUTABLE_TYPES = (str, int, float, bool, bytes, type(None), Enum, datetime, ObjectId)
+"""Field values of these types can only change by being assigned"""
 
 
 def _locatable_name(type_to_name: type) -> str:
@@ -26,6 +78,71 @@ def _locatable_name(type_to_name: type) -> str:
     return module + "." + type_to_name.__name__
 
 
+@cache
+def _locate(type_name: str) -> Any:
+    """A memoized pydoc.locate() for the `_type` strings stored in documents"""
+    return locate(type_name)
+
+
+def _split_field(stored: Any) -> Tuple[str, Any]:
+    """Splits a stored field into its type name and value
+
+    Fields are normally stored as {"_type": ..., "_val": ...}, but older
+    documents may hold (type name, value) pairs or plain values."""
+    if isinstance(stored, dict) and "_type" in stored:
+        field_type_name = stored["_type"]
+        val = stored["_val"]
+    else:
+        try:
+            field_type_name, val = stored
+            if field_type_name != "None":
+                if not isinstance(field_type_name, str) or "." not in field_type_name:
+                    field_type_name, val = ("None", stored)
+        except (ValueError, TypeError):
+            field_type_name, val = ("None", stored)
+    if (
+        field_type_name == "None"
+        and isinstance(val, list)
+        and len(val) == 2
+        and val[0] == "None"
+    ):
+        val = val[1]
+    return field_type_name, val
+
+
+def _is_wrapped(stored: Any) -> bool:
+    """Returns True if a stored field is in the {"_type", "_val"} form"""
+    return isinstance(stored, dict) and "_type" in stored
+
+
+def _unshared(val: Any) -> Any:
+    """Copies mutable raw values so that decoded objects don't share them
+    with the document they came from"""
+    if isinstance(val, (list, dict)):
+        return deepcopy(val)
+    return val
+
+
+def _inflate(value: Any) -> Any:
+    """Converts RawBSONDocuments (including nested ones) to plain dicts"""
+    if isinstance(value, RawBSONDocument):
+        return {key: _inflate(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_inflate(item) for item in value]
+    return value
+
+
+@cache
+def _supports_transactions(client: MongoClient) -> bool:
+    """Whether a client is connected to a deployment that supports
+    transactions (a replica set or a sharded cluster)"""
+    try:
+        hello = client.admin.command("hello")
+    except (PyMongoError, NotImplementedError):  # (e.g. mongomock)
+        return False
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+
 def value_ref(key):
     """Adds in ._val reference to keys"""
     if key == "_id":
@@ -54,6 +171,22 @@ def map_sort(s):
     return [(value_ref(k), d) for k, d in s]
 
 
+def map_projection(fields):
+    """Builds a projection that loads only the given fields
+    (plus the type information needed to decode them)"""
+    projection = {}
+    for field in fields:
+        if field == "_id":
+            continue
+        projection[value_ref(field)] = 1
+        projection[f"{field.split('.', 1)[0]}._type"] = 1
+    return projection
+
+
+class UnloadedFieldError(AttributeError):
+    """Raised when accessing a field that was left out of a projection"""
+
+
 class _Encoder(ABC):
     @abstractmethod
     def encode(self) -> dict:
@@ -114,20 +247,70 @@ class Encodable(_Encoder):
         return self.encode() == __value.encode()
 
 
+def _codec_for(annotation: Any) -> Optional[TypeCodec]:
+    """Picks the TypeCodec for a field from its type annotation
+    (None for values that bson can store as they are)"""
+    if get_origin(annotation) in (Union, UnionType):
+        members = [arg for arg in get_args(annotation) if arg is not type(None)]
+        if len(members) != 1:  # Only stored raw; there's no single codec
+            return None
+        annotation = members[0]
+    if (
+        annotation is Any
+        or get_origin(annotation) is not None  # e.g. List[str]
+        or annotation in BSON_TYPES
+    ):
+        return None
+    if isinstance(annotation, type):
+        if issubclass(annotation, Encodable):
+            return EncodableCodec(annotation)
+        if issubclass(annotation, Enum):
+            return EnumCodec(annotation)
+    raise TypeError(
+        f"No TypeCodec can be inferred for type {annotation}. "
+        f"Please specify one in field_codecs."
+    )
+
+
 class PyMongoModel(Encodable):  # TODO: Clean up some code by making an
     #  AutoEncodable superclass that implements
     #  encode() and decode() for non-document
     #  objects.
     """A class for easy object-mapping to bson.
-    Extend this class for any classes that describe a type of document."""
+    Extend this class for any classes that describe a type of document.
+
+    The fields of a document are declared with class annotations:
+
+        class Team(PyMongoModel):
+            name: str
+            weight_class: Optional[TeamLevel]
+            health: TeamHealth
+
+    Codecs are inferred for Encodable and Enum fields; field_codecs overrides
+    them. The schema is fixed when the class is defined and cannot change
+    afterwards, so models can be shared between threads; other attributes
+    may still be set on instances, but they are not saved."""
 
     mongo: Optional[MongoClient] = None
 
+    indexes: list = []
+    """The ModelIndexes to build on this model's collection (see .indexes)"""
+
+    flat_storage: bool = False
+    """Set to True to opt in to the FLAT storage layout; existing
+    collections are converted with .migration.migrate_to_flat()"""
+
+    field_codecs: Mapping[str, TypeCodec] = {}
+    """TypeCodecs for fields whose codec cannot be (correctly) inferred"""
+
     @classmethod
     def update_mongo_client(cls, mongo_client: Optional[MongoClient]):
         """Sets the MongoClient reference in PyMongoModel, which is then
-        used by any models that extend this class."""
+        used by any models that extend this class (models that were defined
+        already, e.g. by imports, are bound to the new client's database)"""
         cls.mongo = mongo_client
+        for model in all_models():
+            model.set_collection_name(model._collection_name)
 
     @property
     @classmethod
@@ -146,6 +329,8 @@ class PyMongoModel(Encodable):  # TODO: Clean up some code by making an
     def set_collection_name(cls, collection_name: str):
         """Define the Mongodb collection in your class.
         Use the PyMongoModel.model_type_registry as the type registry."""
+        cls._collection_name = collection_name
+        cls._schema_cache = None  # (that of the previous collection)
         try:
             cls.collection = PyMongoModel.mongo.db.get_collection(collection_name)
         except AttributeError:
@@ -163,25 +348,126 @@ class PyMongoModel(Encodable):  # TODO: Clean up some code by making an
                 "Sphinx-api build process."
             )
 
-        cls._ignored: List[str] = [
-            "_id",
-            "type_codec",
-            "_codecs",
-            "_fields",
-            "_ignored",
-        ]
+        # The declared fields and their corresponding TypeCodecs, and the
+        # TypeCodecs by type; these are read-only, and never change:
+        cls._fields, cls._codecs = cls._declared_schema()
+
+        # The compiled decode plan; (field name, `_type` string) -> codec:
+        cls._decode_plan: Mapping[Tuple[str, str], Optional[TypeCodec]] = (
+            MappingProxyType(
+                {
+                    (field_name, _locatable_name(codec.python_type)): codec
+                    for field_name, codec in cls._fields.items()
+                    if codec is not None
+                }
+            )
+        )
 
-        # Registered TypeCodecs:
-        cls._codecs: Mapping[type, TypeCodec] = {}
+        # The cached collection schema, with the time it was fetched:
+        cls._schema_cache: Optional[Tuple[float, dict]] = None
 
-        # Registered fields and their corresponding TypeCodecs:
-        # (None is an acceptable codec for directly bson-compatible types)
-        cls._fields: Mapping[str, Optional[TypeCodec]] = {}
+        # A default-constructed instance for lazily loaded objects:
+        cls._lazy_prototype: Optional[PyMongoModel] = None
 
         cls.set_collection_name(cls.__name__.lower())
 
         super().__init_subclass__()
 
+    @classmethod
+    def _declared_schema(
+        cls,
+    ) -> Tuple[Mapping[str, Optional[TypeCodec]], Mapping[type, TypeCodec]]:
+        """Reads the fields and their TypeCodecs from the class annotations,
+        along with the inferred TypeCodecs by type
+        (None is an acceptable codec for directly bson-compatible types)"""
+        hints = get_type_hints(cls)
+        fields: Dict[str, Optional[TypeCodec]] = {}
+        codecs: Dict[type, TypeCodec] = {}  # (only those that were inferred)
+        for klass in reversed(cls.__mro__):
+            if not issubclass(klass, PyMongoModel) or klass is PyMongoModel:
+                continue
+            for name in klass.__dict__.get("__annotations__", {}):
+                if get_origin(hints[name]) is ClassVar:
+                    continue
+                if name in klass.__dict__:
+                    raise TypeError(
+                        f"{cls.__name__}.{name} is a field; give it a default "
+                        f"value in the constructor rather than on the class"
+                    )
+                if name in cls.field_codecs:
+                    fields[name] = cls.field_codecs[name]
+                else:
+                    fields[name] = _codec_for(hints[name])
+                    if fields[name] is not None:
+                        codecs[fields[name].python_type] = fields[name]
+        return MappingProxyType(fields), MappingProxyType(codecs)
+
+    @classmethod
+    def schema(cls) -> dict:
+        """The storage layout and field types of this model's collection
+        (only flat-storage models have anything stored to look up)"""
+        if not cls.flat_storage:
+            return {"layout": WRAPPED, "fields": {}}
+        cache = cls._schema_cache
+        if cache is None or monotonic() - cache[0] > SCHEMA_REFRESH:
+            document = (
+                PyMongoModel.mongo.db.get_collection(SCHEMA_COLLECTION).find_one(
+                    {"_id": cls.collection.name}
+                )
+                or {}
+            )
+            cache = (
+                monotonic(),
+                {
+                    "layout": document.get("layout", WRAPPED),
+                    "fields": document.get("fields", {}),
+                },
+            )
+            cls._schema_cache = cache
+        return cache[1]
+
+    @classmethod
+    def update_schema(
+        cls, layout: Optional[str] = None, fields: Optional[Mapping[str, str]] = None
+    ):
+        """Records the storage layout and/or field types of the collection"""
+        update = {
+            f"fields.{field}": type_name for field, type_name in (fields or {}).items()
+        }
+        if layout is not None:
+            update["layout"] = layout
+        PyMongoModel.mongo.db.get_collection(SCHEMA_COLLECTION).update_one(
+            {"_id": cls.collection.name}, {"$set": update}, upsert=True
+        )
+        cls._schema_cache = None
+
+    @classmethod
+    def storage_layout(cls) -> str:
+        """WRAPPED, MIGRATING, or FLAT"""
+        return cls.schema()["layout"]
+
+    @classmethod
+    def field_path(cls, key: str) -> str:
+        """The path under which a field (or a dotted path into one) is
+        stored, e.g. for use in aggregation pipelines and indexes
+        (while MIGRATING this is still the wrapped path)"""
+        if cls.storage_layout() == FLAT:
+            return key
+        return value_ref(key)
+
+    @classmethod
+    def _note_schema(cls):
+        """Records the type of every declared field in the schema,
+        so that flat documents can be decoded without the `_type`s"""
+        known = cls.schema()["fields"]
+        new = {}
+        for field, codec in cls._fields.items():
+            type_name = _locatable_name(codec.python_type) if codec else "None"
+            if known.get(field) != type_name:
+                new[field] = type_name
+        if new:
+            cls.update_schema(fields=new)
+
     @abstractmethod
     def __init__(self):
         """Initializes the PyMongoModel overhead"""
@@ -189,22 +475,6 @@ class PyMongoModel(Encodable):  # TODO: Clean up some code by making an
         self._id: Optional[ObjectId] = None
         super().__init__()
 
-    def register_codec(self, type_codec: TypeCodec, replace=False):
-        """Register a TypeCodec for use in the PyMongoModelCodec
-        Specify whether to replace an existing one if applicable,
-        with the default being False."""
-        if type_codec.python_type in self._codecs and not replace:
-            raise KeyError(
-                f"A TypeCodec is already registered"
-                f" for type {type_codec.python_type}"
-            )
-        self._codecs[type_codec.python_type] = type_codec
-
-    def ignore_attribute(self, attr_name: str):
-        """Forces an attribute to be ignored as a document field"""
-        if attr_name not in self._ignored:
-            self._ignored += [attr_name]
-
     def locate_codec(self, data_type: type) -> Optional[TypeCodec]:
         """Tries to find a TypeCodec for the specified type if possible."""
         codec: Optional[TypeCodec] = None
@@ -228,79 +498,71 @@ class PyMongoModel(Encodable):  # TODO: Clean up some code by making an
         value: Optional[Any] = None,
         custom_codec: Optional[TypeCodec] = None,
     ):
-        """Register each attribute of the model for the database.
-        Optionally specify with a custom codec prior to setting the attribute.
-        If a codec is specified optionally here, it will not be automatically
-        registered for use in encoding/decoding attributes of the same type
-        unless register_codec() is used also.
-        The value does not need to be specified ONLY IF a custom_codec is
-        provided.
-        This method returns immediately if a field with the given name is
-        already registered.
-        The force parameter allows you to force the registration of a field
-        despite checks failing or the type appearing to be bson-compatible"""
-
-        if value is not None:  # Also set the value while we're at it:
-            self._setattr_shady(attr_name, value)
-
-        if attr_name in self._fields:
-            return
-        codec = custom_codec
-        # TODO: Check recursively for bson compat- there can be dicts of enums for ex
-        if (
-            codec is None
-            and value is not None
-            and type(value) not in BSON_TYPES
-            and not type(value) in self._codecs
-        ):  # if a TypeCodec is required:
-            # Find or make a TypeCodec for this field:
-            if isinstance(value, Encodable):  # Use the one specified:
-                codec = EncodableCodec(type(value))
-            elif isinstance(value, TypeCodec):
-                codec = value
-            elif isinstance(value, Enum):  # Use the EnumCodec class:
-                codec = EnumCodec(type(value), type(value.value))
-            else:
-                raise TypeError(
-                    f"No TypeCodec is registered for type "
-                    f"{type(value)}, for attribute {attr_name}. "
-                    f"Please register one before setting."
-                )
-            self.register_codec(codec)
-        if codec is None and type(value) in self._codecs:
-            codec = self._codecs[type(value)]
-        self._fields[attr_name] = codec  # Register the field!
-
-    def encode(self) -> dict:
+        """Sets a field, checking that it is declared (with the given codec,
+        if any). Fields are declared with class annotations; this is only
+        kept for older code."""
+        if attr_name not in self._fields:
+            raise TypeError(
+                f"{type(self).__name__} has no field '{attr_name}'; "
+                f"declare it with a class annotation."
+            )
+        declared = self._fields[attr_name]
+        if custom_codec is not None and (
+            declared is None or declared.python_type is not custom_codec.python_type
+        ):
+            raise TypeError(
+                f"The field '{attr_name}' is declared with a different codec; "
+                f"specify it in field_codecs instead."
+            )
+        if value is not None:
+            setattr(self, attr_name, value)
+
+    def _encode_field(
+        self, field: str, codec: Optional[TypeCodec], flat: bool = False
+    ) -> Any:
+        """Encodes the value of a single field"""
+        value = getattr(self, field)
+        if value is None:  # Optional fields that are unset
+            codec = None
+        if flat:
+            return codec.transform_python(value) if codec else value
+        if codec:  # Encode each field:
+            return {
+                "_type": _locatable_name(codec.python_type),
+                "_val": codec.transform_python(value),
+            }
+        # If no TypeCodec was specified, just leave the value raw:
+        return {"_type": "None", "_val": value}
+
+    def encode(self, flat: bool = False) -> dict:
         """Encodes this into a dictionary for BSON to be happy"""
         if "_id" not in vars(self) or self._id is None:
             self._id = ObjectId()
         dictionary: Mapping[str, Tuple[str, Any]] = {}
         for field, codec in zip(self._fields, self._fields.values()):
-            if codec:  # Encode each field:
-                dictionary[field] = {
-                    "_type": _locatable_name(codec.python_type),
-                    "_val": codec.transform_python(getattr(self, field)),
-                }
-            else:  # If no TypeCodec was specified, just leave the value raw:
-                value = getattr(self, field)
-                # dictionary[field] = (_locatable_name(type(value)), value)
-                dictionary[field] = {"_type": "None", "_val": value}
+            dictionary[field] = self._encode_field(field, codec, flat)
         dictionary["_id"] = self._id
         return dictionary
 
     @classmethod
     def find_codec(cls, field_name: str, field_type_name: str) -> TypeCodec:
         """Finds a codec for a given field (w/ name and type name specified)"""
-        return (
-            cls._fields[field_name]
-            if field_name in cls._fields
-            else (
-                cls._codecs[locate(field_type_name)]
-                if locate(field_type_name) in cls._codecs
-                else DummyCodec()
-            )
-        )
+        if field_name in cls._fields:
+            return cls._fields[field_name]
+        field_type = _locate(field_type_name)
+        if field_type in cls._codecs:
+            return cls._codecs[field_type]
+        return DummyCodec()
+
+    @classmethod
+    def _flat_codec(cls, field_name: str) -> Optional[TypeCodec]:
+        """Finds the codec for a field stored as a plain value"""
+        if field_name in cls._fields:
+            return cls._fields[field_name]
+        field_type_name = cls.schema()["fields"].get(field_name, "None")
+        if field_type_name == "None":
+            return None
+        return cls.find_codec(field_name, field_type_name)
 
     @classmethod
     def decode(cls, value: Optional[Mapping[str, Any]]) -> Optional[Encodable]:
@@ -310,46 +572,174 @@ class PyMongoModel(Encodable):  # TODO: Clean up some code by making an
             return None
         new_object = cls()
         new_object._id = value.pop("_id")
-        for field_name, x in zip(value, value.values()):
-            if isinstance(x, dict) and "_type" in x:
-                field_type_name = x["_type"]
-                val = x["_val"]
-            else:
-                try:
-                    field_type_name, val = x
-                    if field_type_name != "None":
-                        if (
-                            not isinstance(field_type_name, str)
-                            or "." not in field_type_name
-                        ):
-                            field_type_name, val = ("None", x)
-                except (ValueError, TypeError):
-                    field_type_name, val = ("None", x)
-
-            if field_type_name == "None":
-                if isinstance(val, list) and len(val) == 2 and val[0] == "None":
-                    val = val[1]
-                new_object._setattr_shady(field_name, val)
-            else:
-                # Try to get the codec from the fields registry
-                # or else try to fall back on the codecs registry
-                # or, if that fails, try the fallback dummy codec:
-                codec: TypeCodec = cls.find_codec(field_name, field_type_name)
-                new_object._setattr_shady(field_name, codec.transform_bson(val))
+        flat = cls.flat_storage and cls.storage_layout() != WRAPPED
+        for field_name, stored in value.items():
+            new_object._setattr_shady(
+                field_name, cls._decode_field(field_name, stored, flat)
+            )
         return new_object
 
-    def __delattr__(self, __name: str):
-        if __name in self._fields:
-            del self._fields[__name]
-        super().__delattr__(__name)
+    @classmethod
+    def _decode_field(
+        cls,
+        field_name: str,
+        stored: Any,
+        flat: bool,
+    ) -> Any:
+        """Decodes the stored value of a single field
+        (flat tells whether the collection may hold flat documents)"""
+        if flat and not _is_wrapped(stored):
+            codec = cls._flat_codec(field_name)
+            if codec is None or stored is None:
+                return _unshared(stored)
+            return codec.transform_bson(stored)
+        field_type_name, val = _split_field(stored)
+        if field_type_name == "None":
+            return _unshared(val)
+        # Try the compiled plan first; only a field stored under a type
+        # other than the declared one needs to go through find_codec():
+        codec = cls._decode_plan.get((field_name, field_type_name))
+        if codec is None:
+            codec = cls.find_codec(field_name, field_type_name)
+        if codec is None:  # A raw field stored under an older type name
+            return _unshared(val)
+        return codec.transform_bson(val)
+
+    @classmethod
+    def _prototype(cls) -> "PyMongoModel":
+        """A default-constructed instance; lazily loaded objects take their
+        defaults from it"""
+        if cls._lazy_prototype is None:
+            cls._lazy_prototype = cls()
+        return cls._lazy_prototype
+
+    @classmethod
+    def decode_lazy(cls, value: Optional[Mapping[str, Any]]) -> Optional[Encodable]:
+        """Wraps a document (ideally a RawBSONDocument) in an object whose
+        fields are each decoded on first access, rather than all up front.
+        The constructor is not run; attributes that are missing from the
+        document get the values that a new object would have."""
+        if value is None:
+            return None
+        new_object = cls.__new__(cls)
+        new_object._setattr_shady("_id", value["_id"])
+        new_object._setattr_shady("_raw", value)
+        return new_object
+
+    def _decode_lazily(self, name: str) -> Any:
+        """Decodes (and caches) an attribute of a lazily loaded object"""
+        cls = type(self)
+        raw = self.__dict__["_raw"]
+        if name in raw:
+            stored = _inflate(raw[name])
+            value = cls._decode_field(
+                name,
+                stored,
+                cls.flat_storage and cls.storage_layout() != WRAPPED,
+            )
+            stored_fields = self.__dict__.get("_stored")
+            if stored_fields is not None:
+                stored_fields[name] = stored
+        else:
+            defaults = cls._prototype().__dict__
+            if name not in defaults:
+                raise AttributeError(
+                    f"'{cls.__name__}' object has no attribute '{name}'"
+                )
+            value = deepcopy(defaults[name])
+        self._setattr_shady(name, value)
+        return value
+
+    @classmethod
+    def decode_partial(
+        cls, value: Optional[Mapping[str, Any]], fields: List[str]
+    ) -> Optional[Encodable]:
+        """Populates an object from a document that was fetched with a
+        projection of the given fields.
+        Fields that were not loaded are removed from the object,
+        so that accessing them raises an UnloadedFieldError rather than
+        quietly returning a default value."""
+        new_object = cls.decode(value)
+        if new_object is None:
+            return None
+        loaded = {field.split(".", 1)[0] for field in fields}
+        unloaded = frozenset(field for field in cls._fields if field not in loaded)
+        for field in unloaded:
+            new_object.__dict__.pop(field, None)
+        new_object._setattr_shady("_unloaded", unloaded)
+        return new_object
+
+    @classmethod
+    def _load(
+        cls,
+        document: Optional[Mapping[str, Any]],
+        fields: Optional[List[str]] = None,
+        lazy: bool = False,
+    ) -> Optional["PyMongoModel"]:
+        """Decodes a document freshly read from the collection, keeping the
+        stored fields around so that save() can tell what has changed
+        (for lazily loaded objects, only those that have been decoded)"""
+        if lazy:
+            loaded = cls.decode_lazy(document)
+            if loaded is not None and fields is not None:
+                loaded._setattr_shady(
+                    "_unloaded",
+                    frozenset(cls._fields).difference(
+                        field.split(".", 1)[0] for field in fields
+                    ),
+                )
+            document = {}
+        elif fields is None:
+            loaded = cls.decode(document)
+        else:
+            loaded = cls.decode_partial(document, fields)
+        if loaded is not None:
+            loaded._setattr_shady("_stored", document)
+            loaded._setattr_shady("_dirty", set())
+        return loaded
+
+    @classmethod
+    def _raw_collection(cls) -> Collection:
+        """The collection, returning documents as RawBSONDocuments"""
+        try:
+            return cls.collection.with_options(
+                codec_options=cls.collection.codec_options.with_options(
+                    document_class=RawBSONDocument
+                )
+            )
+        except NotImplementedError:  # Not every client supports this (e.g. mongomock)
+            return cls.collection
+
+    def __getattr__(self, __name: str):
+        unloaded = self.__dict__.get("_unloaded")
+        if unloaded and __name in unloaded:
+            raise UnloadedFieldError(
+                f"The field '{__name}' was not loaded for this "
+                f"{type(self).__name__}; include it in fields= when "
+                f"finding the document to use it."
+            )
+        if "_raw" in self.__dict__ and not __name.startswith("__"):
+            return self._decode_lazily(__name)
+        if unloaded:
+            raise UnloadedFieldError(
+                f"'{type(self).__name__}' object has no attribute '{__name}' "
+                f"(it was only partially loaded, without "
+                f"{', '.join(sorted(unloaded))})"
+            )
+        raise AttributeError(
+            f"'{type(self).__name__}' object has no attribute '{__name}'"
+        )
+
+    @property
+    def is_partial(self) -> bool:
+        """True if this object was loaded with only some of its fields"""
+        return bool(self.__dict__.get("_unloaded"))
 
     def __setattr__(self, __name: str, __value: Any):
-        if (
-            __name not in self._ignored
-            and __value is not None
-            and __name not in self._fields
-        ):
-            self.register_field(__name, __value)
+        if __name in self._fields:
+            dirty = self.__dict__.get("_dirty")
+            if dirty is not None:
+                dirty.add(__name)
         super().__setattr__(__name, __value)
 
     def __hash__(self) -> int:
@@ -359,8 +749,6 @@ class PyMongoModel(Encodable):  # TODO: Clean up some code by making an
         if not isinstance(__value, PyMongoModel):
             return False
         for field in self._fields:
-            if field in self._ignored:
-                continue
             if getattr(self, field) != getattr(__value, field):
                 return False
 
@@ -382,12 +770,170 @@ class PyMongoModel(Encodable):  # TODO: Clean up some code by making an
         """
         return self.id
 
-    def save(self):
-        """Saves this document to the collection"""
+    def _writes_flat(self, stored: Optional[Mapping[str, Any]]) -> bool:
+        """Whether this document should be written in the FLAT layout
+        An update keeps the layout of the stored document, so that no
+        document is ever left half-converted."""
+        if not self.flat_storage:
+            return False
+        for field, value in (stored or self.__dict__.get("_raw") or {}).items():
+            if field != "_id":
+                return not _is_wrapped(value)
+        return self.storage_layout() == FLAT
+
+    def _changed_fields(self, stored: Mapping[str, Any]) -> dict:
+        """Encodes the fields that differ from what is stored in the collection
+        Fields that were assigned since loading are always checked; others
+        are only checked if their values could have been changed in-place.
+        Fields that were not loaded are never included."""
+        unloaded = self.__dict__.get("_unloaded", ())
+        dirty = self.__dict__.get("_dirty", ())
+        flat = self._writes_flat(stored)
+        lazy = "_raw" in self.__dict__
+        changes = {}
+        for field, codec in self._fields.items():
+            if field in unloaded:
+                continue
+            if lazy and field not in self.__dict__:
+                continue  # Never decoded, so never changed
+            if (
+                field not in dirty
+                and field in stored
+                and isinstance(self.__dict__.get(field), _IMMUTABLE_TYPES)
+            ):
+                continue
+            encoded = self._encode_field(field, codec, flat)
+            if stored.get(field) != encoded:
+                changes[field] = encoded
+        return changes
+
+    def _pending_write(
+        self,
+    ) -> Tuple[Optional[InsertOne | ReplaceOne | UpdateOne], Mapping[str, Any]]:
+        """Works out what saving this document entails
+        Returns the write operation (None if nothing has changed) alongside
+        the encoded fields that it writes."""
         if not self._id:
-            self.collection.insert_one(self.encode())
+            document = self.encode(self._writes_flat(None))
+            return InsertOne(document), document
+        stored = self.__dict__.get("_stored")
+        if stored is None:  # We don't know what's in the collection
+            document = self.encode(self._writes_flat(None))
+            # (upserted, in case it was given its id before it was inserted)
+            return ReplaceOne({"_id": self._id}, document, upsert=True), document
+        changes = self._changed_fields(stored)
+        if not changes:
+            return None, changes
+        return UpdateOne({"_id": self._id}, {"$set": changes}), changes
+
+    def _mark_saved(self, written: Mapping[str, Any]):
+        """Records the fields just written as what is stored
+        (copied, since encoded values may share mutable objects with self)"""
+        stored = self.__dict__.get("_stored")
+        if stored is None:
+            stored = {}
+            self._setattr_shady("_stored", stored)
+        stored.update(deepcopy(dict(written)))
+        self._setattr_shady("_dirty", set())
+
+    def forget_stored(self):
+        """Forgets what is stored, so that the next save() writes the whole
+        document (e.g. after the transaction that saved it was aborted)"""
+        self.__dict__.pop("_stored", None)
+
+    def _sync_field(self, field: str, value: Any):
+        """Takes on the value of a field that was just changed server-side,
+        without marking it as changed for the next save()"""
+        self._setattr_shady(field, value)
+        stored = self.__dict__.get("_stored")
+        if stored is not None:
+            stored[field] = deepcopy(
+                self._encode_field(
+                    field, self._fields[field], self._writes_flat(stored)
+                )
+            )
+        dirty = self.__dict__.get("_dirty")
+        if dirty is not None:
+            dirty.discard(field)
+
+    def save(self, session: Optional[ClientSession] = None):
+        """Saves this document to the collection
+        Documents that were loaded from the collection are only updated
+        with $set for the fields that have changed (if any), so fields that
+        were not loaded are left alone.
+        Pass a session to write as part of a transaction()."""
+        operation, written = self._pending_write()
+        if operation is None:
+            return
+        if self.flat_storage:
+            self._note_schema()
+        if isinstance(operation, InsertOne):
+            self.collection.insert_one(written, session=session)
+        elif isinstance(operation, ReplaceOne):
+            self.collection.replace_one(
+                {"_id": self._id}, written, upsert=True, session=session
+            )
         else:
-            self.collection.replace_one({"_id": self._id}, self.encode())
+            self.collection.update_one(
+                {"_id": self._id}, {"$set": written}, session=session
+            )
+        self._mark_saved(written)
+
+    @classmethod
+    @contextmanager
+    def transaction(cls) -> Iterator[Optional[ClientSession]]:
+        """Runs the enclosed writes in a single transaction, if the database
+        supports them (i.e. it is a replica set); pass the session this
+        yields to each write. Otherwise this yields None, and the writes are
+        simply made one after another."""
+        client = cls.collection.database.client
+        if not _supports_transactions(client):
+            yield None
+            return
+        with client.start_session() as session:
+            with session.start_transaction():
+                yield session
+
+    @classmethod
+    def save_many(
+        cls,
+        models: Iterable["PyMongoModel"],
+        session: Optional[ClientSession] = None,
+    ) -> List[Tuple["PyMongoModel", dict]]:
+        """Saves many documents of this type in a single unordered bulk write
+        Each object is inserted, replaced, or updated just as save() would,
+        and new objects are assigned their ids.
+        Returns a list of (object, write error) pairs for any documents
+        that could not be saved; objects that failed to insert are left
+        without an id so that they may be saved again.
+        Pass a session to write as part of a transaction()."""
+        pending = []
+        for model in models:
+            operation, written = model._pending_write()
+            if operation is not None:
+                pending.append((model, operation, written))
+        if not pending:
+            return []
+        if cls.flat_storage:
+            cls._note_schema()
+        failures = []
+        try:
+            cls.collection.bulk_write(
+                [operation for _, operation, _ in pending],
+                ordered=False,
+                session=session,
+            )
+        except BulkWriteError as error:
+            for write_error in error.details["writeErrors"]:
+                model, operation, _ = pending[write_error["index"]]
+                if isinstance(operation, InsertOne):
+                    model._id = None
+                failures.append((model, write_error))
+        failed = {id(model) for model, _ in failures}
+        for model, _, written in pending:
+            if id(model) not in failed:
+                model._mark_saved(written)
+        return failures
 
     def remove(self):
         """Removes this document from the collection"""
@@ -395,47 +941,128 @@ class PyMongoModel(Encodable):  # TODO: Clean up some code by making an
             self.collection.delete_one({"_id": self._id})
 
     @classmethod
-    def find(cls, *args, **kwargs):
-        """Finds documents from the collection
-        Arguments are the same as those for PyMongo.collection's find()."""
+    def _map_filter(cls, f):
+        """Maps a filter onto the collection's storage layout
+        While MIGRATING, each document is matched in whichever layout it is
+        in, telling them apart by whether the first field filtered on is
+        wrapped (a document is always converted all at once)."""
+        layout = cls.storage_layout()
+        if not f or layout == WRAPPED:
+            return map_filter(f)
+        if layout == FLAT:
+            return f
+        key = next((k for k in f if k != "_id" and not k.startswith("$")), None)
+        if key is None:
+            return map_filter(f)
+        wrapped_type = f"{key.split('.', 1)[0]}._type"
+        return {
+            "$or": [
+                {wrapped_type: {"$exists": True}, **map_filter(f)},
+                {wrapped_type: {"$exists": False}, **f},
+            ]
+        }
+
+    @classmethod
+    def _map_sort(cls, s):
+        """Maps sort keys onto the collection's storage layout
+        (while MIGRATING, wrapped documents sort ahead of converted ones)"""
+        layout = cls.storage_layout()
+        if layout == WRAPPED:
+            return map_sort(s)
+        if layout == FLAT:
+            return list(s)
+        return map_sort(s) + list(s)
+
+    @classmethod
+    def _map_projection(cls, fields):
+        """Builds a projection of the given fields for the storage layout"""
+        layout = cls.storage_layout()
+        if layout == WRAPPED:
+            return map_projection(fields)
+        if layout == FLAT:
+            return {field: 1 for field in fields}
+        # Project whole fields, which works for either layout:
+        return {field.split(".", 1)[0]: 1 for field in fields if field != "_id"}
+
+    @classmethod
+    def _map_query(cls, args: tuple, kwargs: dict) -> Tuple[list, dict]:
+        """Maps the filter and sort arguments of a query onto the
+        document structure (see map_filter and map_sort)"""
         args = list(args)
         if args:
-            args[0] = map_filter(args[0])
+            args[0] = cls._map_filter(args[0])
 
         if "filter" in kwargs:
-            kwargs["filter"] = map_filter(kwargs["filter"])
+            kwargs["filter"] = cls._map_filter(kwargs["filter"])
 
         if "sort" in kwargs:
-            kwargs["sort"] = map_sort(kwargs["sort"])
+            kwargs["sort"] = cls._map_sort(kwargs["sort"])
+        return args, kwargs
 
-        return [
-            cls.decode(document) for document in cls.collection.find(*args, **kwargs)
-        ]
+    @classmethod
+    def iter_find(
+        cls,
+        *args,
+        fields: Optional[List[str]] = None,
+        batch_size: Optional[int] = None,
+        lazy: bool = False,
+        **kwargs,
+    ) -> Iterator["PyMongoModel"]:
+        """Lazily finds documents from the collection, decoding each one
+        as it comes off of the cursor rather than building a list.
+        Arguments are the same as those for find(); optionally specify
+        the number of documents the cursor fetches per batch."""
+        args, kwargs = cls._map_query(args, kwargs)
+        if batch_size is not None:
+            kwargs["batch_size"] = batch_size
+
+        if fields is not None:
+            kwargs["projection"] = cls._map_projection(fields)
+
+        collection = cls._raw_collection() if lazy else cls.collection
+        for document in collection.find(*args, **kwargs):
+            yield cls._load(document, fields, lazy)
 
     @classmethod
-    def find_one(cls, *args, **kwargs):
-        """Finds a document from the collection
-        Arguments are the same as those for PyMongo's find_one()."""
-        args = list(args)
-        if args:
-            args[0] = map_filter(args[0])
+    def find(cls, *args, **kwargs):
+        """Finds documents from the collection
+        Arguments are the same as those for PyMongo.collection's find().
+        Optionally specify fields to load only those (by attribute name);
+        the other fields of the objects returned will be unavailable.
+        Specify lazy=True to keep each document as a RawBSONDocument and
+        only decode the fields that are actually used (see decode_lazy()),
+        which suits views that show a few attributes of many documents.
+        Use iter_find() if the documents only need to be iterated once."""
+        return list(cls.iter_find(*args, **kwargs))
 
-        if "filter" in kwargs:
-            kwargs["filter"] = map_filter(kwargs["filter"])
+    @classmethod
+    def find_one(
+        cls,
+        *args,
+        fields: Optional[List[str]] = None,
+        lazy: bool = False,
+        **kwargs,
+    ):
+        """Finds a document from the collection
+        Arguments are the same as those for PyMongo's find_one().
+        See find() regarding fields and lazy."""
+        args, kwargs = cls._map_query(args, kwargs)
 
-        if "sort" in kwargs:
-            kwargs["sort"] = map_sort(kwargs["sort"])
+        if fields is not None:
+            kwargs["projection"] = cls._map_projection(fields)
 
-        return cls.decode(cls.collection.find_one(*args, **kwargs))
+        collection = cls._raw_collection() if lazy else cls.collection
+        return cls._load(collection.find_one(*args, **kwargs), fields, lazy)
 
     def find_self(self):
         """Returns the database's version of self"""
         return self.find_by_id(self.id)
 
     @classmethod
-    def find_by_id(cls, identifier):
-        """Finds a document from the collection, given the id"""
-        return cls.find_one({"_id": ObjectId(identifier)})
+    def find_by_id(cls, identifier, fields: Optional[List[str]] = None):
+        """Finds a document from the collection, given the id
+        See find() regarding fields."""
+        return cls.find_one({"_id": ObjectId(identifier)}, fields=fields)
 
     def set_attr_from_string(self, field_name: str, value: str):
         """Decodes and updates a single string value to the document object"""
@@ -447,11 +1074,26 @@ class PyMongoModel(Encodable):  # TODO: Clean up some code by making an
             self._setattr_shady(
                 field_name, type(self.__getattribute__(field_name))(value)
             )
+        dirty = self.__dict__.get("_dirty")
+        if dirty is not None:
+            dirty.add(field_name)
 
     @classmethod
     def count_documents(cls, *args, **kwargs):
         """Return the number of documents in the filtered collection"""
         args = list(args)
         if args:
-            args[0] = map_filter(args[0])
+            args[0] = cls._map_filter(args[0])
         return cls.collection.count_documents(*args, **kwargs)
+
+
+def all_models() -> List[Type[PyMongoModel]]:
+    """Lists every PyMongoModel subclass that has been imported"""
+    models = []
+    pending = list(PyMongoModel.__subclasses__())
+    while pending:
+        model = pending.pop(0)
+        if model not in models:
+            models.append(model)
+            pending.extend(model.__subclasses__())
+    return models
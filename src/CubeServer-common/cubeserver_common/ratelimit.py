@@ -0,0 +1,106 @@
+"""Token buckets, for rate limiting
+
+Each bucket holds up to a burst of tokens and refills at a steady rate;
+every request takes a token, and is refused while the bucket is empty.
+The buckets are kept in the database, so that they are shared by every
+server process, or else in this process alone."""
+
+from abc import ABC, abstractmethod
+from threading import Lock
+from time import monotonic, time
+from typing import Dict, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.collection import Collection
+
+__all__ = [
+    "TokenBuckets",
+    "MemoryTokenBuckets",
+    "MongoTokenBuckets",
+    "make_token_buckets",
+]
+
+RATE_LIMIT_COLLECTION = "RateLimits"
+"""The collection that MongoTokenBuckets are kept in"""
+
+
+class TokenBuckets(ABC):
+    """A set of token buckets, by key"""
+
+    @abstractmethod
+    def take(self, key: str, rate: float, burst: float) -> float:
+        """Takes a token from a bucket that refills at rate tokens per second,
+        holding up to burst tokens (a new bucket is full).
+        Returns 0 if a token was taken, or else how many seconds it will be
+        until one is available."""
+
+
+class MemoryTokenBuckets(TokenBuckets):
+    """Token buckets kept in this process"""
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}  # key -> (tokens, at)
+        self._lock = Lock()
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        now = monotonic()
+        with self._lock:
+            tokens, at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - at) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+        return (1 - tokens) / rate
+
+
+class MongoTokenBuckets(TokenBuckets):
+    """Token buckets kept in a collection, each updated atomically (so that
+    every server process shares them)"""
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        now = time()
+        elapsed = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$at", now]}]}]}
+        refilled = {
+            "$add": [{"$ifNull": ["$tokens", burst]}, {"$multiply": [elapsed, rate]}]
+        }
+        bucket = self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": {"$min": [burst, refilled]}, "at": now}},
+                {"$set": {"taken": {"$gte": ["$tokens", 1]}}},
+                {
+                    "$set": {
+                        "tokens": {
+                            "$cond": [
+                                "$taken",
+                                {"$subtract": ["$tokens", 1]},
+                                "$tokens",
+                            ]
+                        }
+                    }
+                },
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if bucket["taken"]:
+            return 0.0
+        return (1 - bucket["tokens"]) / rate
+
+
+def make_token_buckets(backend: str) -> TokenBuckets:
+    """Makes the token buckets of a backend: "mongo" or "memory"
+    (the "mongo" buckets need PyMongoModel's client to be set up)"""
+    if backend == "memory":
+        return MemoryTokenBuckets()
+    if backend == "mongo":
+        from cubeserver_common.models.utils import PyMongoModel
+
+        return MongoTokenBuckets(
+            PyMongoModel.mongo.db.get_collection(RATE_LIMIT_COLLECTION)
+        )
+    raise ValueError(f"Unknown rate limit backend: {backend}")
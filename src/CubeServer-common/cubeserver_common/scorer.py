@@ -0,0 +1,36 @@
+"""The scoring worker, which scores the data that the api queues when
+config.ASYNC_INGESTION is on
+
+Run with: python -m cubeserver_common.scorer"""
+
+import logging
+from time import sleep
+
+from pymongo.errors import PyMongoError
+
+from cubeserver_common import configure_db, config, init_logging
+
+
+def main():
+    """Scores queued data, batch by batch, until stopped"""
+    init_logging()
+    configure_db()
+    from cubeserver_common.models.datapoint import DataPoint
+    from cubeserver_common.models.ingestqueue import QueuedDataPoint
+
+    DataPoint.reference_timeline.backfill()
+    logging.info("Scoring worker started")
+    while True:
+        try:
+            scored = QueuedDataPoint.score_batch()
+        except PyMongoError:
+            logging.exception("Could not score the queued data; retrying")
+            scored = 0
+        if scored:
+            logging.debug(f"Scored {scored} queued datapoint(s)")
+        else:
+            sleep(config.INGEST_POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+"""Fixtures shared by the unit tests."""
+
+import pytest
+from mongomock import MongoClient as MockMongoClient
+
+from cubeserver_common.models.config.conf import Conf
+from cubeserver_common.models.config.rules import Rules
+from cubeserver_common.models.datapoint import DataPoint
+from cubeserver_common.models.team import Team
+from cubeserver_common.models.utils.modelutils import PyMongoModel
+
+
+@pytest.fixture(autouse=True)
+def mongo():
+    """Gives each test an empty (mock) database, and nothing cached from it"""
+    client = MockMongoClient()
+    PyMongoModel.update_mongo_client(client)
+    Rules.invalidate()
+    Conf.invalidate()
+    DataPoint.reference_timeline.clear()
+    Team._credentials.clear()
+    yield client
@@ -0,0 +1,52 @@
+"""Tests for the cached configuration."""
+
+from time import sleep
+
+
+from cubeserver_common.models.config import conf as conf_module
+from cubeserver_common.models.config.conf import Conf
+
+
+def _reset() -> Conf:
+    Conf.unwatch()
+    Conf.collection.delete_many({})
+    conf = Conf()
+    conf.save()
+    return conf
+
+
+def test_retrieve_cached(monkeypatch):
+    _reset()
+    first = Conf.retrieve_instance()
+    assert first.competition_on is False
+    monkeypatch.setattr(Conf, "find_one", None)
+    assert Conf.retrieve_instance() is first
+
+
+def test_save_invalidates():
+    _reset()
+    conf = Conf.find_one()
+    conf.competition_on = True
+    conf.save()
+    assert Conf.retrieve_instance().competition_on is True
+    Conf.collection.update_many({}, {"$set": {"competition_on._val": False}})
+    assert Conf.retrieve_instance().competition_on is True
+    Conf.invalidate()
+    assert Conf.retrieve_instance().competition_on is False
+
+
+def test_watch_polls_without_change_streams(monkeypatch):
+    _reset()
+    monkeypatch.setattr(conf_module, "SETTINGS_REFRESH", 0.01)
+    assert Conf.retrieve_instance().competition_on is False
+    Conf.watch()
+    try:
+        # A change made by another server:
+        Conf.collection.update_many({}, {"$set": {"competition_on._val": True}})
+        for _ in range(200):
+            if Conf.retrieve_instance().competition_on:
+                break
+            sleep(0.01)
+        assert Conf.retrieve_instance().competition_on is True
+    finally:
+        Conf.unwatch()
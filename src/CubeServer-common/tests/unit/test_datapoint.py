@@ -0,0 +1,176 @@
+"""Tests for the DataPoint model's reference timeline and scoring keys."""
+
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from bson.objectid import ObjectId
+from pymongo import DESCENDING
+
+from cubeserver_common.config import REFERENCE_TIMELINE_REBUILD_INTERVAL
+from cubeserver_common.models.datapoint import (
+    DataClass,
+    DataPoint,
+    ReferenceTimeline,
+    migrate_scoring_keys,
+    window_key,
+)
+from cubeserver_common.models.utils.indexes import reconcile_indexes
+
+
+@pytest.fixture(autouse=True)
+def _indexes(mongo):
+    reconcile_indexes(DataPoint)  # (at most one point holds each window)
+
+
+START = datetime(2026, 2, 1, 12, 0, 0)
+
+
+def _reference(moment: datetime, value: float = 29.92) -> DataPoint:
+    data_point = DataPoint(ObjectId(), DataClass.PRESSURE, value, moment, True)
+    data_point.save()
+    return data_point
+
+
+def _queried(moment: datetime):
+    return DataPoint.find_one(
+        {
+            "is_reference": True,
+            "category": DataClass.PRESSURE.value,
+            "moment": {"$lte": moment},
+        },
+        sort=[("moment", DESCENDING)],
+    )
+
+
+def test_timeline_matches_query():
+    DataPoint.collection.delete_many({})
+    rng = random.Random(0)
+    for _ in range(50):
+        _reference(START + timedelta(seconds=rng.randrange(3600)))
+    DataPoint(ObjectId(), DataClass.PRESSURE, 1.0, START).save()  # Not a reference
+
+    for size in (100, 20):  # Holding all of them, then only the latest
+        timeline = ReferenceTimeline(size)
+        timeline.backfill([DataClass.PRESSURE])
+        for offset in range(-60, 3700, 7):
+            moment = START + timedelta(seconds=offset)
+            found = timeline.latest(DataClass.PRESSURE, moment)
+            expected = _queried(moment)
+            assert (found and found.moment) == (expected and expected.moment)
+            assert found is None or found.is_reference
+
+
+def test_timeline_is_bounded():
+    DataPoint.collection.delete_many({})
+    timeline = ReferenceTimeline(5)
+    timeline.backfill([DataClass.PRESSURE])
+    for i in range(8):
+        timeline.add(_reference(START + timedelta(minutes=i), value=i))
+    assert len(timeline._timelines[DataClass.PRESSURE].points) == 5
+    # Older than the timeline, so looked up:
+    assert timeline.latest(DataClass.PRESSURE, START).value == 0
+    assert timeline.latest(DataClass.PRESSURE, START - timedelta(minutes=1)) is None
+
+
+def test_timeline_fetches_points_saved_elsewhere():
+    DataPoint.collection.delete_many({})
+    timeline = ReferenceTimeline()
+    timeline.backfill([DataClass.PRESSURE])
+    assert timeline.latest(DataClass.PRESSURE, datetime.now()) is None
+
+    saved = _reference(datetime.now())  # By another process
+    timeline._timelines[DataClass.PRESSURE].synced_at -= timedelta(seconds=2)
+    assert timeline.latest(DataClass.PRESSURE, datetime.now()).id == saved.id
+
+
+def test_timeline_follows_edits():
+    DataPoint.collection.delete_many({})
+    first = _reference(START, value=1.0)
+    second = _reference(START + timedelta(minutes=1), value=2.0)
+    timeline = DataPoint.reference_timeline
+    timeline.backfill([DataClass.PRESSURE])
+    moment = START + timedelta(minutes=5)
+    assert timeline.latest(DataClass.PRESSURE, moment).value == 2.0
+
+    edited = DataPoint.find_by_id(second.id)
+    edited.value = 3.0
+    edited.save()
+    assert timeline.latest(DataClass.PRESSURE, moment).value == 3.0
+    edited.moment = START - timedelta(minutes=1)
+    edited.save()
+    assert timeline.latest(DataClass.PRESSURE, moment).id == first.id
+    edited.remove()
+    first.is_reference = False
+    first.save()
+    assert timeline.latest(DataClass.PRESSURE, moment) is None
+
+
+def test_timeline_rebuilt_for_edits_elsewhere():
+    DataPoint.collection.delete_many({})
+    first = _reference(START, value=1.0)
+    second = _reference(START + timedelta(minutes=1), value=2.0)
+    timeline = ReferenceTimeline()
+    timeline.backfill([DataClass.PRESSURE])
+    moment = START + timedelta(minutes=5)
+
+    # By another process:
+    edited = DataPoint.find_by_id(first.id)
+    edited.value = 3.0
+    edited.save()
+    DataPoint.find_by_id(second.id).remove()
+    assert timeline.latest(DataClass.PRESSURE, moment).id == second.id  # (stale)
+
+    timeline._timelines[DataClass.PRESSURE].built_at -= timedelta(
+        seconds=REFERENCE_TIMELINE_REBUILD_INTERVAL
+    )
+    found = timeline.latest(DataClass.PRESSURE, moment)
+    assert (found.id, found.value) == (first.id, 3.0)
+
+
+def test_timeline_fetches_without_the_lock(monkeypatch):
+    DataPoint.collection.delete_many({})
+    saved = _reference(START)
+    timeline = ReferenceTimeline()
+    find = DataPoint.find
+
+    def unlocked_find(*args, **kwargs):
+        assert not timeline._lock.locked()
+        # Another thread asking meanwhile isn't held up by this fetch:
+        assert timeline.latest(DataClass.PRESSURE, START).id == saved.id
+        return find(*args, **kwargs)
+
+    monkeypatch.setattr(DataPoint, "find", unlocked_find)
+    assert timeline.latest(DataClass.PRESSURE, START).id == saved.id
+
+
+def test_migrate_scoring_keys():
+    DataPoint.collection.delete_many({})
+    team = ObjectId()
+    points = []
+    for key in [
+        "2026-02-01 12:04:00->2026-02-01 12:08:00",
+        "2026-02-01 12:04:00->2026-02-01 12:08:00",  # The same window, again
+        "2026-02-01 12:10:00->2026-02-01 12:14:00",
+        "nonsense",
+        None,
+    ]:
+        data_point = DataPoint(team, DataClass.PRESSURE, 29.92, START)
+        data_point.rawscore = 1.0
+        data_point.scoring_key = key
+        points.append(data_point)
+    DataPoint.collection.insert_many([point.encode() for point in points])
+
+    assert migrate_scoring_keys(batch_size=2, pause=0) == 3
+    start = window_key(datetime(2026, 2, 1, 12, 4))
+    assert start == window_key(START) + 4 * 60
+    stored = DataPoint.find({}, sort=[("_id", 1)])
+    assert [point.scoring_key for point in stored] == [
+        start,
+        None,  # (the unique index allows only one)
+        start + 6 * 60,
+        None,
+        None,
+    ]
+    assert all(point.rawscore == 1.0 for point in stored)
+    assert migrate_scoring_keys(pause=0) == 0
@@ -0,0 +1,217 @@
+"""Tests for the flat storage layout and its migration."""
+
+from enum import Enum
+
+import mongomock
+import pytest
+from mongomock import MongoClient as MockMongoClient
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from cubeserver_common.models.team import Team
+from cubeserver_common.models.utils import migration
+from cubeserver_common.models.utils.indexes import ModelIndex, reconcile_indexes
+from cubeserver_common.models.utils.migration import _flatten, migrate_to_flat
+from cubeserver_common.models.utils.modelutils import (
+    FLAT,
+    MIGRATING,
+    WRAPPED,
+    Encodable,
+    PyMongoModel,
+)
+
+client = MockMongoClient()
+PyMongoModel.update_mongo_client(client)
+
+
+@pytest.fixture(autouse=True)
+def _strict_indexes(monkeypatch):
+    """Refuses a second index with the same keys and options, as the server
+    does (mongomock doesn't)"""
+    create_index = mongomock.collection.Collection.create_index
+
+    def strict_create_index(self, keys, **kwargs):
+        for name, info in self.index_information().items():
+            if (
+                name != kwargs.get("name")
+                and info["key"] == list(keys)
+                and bool(info.get("unique")) == bool(kwargs.get("unique"))
+                and info.get("partialFilterExpression")
+                == kwargs.get("partialFilterExpression")
+            ):
+                raise OperationFailure(
+                    "Index already exists with a different name", code=85
+                )
+        return create_index(self, keys, **kwargs)
+
+    monkeypatch.setattr(
+        mongomock.collection.Collection, "create_index", strict_create_index
+    )
+
+
+class Level(Enum):
+    LOW = "low"
+    HIGH = "high"
+
+
+class Stats(Encodable):
+    def __init__(self, total: int = 0):
+        self.total = total
+        super().__init__()
+
+    def encode(self) -> dict:
+        return {"total": self.total}
+
+    @classmethod
+    def decode(cls, value: dict):
+        return cls(value["total"])
+
+
+class FlatModel(PyMongoModel):
+    flat_storage = True
+    indexes = [ModelIndex("name", ("rank", DESCENDING))]
+
+    name: str
+    rank: int
+    level: Level
+    tags: list
+    stats: Stats
+
+    def __init__(self, name: str = "", rank: int = 0, level: Level = Level.LOW):
+        super().__init__()
+        self.name = name
+        self.rank = rank
+        self.level = level
+        self.tags = []
+        self.stats = Stats()
+
+
+def _fill(count: int):
+    FlatModel.collection.delete_many({})
+    FlatModel.update_schema(layout=WRAPPED)
+    models = [
+        FlatModel(name=f"model {i % 3}", rank=i, level=Level(["low", "high"][i % 2]))
+        for i in range(count)
+    ]
+    for model in models:
+        model.stats = Stats(model.rank * 10)
+    FlatModel.save_many(models)
+    return models
+
+
+def test_wrapped_until_migrated():
+    model = _fill(1)[0]
+    assert FlatModel.storage_layout() == WRAPPED
+    assert FlatModel.collection.find_one({"_id": model.id})["name"] == {
+        "_type": "None",
+        "_val": "model 0",
+    }
+    assert FlatModel.find_one({"name": "model 0"}).level == Level.LOW
+
+
+def test_migrate_to_flat():
+    _fill(10)
+    assert migrate_to_flat(FlatModel, batch_size=3, pause=0, settle=0) == 10
+    assert FlatModel.storage_layout() == FLAT
+    document = FlatModel.collection.find_one({"rank": 4})
+    assert document["name"] == "model 1"
+    assert document["level"] == "low"
+    assert document["stats"] == {"total": 40}
+    assert FlatModel.schema()["fields"]["level"].endswith("Level")
+
+    found = FlatModel.find({"name": "model 1"}, sort=[("rank", DESCENDING)])
+    assert [model.rank for model in found] == [7, 4, 1]
+    assert found[0].level == Level.HIGH
+    assert isinstance(found[0].stats, Stats)
+    assert FlatModel.count_documents({"level": "high"}) == 5
+    partial = FlatModel.find_one({"rank": 2}, fields=["level"])
+    assert partial.level == Level.LOW
+
+    # New and updated documents are flat too:
+    model = FlatModel(name="new", rank=11)
+    model.save()
+    model.tags.append("tagged")
+    model.save()
+    assert FlatModel.collection.find_one({"_id": model.id})["tags"] == ["tagged"]
+    assert FlatModel.find_by_id(model.id).tags == ["tagged"]
+
+    # Indexes were rebuilt on the flat paths:
+    info = FlatModel.collection.index_information()["name_1_rank_-1"]
+    assert info["key"] == [("name", 1), ("rank", DESCENDING)]
+
+    # Running it again is harmless:
+    assert migrate_to_flat(FlatModel, pause=0, settle=0) == 0
+
+
+def test_mixed_layouts_while_migrating():
+    models = _fill(4)
+    FlatModel.update_schema(layout=MIGRATING)
+    converted = FlatModel.collection.find_one({"_id": models[0].id})
+    FlatModel.collection.replace_one({"_id": models[0].id}, _flatten(converted)[0])
+
+    assert FlatModel.count_documents({"name": "model 0"}) == 2
+    assert {model.rank for model in FlatModel.find({"name": "model 0"})} == {0, 3}
+    assert FlatModel.count_documents({"rank": {"$ne": 0}}) == 3
+
+    # Saving keeps each document in the layout it is in:
+    for model in FlatModel.find({"name": "model 0"}):
+        model.rank += 100
+        model.save()
+    assert FlatModel.collection.find_one({"_id": models[0].id})["rank"] == 100
+    assert FlatModel.collection.find_one({"_id": models[3].id})["rank"] == {
+        "_type": "None",
+        "_val": 103,
+    }
+
+
+class UniqueModel(PyMongoModel):
+    flat_storage = True
+    indexes = [ModelIndex("code", unique=True, partial={"code": {"$type": "string"}})]
+
+    code: str
+
+    def __init__(self, code: str = ""):
+        super().__init__()
+        self.code = code
+
+
+def test_indexes_built_before_migrating(monkeypatch):
+    UniqueModel.update_schema(layout=WRAPPED)
+    reconcile_indexes(UniqueModel)
+    UniqueModel.save_many([UniqueModel("A"), UniqueModel("B")])
+    convert_pass = migration._convert_pass
+
+    def first_pass(model, batch_size, pause):
+        monkeypatch.setattr(migration, "_convert_pass", convert_pass)
+        # Both layouts are indexed, and held unique, while migrating:
+        info = UniqueModel.collection.index_information()
+        assert info["code_1"]["key"] == [("code._val", 1)]
+        assert info["code_1_flat"]["key"] == [("code", 1)]
+        UniqueModel.collection.insert_one({"code": "C"})  # (as a server would)
+        with pytest.raises(DuplicateKeyError):
+            UniqueModel.collection.insert_one({"code": "C"})
+        return convert_pass(model, batch_size, pause)
+
+    monkeypatch.setattr(migration, "_convert_pass", first_pass)
+    assert migrate_to_flat(UniqueModel, pause=0, settle=0) == 2
+    info = UniqueModel.collection.index_information()
+    assert info["code_1"]["key"] == [("code", 1)]
+    assert "code_1_flat" not in info
+    assert sorted(model.code for model in UniqueModel.find()) == ["A", "B", "C"]
+
+
+def test_unique_index_must_be_partial(monkeypatch):
+    monkeypatch.setattr(UniqueModel, "indexes", [ModelIndex("code", unique=True)])
+    with pytest.raises(ValueError):
+        migrate_to_flat(UniqueModel, pause=0, settle=0)
+    assert UniqueModel.storage_layout() == WRAPPED
+
+
+def test_migrate_team(monkeypatch):
+    monkeypatch.setattr(Team, "flat_storage", True)
+    reconcile_indexes(Team)
+    Team.save_many([Team(name="First Team"), Team(name="Second Team")])
+    assert migrate_to_flat(Team, pause=0, settle=0) == 2
+    assert Team.find_one({"name": "Second Team"}) is not None
+    with pytest.raises(DuplicateKeyError):
+        Team(name="First Team").save()
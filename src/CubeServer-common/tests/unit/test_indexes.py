@@ -0,0 +1,73 @@
+"""Tests for declarative model indexes."""
+
+from mongomock import MongoClient as MockMongoClient
+from pymongo import DESCENDING
+
+from cubeserver_common.models.utils.modelutils import PyMongoModel
+from cubeserver_common.models.utils.indexes import (
+    ModelIndex,
+    all_models,
+    index_report,
+    reconcile_indexes,
+)
+
+client = MockMongoClient()
+PyMongoModel.update_mongo_client(client)
+
+
+class IndexedModel(PyMongoModel):
+    indexes = [
+        ModelIndex("name", unique=True),
+        ModelIndex("owner", ("moment", DESCENDING)),
+        ModelIndex("category", partial={"is_reference": True}),
+        ModelIndex("expires", expire_after=3600),
+    ]
+
+    name: str
+
+    def __init__(self, name: str = ""):
+        super().__init__()
+        self.name = name
+
+
+def test_index_keys():
+    index = ModelIndex("owner", ("moment", DESCENDING), "category")
+    assert index.keys(IndexedModel) == [
+        ("owner._val", 1),
+        ("moment._val", DESCENDING),
+        ("category._val", 1),
+    ]
+    assert index.name == "owner_1_moment_-1_category_1"
+    partial = ModelIndex("category", partial={"is_reference": True})
+    assert partial.options(IndexedModel)["partialFilterExpression"] == {
+        "is_reference._val": True
+    }
+
+
+def test_reconcile_indexes():
+    assert IndexedModel in all_models()
+    created = reconcile_indexes(IndexedModel)
+    assert created == [index.name for index in IndexedModel.indexes]
+    info = IndexedModel.collection.index_information()
+    assert info["name_1"]["unique"]
+    assert info["expires_1"]["expireAfterSeconds"] == 3600
+    assert index_report(IndexedModel)["missing"] == []
+
+    # Reconciling again does nothing:
+    assert reconcile_indexes(IndexedModel) == []
+
+
+def test_reconcile_changed_index():
+    reconcile_indexes(IndexedModel)
+    IndexedModel.collection.drop_index("expires_1")
+    IndexedModel.collection.create_index(
+        [("expires._val", 1)], name="expires_1", expireAfterSeconds=60
+    )
+    IndexedModel.collection.create_index([("leftover._val", 1)])
+    report = index_report(IndexedModel)
+    assert report["missing"] == ["expires_1"]
+    assert report["undeclared"] == ["leftover._val_1"]
+
+    assert reconcile_indexes(IndexedModel) == ["expires_1"]
+    info = IndexedModel.collection.index_information()
+    assert info["expires_1"]["expireAfterSeconds"] == 3600
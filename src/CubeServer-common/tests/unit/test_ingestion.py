@@ -0,0 +1,256 @@
+"""Tests for the data ingestion path (Rules.post_data)."""
+
+from datetime import datetime, timedelta
+from functools import wraps
+
+import mongomock
+import pytest
+
+from cubeserver_common.models.config.rules import Rules
+from cubeserver_common.models.datapoint import DataClass, DataPoint
+from cubeserver_common.models.ingestqueue import QueuedDataPoint
+from cubeserver_common.models.team import (
+    Team,
+    TeamCredentials,
+    TeamHealth,
+    TeamLevel,
+)
+from cubeserver_common.models.utils.indexes import reconcile_indexes
+
+
+@pytest.fixture(autouse=True)
+def _indexes(mongo):
+    reconcile_indexes(DataPoint)  # (at most one point holds each window)
+
+
+OPERATIONS = [
+    "find",
+    "find_one",
+    "insert_one",
+    "replace_one",
+    "update_one",
+    "update_many",
+    "bulk_write",
+    "find_one_and_update",
+    "aggregate",
+    "count_documents",
+]
+
+
+def _count_round_trips(monkeypatch) -> list:
+    """Records every (outermost) operation made on any collection"""
+    calls = []
+    depth = [0]
+    for name in OPERATIONS:
+        method = getattr(mongomock.collection.Collection, name)
+
+        def counted(self, *args, _method=method, _name=name, **kwargs):
+            if depth[0] == 0:
+                calls.append((self.name, _name))
+            depth[0] += 1
+            try:
+                return _method(self, *args, **kwargs)
+            finally:
+                depth[0] -= 1
+
+        monkeypatch.setattr(
+            mongomock.collection.Collection, name, wraps(method)(counted)
+        )
+    return calls
+
+
+def _team(name: str, level: TeamLevel) -> TeamCredentials:
+    team = Team(name=name, weight_class=level, health=TeamHealth())
+    team.save()
+    return TeamCredentials.of(Team.find_by_id(team.id))
+
+
+def test_post_data_round_trips(monkeypatch):
+    ruleset = Rules()
+    ruleset.save()
+    moment = datetime(2026, 1, 1, 12, 6, 10)  # In a varsity pressure window
+    reference = _team(Team.RESERVED_NAMES[1], TeamLevel.REFERENCE)
+    first = _team("Warm Team", TeamLevel.VARSITY)
+    second = _team("Measured Team", TeamLevel.VARSITY)
+
+    ruleset.post_data(
+        DataPoint(reference.id, DataClass.PRESSURE, 101.0, moment, True),
+        team=reference,
+    )
+    ruleset.post_data(DataPoint(first.id, DataClass.PRESSURE, 101.1, moment))
+
+    calls = _count_round_trips(monkeypatch)
+    point = DataPoint(second.id, DataClass.PRESSURE, 101.2, moment)
+    assert ruleset.post_data(point, team=second)
+    # The insert (which claims the window), and the score:
+    assert len(calls) <= 2, calls
+
+    assert point.rawscore == ruleset.point_menu[TeamLevel.VARSITY][DataClass.PRESSURE]
+    assert Team.find_by_id(second.id).score == point.rawscore * second.multiplier
+    assert DataPoint.find_by_id(point.id).rawscore == point.rawscore
+
+
+def test_post_batch(monkeypatch):
+    ruleset = Rules()
+    ruleset.save()
+    moment = datetime(2026, 1, 1, 13, 6, 10)
+    reference = _team(Team.RESERVED_NAMES[2], TeamLevel.REFERENCE)
+    team = _team("Batch Team", TeamLevel.VARSITY)
+    ruleset.post_data(
+        DataPoint(reference.id, DataClass.PRESSURE, 101.0, moment, True),
+        team=reference,
+    )
+    points = [
+        DataPoint(team.id, DataClass.PRESSURE, 101.1, moment),
+        DataPoint(team.id, DataClass.PRESSURE, 101.1, moment),  # A second try
+        DataPoint(team.id, DataClass.COMMENT, "Hello!", moment),
+        DataPoint(team.id, DataClass.PRESSURE, 101.1, moment + timedelta(minutes=6)),
+    ]
+
+    DataPoint.reference_timeline.backfill()  # (as the api does at startup)
+    calls = _count_round_trips(monkeypatch)
+    assert ruleset.post_batch(points, team) == [True] * 4
+    # Stored at once, and scored at once:
+    assert [name for _, name in calls if name != "find_one"] == [
+        "bulk_write",
+        "find_one_and_update",
+    ]
+
+    worth = ruleset.point_menu[TeamLevel.VARSITY][DataClass.PRESSURE]
+    assert [point.rawscore for point in points] == [worth, -worth, 0.0, worth]
+    assert Team.find_by_id(team.id).score == worth * team.multiplier
+    assert DataPoint.count_documents({"team_reference": team.id}) == 4
+
+
+def test_window_already_scored():
+    ruleset = Rules()
+    ruleset.save()
+    moment = datetime(2026, 1, 1, 16, 6, 10)
+    reference = _team(Team.RESERVED_NAMES[4], TeamLevel.REFERENCE)
+    team = _team("Eager Team", TeamLevel.VARSITY)
+    ruleset.post_data(
+        DataPoint(reference.id, DataClass.PRESSURE, 101.0, moment, True),
+        team=reference,
+    )
+    worth = ruleset.point_menu[TeamLevel.VARSITY][DataClass.PRESSURE]
+    first = DataPoint(team.id, DataClass.PRESSURE, 101.1, moment)
+    ruleset.post_data(first, team=team)
+    assert first.rawscore == worth and first.scoring_key is not None
+
+    # Posted again, alone and then in a batch, the window is already held:
+    again = DataPoint(team.id, DataClass.PRESSURE, 101.1, moment)
+    ruleset.post_data(again, team=team)
+    batch = [
+        DataPoint(team.id, DataClass.PRESSURE, 101.1, moment),
+        DataPoint(team.id, DataClass.PRESSURE, 50.0, moment),  # Way off, too
+        DataPoint(team.id, DataClass.PRESSURE, 101.1, moment + timedelta(minutes=6)),
+    ]
+    assert ruleset.post_batch(batch, team) == [True] * 3
+    assert [point.rawscore for point in [again, *batch]] == [
+        -worth,
+        -worth,
+        -worth,
+        worth,
+    ]
+    assert [point.scoring_key for point in [again, *batch]][:3] == [None] * 3
+
+    stored = DataPoint.find({"team_reference": team.id})
+    assert sorted(point.rawscore for point in stored) == [-worth] * 3 + [worth] * 2
+    assert Team.find_by_id(team.id).score == -worth * team.multiplier
+
+
+def test_misses_looked_up_together(monkeypatch):
+    ruleset = Rules()
+    ruleset.save()
+    moment = datetime(2026, 1, 1, 17, 6, 10)
+    later = moment + timedelta(minutes=6)
+    reference = _team(Team.RESERVED_NAMES[5], TeamLevel.REFERENCE)
+    team = _team("Careless Team", TeamLevel.VARSITY)
+    for when in (moment, later):
+        ruleset.post_data(
+            DataPoint(reference.id, DataClass.PRESSURE, 101.0, when, True),
+            team=reference,
+        )
+    ruleset.post_data(DataPoint(team.id, DataClass.PRESSURE, 101.1, moment), team=team)
+
+    batch = [
+        DataPoint(team.id, DataClass.PRESSURE, 50.0, moment),
+        DataPoint(team.id, DataClass.PRESSURE, 60.0, moment),
+        DataPoint(team.id, DataClass.PRESSURE, 70.0, later),  # Not yet scored
+    ]
+    calls = _count_round_trips(monkeypatch)
+    assert ruleset.post_batch(batch, team) == [True] * 3
+    assert calls.count((DataPoint.collection.name, "find")) == 1
+    worth = ruleset.point_menu[TeamLevel.VARSITY][DataClass.PRESSURE]
+    assert [point.rawscore for point in batch] == [-worth, -worth, 0.0]
+
+
+def _readings(team: TeamCredentials, start: datetime) -> list:
+    """A mix of scored, penalized and unscored readings"""
+    return [
+        DataPoint(team.id, DataClass.PRESSURE, 101.1, start),
+        DataPoint(team.id, DataClass.PRESSURE, 101.1, start + timedelta(seconds=5)),
+        DataPoint(team.id, DataClass.TEMPERATURE, 70.0, start),
+        DataPoint(team.id, DataClass.PRESSURE, 50.0, start + timedelta(minutes=6)),
+        DataPoint(team.id, DataClass.COMMENT, "Hello!", start),
+    ]
+
+
+def test_queued_scoring_matches_synchronous():
+    ruleset = Rules()
+    ruleset.save()
+    QueuedDataPoint.collection.delete_many({})
+    start = datetime(2026, 1, 1, 14, 6, 0)
+    reference = _team(Team.RESERVED_NAMES[3], TeamLevel.REFERENCE)
+    direct = _team("Direct Team", TeamLevel.VARSITY)
+    queued = _team("Queued Team", TeamLevel.VARSITY)
+
+    expected = _readings(direct, start)
+    ruleset.post_data(
+        DataPoint(reference.id, DataClass.PRESSURE, 101.0, start, True),
+        team=reference,
+    )
+    for datapoint in expected:
+        ruleset.post_data(datapoint, team=direct)
+
+    # The reference point is queued with (and after) the team's data:
+    readings = _readings(queued, start)
+    assert QueuedDataPoint.enqueue(readings[:2]) == [True] * 2
+    QueuedDataPoint.enqueue(
+        [DataPoint(reference.id, DataClass.PRESSURE, 101.0, start, True)]
+    )
+    QueuedDataPoint.enqueue(readings[2:])
+    DataPoint.reference_timeline.clear()
+    assert QueuedDataPoint.score_batch(size=3) == 3
+    assert QueuedDataPoint.score_batch() == 3
+    assert QueuedDataPoint.score_batch() == 0
+
+    scored = DataPoint.find({"team_reference": queued.id}, sort=[("_id", 1)])
+    assert [point.rawscore for point in scored] == [
+        point.rawscore for point in expected
+    ]
+    assert Team.find_by_id(queued.id).score == Team.find_by_id(direct.id).score
+
+
+def test_queued_scoring_survives_a_dead_worker(monkeypatch):
+    ruleset = Rules()
+    ruleset.save()
+    QueuedDataPoint.collection.delete_many({})
+    moment = datetime(2026, 1, 1, 15, 6, 0)
+    team = _team("Resilient Team", TeamLevel.VARSITY)
+    QueuedDataPoint.enqueue([DataPoint(team.id, DataClass.PRESSURE, 101.1, moment)])
+
+    # A worker saves the scored data, then dies before clearing the queue:
+    monkeypatch.setattr(QueuedDataPoint.collection, "delete_many", lambda *a: None)
+    assert QueuedDataPoint.score_batch() == 1
+    monkeypatch.undo()
+    assert QueuedDataPoint.score_batch() == 0  # (still claimed)
+    score = Team.find_by_id(team.id).score
+
+    QueuedDataPoint.collection.update_many(
+        {}, {"$set": {QueuedDataPoint.field_path("claimed_at"): datetime.min}}
+    )
+    assert QueuedDataPoint.score_batch() == 1
+    assert Team.find_by_id(team.id).score == score
+    assert DataPoint.count_documents({"team_reference": team.id}) == 1
+    assert QueuedDataPoint.count_documents({}) == 0
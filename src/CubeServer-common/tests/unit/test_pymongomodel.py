@@ -1,13 +1,19 @@
 import pytest
-from bson import ObjectId
+from bson import ObjectId, encode
+from bson.raw_bson import RawBSONDocument
 from enum import Enum
+from pydoc import locate
 from typing import Optional, List
 from pymongo.errors import PyMongoError
+from cubeserver_common.models.utils import modelutils
 from cubeserver_common.models.utils.modelutils import (
     PyMongoModel,
     EncodableCodec,
     Encodable,
     BSON_TYPES,
+    UnloadedFieldError,
+    _locatable_name,
+    _locate,
 )
 
 from mongomock import MongoClient as MockMongoClient
@@ -52,6 +58,12 @@ class MyEncodable(Encodable):
 
 
 class MyModel(PyMongoModel):
+    foo: str
+    bar: int
+    baz: list
+    qux: MyEnum
+    weird: MyEncodable
+
     def __init__(
         self, foo: str = "", bar: int = 0, baz: list = [], qux: MyEnum = MyEnum.FOO
     ):
@@ -60,11 +72,7 @@ class MyModel(PyMongoModel):
         self.bar = bar
         self.baz = baz
         self.qux = qux
-        self.register_field(
-            "weird",
-            value=MyEncodable.test_encodable(),
-            custom_codec=EncodableCodec(MyEncodable),
-        )
+        self.weird = MyEncodable.test_encodable()
 
 
 def test_create():
@@ -92,6 +100,8 @@ def test_create():
     assert_bson_types(model.encode())
     model.save()
     assert isinstance(model._id, ObjectId)
+    # (encoding it gave it an id, but it is still saved)
+    assert MyModel.find_by_id(model._id).foo == "foo"
 
 
 def test_find_by_id():
@@ -119,3 +129,224 @@ def test_delete():
     model.save()
     model.remove()
     assert MyModel.find_by_id(model._id) is None
+
+
+def test_decode_plan():
+    model = MyModel(foo="planned", bar=7, baz=["baz"], qux=MyEnum.BAR)
+    model.save()
+    found_model = MyModel.find_by_id(model._id)
+    assert found_model.qux == MyEnum.BAR
+    assert found_model.weird.encode() == MyEncodable.test_encodable().encode()
+    # Every codec field is resolved ahead of time, keyed by its `_type`:
+    assert MyModel._decode_plan[("qux", _locatable_name(MyEnum))] is not None
+    assert ("weird", _locatable_name(MyEncodable)) in MyModel._decode_plan
+
+
+def test_decode_plan_locates_once(monkeypatch):
+    calls = []
+
+    def counting_locate(type_name):
+        calls.append(type_name)
+        return locate(type_name)
+
+    _locate.cache_clear()
+    monkeypatch.setattr(modelutils, "locate", counting_locate)
+    documents = [
+        {
+            "_id": ObjectId(),
+            "foo": {"_type": "None", "_val": "foo"},
+            "extra": {"_type": _locatable_name(MyEnum), "_val": "bar"},
+        }
+        for _ in range(25)
+    ]
+    decoded = [MyModel.decode(document) for document in documents]
+    assert all(model.extra == MyEnum.BAR for model in decoded)
+    assert calls == [_locatable_name(MyEnum)]
+
+
+def test_find_with_fields():
+    model = MyModel(foo="projected", bar=99, baz=["baz"], qux=MyEnum.BAR)
+    model.save()
+    partial = MyModel.find_one({"foo": "projected"}, fields=["foo", "qux"])
+    assert partial._id == model._id
+    assert partial.foo == "projected"
+    assert partial.qux == MyEnum.BAR
+    assert partial.is_partial
+    with pytest.raises(UnloadedFieldError):
+        partial.bar
+    assert not hasattr(partial, "weird")
+    assert all(isinstance(found.bar, int) for found in MyModel.find(fields=["bar"]))
+    assert MyModel.find_by_id(model._id, fields=["bar"]).bar == 99
+
+
+def test_save_partial():
+    model = MyModel(foo="partial save", bar=1, baz=["baz"], qux=MyEnum.FOO)
+    model.save()
+    partial = MyModel.find_by_id(model._id, fields=["bar"])
+    partial.bar = 2
+    partial.save()
+    found_model = MyModel.find_by_id(model._id)
+    assert found_model.bar == 2
+    assert found_model.foo == "partial save"
+    assert found_model.weird.encode() == MyEncodable.test_encodable().encode()
+
+
+def test_iter_find():
+    models = [
+        MyModel(foo="streamed", bar=i, baz=["baz"], qux=MyEnum.FOO) for i in range(10)
+    ]
+    for model in models:
+        model.save()
+    results = MyModel.iter_find({"foo": "streamed"}, sort=[("bar", 1)], batch_size=3)
+    assert not isinstance(results, list)
+    assert [found.bar for found in results] == list(range(10))
+    partials = MyModel.iter_find({"foo": "streamed"}, fields=["bar"], batch_size=3)
+    assert all(found.is_partial for found in partials)
+
+
+def test_save_many():
+    existing = MyModel(foo="bulk", bar=0, baz=["baz"], qux=MyEnum.FOO)
+    existing.save()
+    existing.bar = 100
+    partial = MyModel.find_by_id(existing._id, fields=["qux"])
+    partial.qux = MyEnum.BAR
+    new_models = [
+        MyModel(foo="bulk", bar=i, baz=["baz"], qux=MyEnum.FOO) for i in range(1, 6)
+    ]
+    assert MyModel.save_many([existing] + new_models) == []
+    assert all(isinstance(model._id, ObjectId) for model in new_models)
+    assert MyModel.count_documents({"foo": "bulk"}) == 6
+    assert MyModel.find_by_id(existing._id).bar == 100
+    assert MyModel.save_many([partial]) == []
+    assert MyModel.find_by_id(existing._id).qux == MyEnum.BAR
+    assert MyModel.find_by_id(existing._id).bar == 100
+
+
+class UniqueModel(MyModel):
+    pass
+
+
+def test_save_many_errors():
+    UniqueModel.collection.create_index("foo._val", unique=True)
+    first = UniqueModel(foo="unique")
+    duplicate = UniqueModel(foo="unique")
+    other = UniqueModel(foo="another")
+    failures = UniqueModel.save_many([first, duplicate, other])
+    assert [model for model, _ in failures] == [duplicate]
+    assert failures[0][1]["code"] == 11000
+    assert duplicate._id is None
+    assert first._id is not None and other._id is not None
+
+
+def test_save_changed_fields_only():
+    model = MyModel(foo="dirty", bar=1, baz=["baz"], qux=MyEnum.FOO)
+    model.save()
+    loaded = MyModel.find_by_id(model._id)
+    # Somebody else changes another field in the meantime:
+    MyModel.collection.update_one(
+        {"_id": model._id}, {"$set": {"foo._val": "changed elsewhere"}}
+    )
+    loaded.bar = 2
+    loaded.baz.append("appended in-place")
+    loaded.save()
+    found_model = MyModel.find_by_id(model._id)
+    assert found_model.foo == "changed elsewhere"
+    assert found_model.bar == 2
+    assert found_model.baz == ["baz", "appended in-place"]
+
+
+def test_save_unchanged_is_noop(monkeypatch):
+    model = MyModel(foo="unchanged", bar=1, baz=["baz"], qux=MyEnum.FOO)
+    model.save()
+    loaded = MyModel.find_by_id(model._id)
+    writes = []
+    monkeypatch.setattr(
+        MyModel.collection, "update_one", lambda *args, **kw: writes.append(args)
+    )
+    monkeypatch.setattr(
+        MyModel.collection, "replace_one", lambda *args, **kw: writes.append(args)
+    )
+    loaded.bar = 1  # Assigned, but not actually changed
+    loaded.save()
+    assert writes == []
+    loaded.qux = MyEnum.BAR
+    loaded.save()
+    assert writes == [
+        (
+            {"_id": model._id},
+            {"$set": {"qux": {"_type": _locatable_name(MyEnum), "_val": "bar"}}},
+        )
+    ]
+
+
+def test_save_after_save():
+    model = MyModel(foo="saved twice", bar=1, baz=["baz"], qux=MyEnum.FOO)
+    model.save()
+    model.baz.append("appended after insert")
+    model.save()
+    assert MyModel.find_by_id(model._id).baz == ["baz", "appended after insert"]
+
+
+def test_decode_lazy():
+    model = MyModel(foo="lazy", bar=7, baz=["a", "b"], qux=MyEnum.BAR)
+    raw = RawBSONDocument(encode(model.encode()))
+    lazy = MyModel.decode_lazy(raw)
+    assert set(vars(lazy)) == {"_id", "_raw"}
+    assert lazy.foo == "lazy"
+    assert set(vars(lazy)) == {"_id", "_raw", "foo"}
+    assert lazy.qux == MyEnum.BAR
+    assert lazy.weird.encode() == model.weird.encode()
+    assert lazy.encode() == model.encode()
+
+
+def test_decode_lazy_defaults():
+    model = MyModel(foo="missing bar")
+    document = model.encode()
+    del document["bar"]
+    lazy = MyModel.decode_lazy(RawBSONDocument(encode(document)))
+    assert lazy.bar == 0
+    with pytest.raises(AttributeError):
+        lazy.not_a_field
+
+
+def test_find_lazy():
+    model = MyModel(foo="found lazily", bar=3, baz=["x"], qux=MyEnum.FOO)
+    model.save()
+    lazy = MyModel.find_one({"foo": "found lazily"}, lazy=True)
+    assert lazy.bar == 3
+    assert "baz" not in vars(lazy)
+    assert MyModel.find({"foo": "found lazily"}, lazy=True)[0].id == model.id
+
+    # Only decoded fields can have changed:
+    lazy.baz.append("y")
+    lazy.bar = 4
+    operation, written = lazy._pending_write()
+    assert set(written) == {"bar", "baz"}
+    lazy.save()
+    saved = MyModel.find_by_id(model.id)
+    assert saved.baz == ["x", "y"]
+    assert saved.bar == 4
+    assert saved.weird.encode() == model.weird.encode()
+
+    partial = MyModel.find_one({"foo": "found lazily"}, fields=["foo"], lazy=True)
+    assert partial.foo == "found lazily"
+    with pytest.raises(UnloadedFieldError):
+        partial.bar
+
+
+def test_model_defined_before_the_client(monkeypatch):
+    monkeypatch.setattr(PyMongoModel, "mongo", None)
+    with pytest.warns(UserWarning):
+
+        class EarlyModel(PyMongoModel):
+            foo: str
+
+            def __init__(self, foo: str = ""):
+                super().__init__()
+                self.foo = foo
+
+    client = MockMongoClient()
+    PyMongoModel.update_mongo_client(client)
+    EarlyModel(foo="early").save()
+    assert EarlyModel.collection.database.client is client
+    assert EarlyModel.find_one({"foo": "early"}).foo == "early"
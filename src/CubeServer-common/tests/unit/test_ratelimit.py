@@ -0,0 +1,63 @@
+"""Tests for the rate limiting token buckets."""
+
+import pytest
+
+from cubeserver_common import config, ratelimit
+from cubeserver_common.models.config.rules import Rules
+from cubeserver_common.models.team import TeamLevel
+
+
+class Clock:
+    """Stands in for time() and monotonic()"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture(params=["memory", "mongo"])
+def buckets(request, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    monkeypatch.setattr(ratelimit, "monotonic", clock)
+    return ratelimit.make_token_buckets(request.param), clock
+
+
+def test_burst_then_rate(buckets):
+    buckets, clock = buckets
+    assert [buckets.take("team", 0.5, 3) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("team", 0.5, 3) == pytest.approx(2.0)
+    assert buckets.take("other team", 0.5, 3) == 0  # Each key has its own
+
+    clock.now += 1
+    assert buckets.take("team", 0.5, 3) == pytest.approx(1.0)
+    clock.now += 1
+    assert buckets.take("team", 0.5, 3) == 0
+    assert buckets.take("team", 0.5, 3) > 0
+
+    # It refills up to the burst only:
+    clock.now += 1000
+    assert [buckets.take("team", 0.5, 3) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("team", 0.5, 3) > 0
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        ratelimit.make_token_buckets("carrier pigeon")
+
+
+def test_rate_limit_follows_windows():
+    rules = Rules()
+    varsity_rate, varsity_burst = rules.rate_limit(TeamLevel.VARSITY)
+    jv_rate, jv_burst = rules.rate_limit(TeamLevel.JUNIOR_VARSITY)
+    # Varsity posts far more often than JV:
+    assert varsity_rate > jv_rate
+    assert varsity_rate * 3600 >= 14  # 10 pressure and 4 temperature windows
+    assert varsity_burst >= 2
+    # Teams without windows still get the minimum:
+    assert rules.rate_limit(None) == (
+        config.RATE_LIMIT_MIN_PER_HOUR / 3600,
+        config.RATE_LIMIT_MIN_BURST,
+    )
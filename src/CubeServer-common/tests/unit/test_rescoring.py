@@ -0,0 +1,301 @@
+"""Tests for rescoring whole teams at once."""
+
+import random
+from datetime import datetime, timedelta
+from time import monotonic, sleep
+from typing import Optional
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from cubeserver_common.config import RESCORE_STALE_AFTER
+from cubeserver_common.models.config.rules import RegularOccurrence, Rules
+from cubeserver_common.models.datapoint import DataClass, DataPoint
+from cubeserver_common.models import rescoring
+from cubeserver_common.models.rescoring import (
+    RescoreRun,
+    _rescoring_pool,
+    check_scores,
+    rescore_competition,
+    rescore_teams,
+)
+from cubeserver_common.models.team import (
+    Team,
+    TeamCredentials,
+    TeamHealth,
+    TeamLevel,
+)
+from cubeserver_common.models.utils.indexes import reconcile_indexes
+
+
+@pytest.fixture(autouse=True)
+def _indexes(mongo):
+    reconcile_indexes(DataPoint)  # (at most one point holds each window)
+    reconcile_indexes(RescoreRun)  # (and one run is going at a time)
+
+
+START = datetime(2026, 3, 1, 9, 0, 0)
+
+
+def _moment(rng: random.Random) -> datetime:
+    """A time near one of the windows (so that some windows get several)"""
+    return START + timedelta(
+        hours=rng.randrange(2),
+        seconds=rng.choice([0, 360, 900, 1800, 2700]) + rng.uniform(-240, 240),
+    )
+
+
+def _competition(rng: random.Random, rules: Optional[Rules] = None) -> Rules:
+    """Reference data, and a few teams that have posted plenty"""
+    for model in (Team, DataPoint, Rules):
+        model.collection.delete_many({})
+    DataPoint.reference_timeline.clear()
+    rules = rules or Rules()
+    rules.save()
+    reference = Team(name=Team.RESERVED_NAMES[1], weight_class=TeamLevel.REFERENCE)
+    reference.save()
+    for _ in range(60):
+        rules.post_data(
+            DataPoint(
+                reference.id,
+                rng.choice([DataClass.PRESSURE, DataClass.TEMPERATURE]),
+                rng.uniform(29.0, 31.0),
+                _moment(rng),
+                True,
+            )
+        )
+    for i, level in enumerate([TeamLevel.VARSITY, TeamLevel.JUNIOR_VARSITY, None]):
+        team = Team(name=f"Rescored Team {i}", weight_class=level, health=TeamHealth())
+        team.save()
+        credentials = TeamCredentials.of(Team.find_by_id(team.id))
+        for _ in range(150):
+            readings = [
+                (DataClass.PRESSURE, rng.uniform(29.0, 31.0)),
+                (DataClass.TEMPERATURE, rng.uniform(25.0, 35.0)),
+                (DataClass.COMMENT, rng.choice(["Hello!", "Oh, crap."])),
+            ]
+            if level is not None:  # (which has no points for signals)
+                readings.append((DataClass.SIGNAL_LIGHT, rng.random() < 0.5))
+            category, value = rng.choice(readings)
+            rules.post_data(
+                DataPoint(team.id, category, value, _moment(rng)), team=credentials
+            )
+    return rules
+
+
+def _point_by_point():
+    """Rescores every team one datapoint at a time"""
+    for team in Team.find():
+        team.reset_score()
+        for data in DataPoint.iter_by_team(team):
+            data.recalculate_score(0)
+
+
+def _results() -> tuple:
+    return (
+        {
+            point.id: (point.rawscore, point.scoring_key, point.value)
+            for point in DataPoint.find()
+        },
+        {team.id: team.score for team in Team.find()},
+    )
+
+
+def _compare_with_point_by_point():
+    stored = {model: list(model.collection.find()) for model in (Team, DataPoint)}
+    _point_by_point()
+    expected = _results()
+    for model, documents in stored.items():
+        model.collection.delete_many({})
+        model.collection.insert_many(documents)
+
+    scores = rescore_teams()
+    assert _results() == expected
+    assert scores == expected[1]
+
+
+def test_rescoring_matches_point_by_point():
+    rng = random.Random(1)
+    rules = Rules.find_by_id(_competition(rng).id)  # (not the shared defaults)
+    # Made stricter since the data were scored, and with a reference corrected:
+    for level in rules.accuracy_tolerance.values():
+        level[DataClass.TEMPERATURE] = 2.0
+    rules.save()
+    DataPoint.collection.update_one(
+        {"is_reference": True}, {"$set": {DataPoint.field_path("value"): 30.0}}
+    )
+    DataPoint.reference_timeline.clear()
+    _compare_with_point_by_point()
+
+
+def test_rescoring_after_the_windows_changed():
+    rng = random.Random(1)
+    overlapping = RegularOccurrence(interval=60 * 5, tolerance=60 * 4)
+    rules = _competition(
+        rng,
+        Rules(post_times={TeamLevel.VARSITY: {DataClass.PRESSURE: overlapping}}),
+    )
+    # Now some of the keys already held belong to other points' windows:
+    overlapping.offsets.reverse()
+    rules.save()
+    # And some are held by points other than those that scored them:
+    scored = DataPoint.find({"scoring_key": {"$ne": None}})
+    for point in rng.sample(scored, 3):
+        others = DataPoint.find(
+            {
+                "team_reference": point.team_reference,
+                "category": point.category.value,
+                "scoring_key": None,
+            }
+        )
+        key, point.scoring_key = point.scoring_key, None
+        point.save()
+        rng.choice(others).scoring_key = key
+        DataPoint.save_many(others)
+    _compare_with_point_by_point()
+
+
+def test_recompute_score():
+    rng = random.Random(3)
+    _competition(rng)
+    team = Team.find_one({"name": "Rescored Team 0"})
+    Team.adjust_score(team.id, 1000)
+    team.recompute_score()
+    score = sum(
+        point.rawscore * team.multiplier.amount
+        for point in DataPoint.find_by_team(team)
+    )
+    assert team.score == score
+    assert Team.find_by_id(team.id).score == score
+
+
+def test_rescore_competition():
+    rng = random.Random(4)
+    _competition(rng)
+    Team.adjust_score(Team.find_one({"name": "Rescored Team 1"}).id, 10)
+    assert len(check_scores()) == 1
+
+    progress = list(rescore_competition(workers=0, shard_size=2))
+    teams = Team.count_documents({})
+    assert progress[0] == (0, teams) and progress[-1] == (teams, teams)
+    assert [done for done, _ in progress] == sorted(done for done, _ in progress)
+    assert check_scores() == {}
+
+
+def _posting_meanwhile(monkeypatch, post):
+    """Has post() called (once) as the first team is being rescored"""
+    rescore_team = rescoring._rescore_team
+
+    def rescore_team_and_post(*args):
+        monkeypatch.setattr(rescoring, "_rescore_team", rescore_team)
+        post()
+        return rescore_team(*args)
+
+    monkeypatch.setattr(rescoring, "_rescore_team", rescore_team_and_post)
+
+
+def test_rescoring_while_posting(monkeypatch):
+    rng = random.Random(6)
+    rules = _competition(rng)
+    team = TeamCredentials.of(Team.find_one({"name": "Rescored Team 0"}))
+    Team.adjust_score(team.id, 10)  # (which rescoring puts right)
+    late = DataPoint(team.id, DataClass.SIGNAL_LIGHT, True, START)
+    _posting_meanwhile(monkeypatch, lambda: rules.post_data(late, team=team))
+    rescore_teams([team.id])
+    assert late.rawscore > 0
+    assert check_scores() == {}
+
+
+def test_rescoring_while_a_window_is_scored(monkeypatch):
+    rng = random.Random(7)
+    _competition(rng)
+    team = Team.find_one({"name": "Rescored Team 0"})
+    holder = DataPoint.find_one(
+        {"team_reference": team.id, "scoring_key": {"$ne": None}}
+    )
+    # Given up (as if by a change of the rules), so rescoring gives it back...
+    key, holder.scoring_key = holder.scoring_key, None
+    holder.save()
+
+    def post():  # ...but another point takes the window first:
+        taken = DataPoint(team.id, holder.category, holder.value, holder.moment)
+        taken.rawscore, taken.scoring_key = holder.rawscore, key
+        taken.save()
+        Team.adjust_score(team.id, taken.rawscore * team.multiplier.amount)
+
+    _posting_meanwhile(monkeypatch, post)
+    passes = []
+    rescore_once = rescoring._rescore_once
+    monkeypatch.setattr(
+        rescoring,
+        "_rescore_once",
+        lambda *args: passes.append(args) or rescore_once(*args),
+    )
+    rescore_teams([team.id])
+    assert len(passes) == 2  # (the first was turned away by the unique index)
+    held = DataPoint.find({"team_reference": team.id, "scoring_key": key})
+    assert len(held) == 1
+    assert check_scores() == {}
+
+
+def test_rescore_run():
+    rng = random.Random(5)
+    _competition(rng)
+    RescoreRun.collection.delete_many({})
+    run = RescoreRun.start(workers=0)
+    assert run is not None
+    deadline = monotonic() + 10
+    while RescoreRun.latest().running and monotonic() < deadline:
+        sleep(0.05)
+    latest = RescoreRun.latest()
+    assert latest.id == run.id
+    assert latest.finished != datetime.min and latest.error == ""
+    assert latest.done == latest.teams == Team.count_documents({})
+    assert latest.mismatched == []
+
+    RescoreRun().save()  # Another, still going:
+    assert RescoreRun.start(workers=0) is None
+    with pytest.raises(DuplicateKeyError):  # (even if started at once)
+        RescoreRun().save()
+
+
+def test_rescore_run_after_one_died():
+    died = RescoreRun()
+    died.updated -= timedelta(seconds=RESCORE_STALE_AFTER + 1)
+    died.save()
+    assert not RescoreRun.find_by_id(died.id).running
+    run = RescoreRun.start(workers=0)
+    assert run is not None
+    assert RescoreRun.find_by_id(died.id).error == "Stopped responding"
+    deadline = monotonic() + 10
+    while RescoreRun.find_by_id(run.id).running and monotonic() < deadline:
+        sleep(0.05)
+
+
+def _bound_collections() -> dict:
+    return {
+        model.__name__: (type(model.collection).__name__, model.collection.name)
+        for model in (Team, DataPoint, Rules)
+    }
+
+
+def test_rescoring_pool_workers(monkeypatch):
+    # (a server that is never reached: the workers must not touch the database
+    # until they are given teams to rescore)
+    for variable, value in {
+        "MONGODB_USERNAME": "user",
+        "MONGODB_PASSWORD": "password",
+        "MONGODB_HOSTNAME": "localhost",
+        "MONGODB_DATABASE": "cubeserver",
+        "MONGODB_OPTIONS": "serverSelectionTimeoutMS=100",
+    }.items():
+        monkeypatch.setenv(variable, value)
+    with _rescoring_pool(workers=2) as pool:
+        bound = [pool.submit(_bound_collections) for _ in range(2)]
+        assert [future.result(timeout=60) for future in bound] == [
+            {
+                "Team": ("Collection", "team"),
+                "DataPoint": ("Collection", "datapoint"),
+                "Rules": ("Collection", "rules"),
+            }
+        ] * 2
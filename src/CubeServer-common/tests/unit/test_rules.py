@@ -0,0 +1,96 @@
+"""Tests for the cached game rules."""
+
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+
+from cubeserver_common.models.config import rules as rules_module
+from cubeserver_common.models.config.rules import RegularOccurrence, Rules
+from cubeserver_common.models.team import TeamLevel
+from cubeserver_common.models.datapoint import DataClass
+
+
+def _reset():
+    Rules.collection.delete_many({})
+    Rules.invalidate()
+    ruleset = Rules()
+    ruleset.save()
+    return ruleset
+
+
+def test_retrieve_first():
+    # In a fresh interpreter (as at startup), with nothing cached or saved:
+    script = (
+        "from mongomock import MongoClient\n"
+        "from cubeserver_common.models.utils.modelutils import PyMongoModel\n"
+        "PyMongoModel.update_mongo_client(MongoClient())\n"
+        "from cubeserver_common.models.config.rules import Rules\n"
+        "assert Rules.retrieve_instance() is None\n"
+        "Rules().save()\n"
+        "assert Rules.retrieve_instance().version == 1\n"
+    )
+    subprocess.run([sys.executable, "-c", script], check=True)
+
+
+def test_retrieve_cached(monkeypatch):
+    ruleset = _reset()
+    assert ruleset.version == 1
+    first = Rules.retrieve_instance()
+    assert first.id == ruleset.id
+    # Within the refresh period, the database is not read at all:
+    monkeypatch.setattr(Rules, "find_one", None)
+    assert Rules.retrieve_instance() is first
+
+
+def test_revalidate(monkeypatch):
+    _reset()
+    first = Rules.retrieve_instance()
+    monkeypatch.setattr(rules_module, "SETTINGS_REFRESH", 0)
+    # Unchanged, so the decoded ruleset is kept:
+    assert Rules.retrieve_instance() is first
+
+    # Another worker edits the rules:
+    edited = Rules.from_json(first.to_json())
+    edited.point_menu[TeamLevel.VARSITY][DataClass.PRESSURE] = 7
+    edited.save()
+    assert edited.version == 2
+    # (this worker still has the old ruleset cached)
+    Rules._selected = (0, first.id, first.version, first)
+    current = Rules.retrieve_instance()
+    assert current is not first
+    assert current.version == 2
+    assert current.point_menu[TeamLevel.VARSITY][DataClass.PRESSURE] == 7
+
+
+def test_version_never_goes_back():
+    ruleset = _reset()
+    stale = Rules.from_json(ruleset.to_json())
+    Rules.find_by_id(ruleset.id).save()
+    Rules.find_by_id(ruleset.id).save()
+    stale.save()
+    assert stale.version == 4
+    assert Rules.find_by_id(ruleset.id).version == 4
+
+
+def test_compiled_windows_match():
+    hour = datetime(2026, 3, 1, 9, 0, 0)
+    for occurrence in (
+        RegularOccurrence(),
+        RegularOccurrence(interval=60 * 5, tolerance=60 * 4),  # Overlapping
+        RegularOccurrence(offsets=[3500, 100, 1800], tolerance=150),
+    ):
+        windows = occurrence.compile()
+        for second in range(60 * 60):
+            moment = hour + timedelta(seconds=second, microseconds=250)
+            assert windows.match(moment) == occurrence.get_match_window(moment)
+
+
+def test_plan_is_recompiled_when_saved():
+    ruleset = Rules.find_by_id(_reset().id)  # (not the shared defaults)
+    plan = ruleset.plan
+    assert ruleset.plan is plan
+    assert plan[TeamLevel.VARSITY, DataClass.PRESSURE].points == 1
+    ruleset.point_menu[TeamLevel.VARSITY][DataClass.PRESSURE] = 7
+    ruleset.save()
+    assert ruleset.plan[TeamLevel.VARSITY, DataClass.PRESSURE].points == 7
@@ -0,0 +1,157 @@
+"""Tests for the Team model."""
+
+from cubeserver_common.models.team import Team, TeamHealth, TeamStatus
+from cubeserver_common.models.utils import PyMongoModel, TTLCache
+from cubeserver_common.models.utils.modelutils import FLAT
+
+
+def test_adjust_score():
+    team = Team(name="Atomic Team", health=TeamHealth(score=10))
+    team.save()
+    health = Team.adjust_score(team.id, 5)
+    assert health.score == 15
+    assert health.last_score == 10
+    health = Team.adjust_score(team.id, -2.5)
+    assert health.score == 12.5
+    assert health.last_score == 15
+
+    stored = Team.find_by_id(team.id)
+    assert stored.health == health
+    assert stored.name == "Atomic Team"
+
+
+def test_adjust_score_interleaved():
+    team = Team(name="Busy Team", health=TeamHealth())
+    team.save()
+    first = Team.find_by_id(team.id)
+    second = Team.find_by_id(team.id)
+    first.change_score(3)
+    second.change_score(4)
+    assert first.score == 3
+    assert second.score == 7
+    second.save()  # Must not write the stale score back
+    assert Team.find_by_id(team.id).score == 7
+
+
+def test_reset_score():
+    team = Team(name="Reset Team", health=TeamHealth(score=42))
+    team.save()
+    team.reset_score()
+    assert team.score == 0
+    assert team.health.last_score == 42
+    assert Team.find_by_id(team.id).score == 0
+
+
+def test_adjust_score_missing_team():
+    assert Team.adjust_score(Team().id, 1) is None
+
+
+def test_score_in_flat_storage(monkeypatch):
+    monkeypatch.setattr(Team, "flat_storage", True)
+    Team.update_schema(layout=FLAT)
+    team = Team(name="Flat Team", health=TeamHealth(score=10))
+    team.save()
+    health = Team.adjust_score(team.id, 5)
+    assert (health.score, health.last_score) == (15, 10)
+    Team.set_scores({team.id: 20})
+    document = Team.collection.find_one({"_id": team.id})
+    assert document["health"]["score"] == 20
+    assert document["health"]["lastScore"] == 15
+    assert Team.find_by_id(team.id).health.last_score == 15
+
+
+def test_credentials_cached():
+    team = Team(name="Cached Team", status=TeamStatus.PARTICIPATING)
+    team.save()
+    credentials = Team.credentials("Cached Team")
+    assert credentials.id == team.id
+    assert credentials.secret == team.secret
+    assert credentials.status == TeamStatus.PARTICIPATING
+    assert not credentials.is_reference
+    # Changed elsewhere; still cached:
+    Team.collection.update_one(
+        {"_id": team.id}, {"$set": {"status._val": TeamStatus.DISQUALIFIED.value}}
+    )
+    assert Team.credentials("Cached Team") is credentials
+
+    # An admin edit drops them:
+    edited = Team.find_by_id(team.id)
+    edited.status = TeamStatus.ELIMINATED
+    edited.save()
+    assert Team.credentials("Cached Team").status == TeamStatus.ELIMINATED
+    edited.remove()
+    assert Team.credentials("Cached Team") is None
+    assert Team.credentials("No Such Team") is None
+
+
+def test_credentials_expire(monkeypatch):
+    team = Team(name="Expiring Team")
+    team.save()
+    monkeypatch.setattr(Team._credentials, "ttl", 0)
+    first = Team.credentials("Expiring Team")
+    assert Team.credentials("Expiring Team") is not first
+    assert Team.credentials("Expiring Team") == first
+
+
+def test_ttlcache_evicts_least_recently_used():
+    cache = TTLCache(2, 60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    cache.discard_where(lambda value: value == 3)
+    assert cache.get("c") is None
+    assert len(cache) == 1
+
+
+def test_code_update_taken_once(monkeypatch):
+    team = Team(name="Coding Team")
+    team.save()
+    team.update_code(b"print('Hello, World!')")
+
+    assert Team.take_code_update(team.id)
+    assert not Team.take_code_update(team.id)  # (already taken)
+    assert Team.find_by_id(team.id).code_update_taken
+
+    # Polling an update that was already taken does not write:
+    writes = []
+    for name in ("update_one", "replace_one", "find_one_and_update"):
+        monkeypatch.setattr(
+            Team.collection, name, lambda *args, **kw: writes.append(args)
+        )
+    polled = Team.find_by_id(team.id, fields=["code_update_taken", "_code_update"])
+    assert polled.get_code_update() == b"print('Hello, World!')"
+    assert polled.poll_code_update() == (b"print('Hello, World!')", False)
+    polled.save()
+    assert writes == []
+
+
+def test_code_update_new_to_one_poll():
+    team = Team(name="Polled Team")
+    team.save()
+    team.update_code(b"print('Hello again!')")
+    # Two polls at once, both having read the update before it was taken:
+    first, second = (
+        Team.find_by_id(team.id, fields=["code_update_taken", "_code_update"])
+        for _ in range(2)
+    )
+    assert first.poll_code_update() == (b"print('Hello again!')", True)
+    assert second.poll_code_update() == (b"print('Hello again!')", False)
+
+
+def test_save_in_a_session(monkeypatch):
+    sessions = []
+    monkeypatch.setattr(
+        PyMongoModel, "save", lambda self, session=None: sessions.append(session)
+    )
+    monkeypatch.setattr(
+        PyMongoModel,
+        "save_many",
+        classmethod(lambda cls, models, session=None: sessions.append(session) or []),
+    )
+    session = object()  # (standing in for a ClientSession)
+    Team(name="Transactional Team").save(session=session)
+    assert Team.save_many([Team(name="Another")], session=session) == []
+    assert sessions == [session, session]
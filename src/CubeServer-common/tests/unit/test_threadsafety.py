@@ -0,0 +1,122 @@
+"""Tests that models can be shared between threads."""
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from types import MappingProxyType
+
+import pytest
+from mongomock import MongoClient as MockMongoClient
+
+from cubeserver_common.models.utils.modelutils import Encodable, PyMongoModel
+
+client = MockMongoClient()
+PyMongoModel.update_mongo_client(client)
+
+THREADS = 32
+ROUNDS = 200
+
+
+class Color(Enum):
+    RED = "red"
+    BLUE = "blue"
+
+
+class Counter(Encodable):
+    def __init__(self, count: int = 0):
+        self.count = count
+        super().__init__()
+
+    def encode(self) -> dict:
+        return {"count": self.count}
+
+    @classmethod
+    def decode(cls, value: dict):
+        return cls(value["count"])
+
+
+class SharedModel(PyMongoModel):
+    name: str
+    color: Color
+    counter: Counter
+    tags: list
+
+    def __init__(self, name: str = "", color: Color = Color.RED):
+        super().__init__()
+        self.name = name
+        self.color = color
+        self.counter = Counter()
+        self.tags = []
+
+
+@pytest.fixture
+def fast_switching():
+    """Switches threads as often as possible, to shake out races"""
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def _hammer(worker: int):
+    """Encodes, decodes, saves and finds models, setting attributes
+    (declared or not) along the way"""
+    for i in range(ROUNDS):
+        model = SharedModel(f"{worker}-{i}", Color.BLUE if i % 2 else Color.RED)
+        model.counter = Counter(i)
+        model.scratch = object()  # Not a field; must not become one
+        document = model.encode()
+        decoded = SharedModel.decode(dict(document))
+        assert decoded.name == model.name
+        assert decoded.color == model.color
+        assert decoded.counter.count == i
+        assert "scratch" not in document
+        if i % 20 == 0:
+            saved = SharedModel(model.name, model.color)
+            saved.counter = Counter(i)
+            saved.save()
+            found = SharedModel.find_by_id(saved.id)
+            assert found.counter.count == i
+            found.tags = [worker]
+            found.save()
+
+
+def test_concurrent_encode_decode(fast_switching):
+    schema = dict(SharedModel._fields)
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        for result in executor.map(_hammer, range(THREADS)):
+            assert result is None
+    assert dict(SharedModel._fields) == schema
+    assert list(SharedModel._fields) == ["name", "color", "counter", "tags"]
+    assert SharedModel.collection.count_documents({}) == THREADS * ROUNDS // 20
+
+
+def test_schema_is_frozen():
+    assert isinstance(SharedModel._fields, MappingProxyType)
+    assert isinstance(SharedModel._decode_plan, MappingProxyType)
+    with pytest.raises(TypeError):
+        SharedModel._fields["extra"] = None
+    model = SharedModel()
+    model.extra = 42
+    del model.extra
+    assert "extra" not in SharedModel._fields
+    with pytest.raises(TypeError):
+        model.register_field("extra", 42)
+
+
+def test_fields_need_annotations():
+    with pytest.raises(TypeError):
+
+        class ClassDefault(PyMongoModel):
+            name: str = "nope"
+
+            def __init__(self):
+                super().__init__()
+
+    with pytest.raises(TypeError):
+
+        class NoCodec(PyMongoModel):
+            thing: complex
+
+            def __init__(self):
+                super().__init__()